@@ -0,0 +1,106 @@
+"""
+Microbenchmark for the WebSocket message dispatch path (CapitalComAPI._ws_on_message).
+
+Feeds synthetic 'quote' and 'ohlc.event' messages through the current dispatcher and through a copy of
+the previous implementation (f-string stream key + _ws_lock per message + eager debug formatting) and
+prints messages/sec for both. No network access or login is needed.
+
+    python CapitalA/bench_ws_dispatch.py [--messages 200000] [--epics 50]
+"""
+import argparse
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from library import CapitalComAPI, HistoricalPriceResolution, OhlcBarType, WebsocketDataType, logger
+
+
+def legacy_on_message(api: CapitalComAPI, message_str: str):
+    """The dispatch logic of _ws_on_message before the routing table, kept for comparison."""
+    legacy_dispatch(api, json.loads(message_str), message_str)
+
+
+def legacy_dispatch(api: CapitalComAPI, message: Dict[str, Any], message_str: str):
+    logger.debug(f"WebSocket received message: {message_str[:300]}")
+    if message.get("errorCode"):
+        return
+    if "status" in message and message.get("status") == "OK" and "correlationId" in message and "payload" in message:
+        subs_payload = message["payload"].get("subscriptions")
+        if subs_payload and isinstance(subs_payload, dict) and list(subs_payload.values())[0] == "PROCESSED":
+            return
+    server_destination = message.get("destination")
+    payload = message.get("payload")
+    if payload and "epic" in payload:
+        epic = payload["epic"]
+        key: Optional[str] = None
+        if server_destination == "quote":
+            key = f"/market/{epic}"
+        elif server_destination == "ohlc.event":
+            key = f"/ohlc/{epic}/{payload.get('resolution')}/{payload.get('type', OhlcBarType.CLASSIC.value)}"
+        if key:
+            with api._ws_lock:
+                subscription_info = api._ws_subscriptions.get(key)
+            if subscription_info and subscription_info["active"] and subscription_info["callback"]:
+                subscription_info["callback"](payload)
+
+
+def build_messages(epics: List[str], count: int) -> List[str]:
+    messages = []
+    for i in range(count):
+        epic = epics[i % len(epics)]
+        if i % 10 == 9:
+            payload: Dict[str, Any] = {"resolution": "MINUTE", "epic": epic, "type": "classic", "priceType": "bid",
+                                       "t": 1700000000000 + i, "h": 1.1, "l": 1.0, "o": 1.05, "c": 1.07}
+            destination = "ohlc.event"
+        else:
+            payload = {"epic": epic, "product": "CFD", "bid": 1.0 + i * 1e-6, "bidQty": 1000000.0,
+                       "ofr": 1.0002 + i * 1e-6, "ofrQty": 1000000.0, "timestamp": 1700000000000 + i}
+            destination = "quote"
+        messages.append(json.dumps({"status": "OK", "destination": destination, "payload": payload}))
+    return messages
+
+
+def run(handler, messages: List[str]) -> float:
+    start = time.perf_counter()
+    for message_str in messages:
+        handler(message_str)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--epics", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    api = CapitalComAPI("bench", "bench", "bench", rate_limit=False)
+    epics = [f"EPIC{i}" for i in range(args.epics)]
+    received = [0]
+
+    def callback(payload: Dict[str, Any]):
+        received[0] += 1
+
+    api._ws_register_subscriptions(epics, WebsocketDataType.MARKET, callback)
+    api._ws_register_subscriptions(epics, WebsocketDataType.OHLC, callback, resolution=HistoricalPriceResolution.MINUTE)
+    messages = build_messages(epics, args.messages)
+
+    before = run(lambda m: legacy_on_message(api, m), messages)
+    after = run(lambda m: api._ws_on_message(None, m), messages)
+
+    # Same comparison without json.loads, i.e. only the routing work done per message.
+    parsed = {m: json.loads(m) for m in messages}
+    before_dispatch = run(lambda m: legacy_dispatch(api, parsed[m], m), messages)
+    after_dispatch = run(lambda m: api._ws_dispatch(parsed[m]["destination"], parsed[m]["payload"]), messages)
+    assert received[0] == 4 * len(messages), "every message should reach its callback"
+
+    print(f"{len(messages)} messages, {len(epics)} epics")
+    print(f"on_message  before (string key + lock): {before:12,.0f} msg/s")
+    print(f"on_message  after  (route table):       {after:12,.0f} msg/s  ({after / before:.2f}x)")
+    print(f"dispatch    before (string key + lock): {before_dispatch:12,.0f} msg/s")
+    print(f"dispatch    after  (route table):       {after_dispatch:12,.0f} msg/s  ({after_dispatch / before_dispatch:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,30 @@ import threading
 import time
 import logging
 import math
+import asyncio
+import copy
+import os
+import queue
+import random
+import heapq
+import inspect
+import itertools
+import struct
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-from typing import List, Dict, Optional, Callable, Any, Union
+from typing import List, Dict, Optional, Callable, Any, Union, Tuple, Iterator, AsyncIterator
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp is only needed by AsyncCapitalComAPI
+    aiohttp = None
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by the columnar/array helpers
+    np = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -46,11 +68,84 @@ class HistoricalPriceResolution(Enum):
     WEEK = "WEEK"
     MONTH = "MONTH"
 
+    @property
+    def seconds(self) -> int:
+        """Nominal bar duration in seconds (MONTH is approximated as 31 days)."""
+        return _RESOLUTION_SECONDS[self]
+
+_RESOLUTION_SECONDS: Dict[HistoricalPriceResolution, int] = {
+    HistoricalPriceResolution.MINUTE: 60,
+    HistoricalPriceResolution.MINUTE_5: 5 * 60,
+    HistoricalPriceResolution.MINUTE_10: 10 * 60,
+    HistoricalPriceResolution.MINUTE_15: 15 * 60,
+    HistoricalPriceResolution.MINUTE_30: 30 * 60,
+    HistoricalPriceResolution.HOUR: 3600,
+    HistoricalPriceResolution.HOUR_2: 2 * 3600,
+    HistoricalPriceResolution.HOUR_3: 3 * 3600,
+    HistoricalPriceResolution.HOUR_4: 4 * 3600,
+    HistoricalPriceResolution.DAY: 86400,
+    HistoricalPriceResolution.WEEK: 7 * 86400,
+    HistoricalPriceResolution.MONTH: 31 * 86400,
+}
+
+API_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+def _to_utc_datetime(value: Union[str, datetime]) -> datetime:
+    """Parses an API date string (or datetime) into a naive UTC datetime."""
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    return datetime.strptime(value[:19], API_DATETIME_FORMAT)
+
+def _format_api_datetime(value: datetime) -> str:
+    return value.strftime(API_DATETIME_FORMAT)
+
+def _require_numpy(feature: str):
+    if np is None:
+        raise ImportError(f"{feature} requires the 'numpy' package (pip install numpy).")
+
+# One record per bar: UTC bar time plus bid/ask OHLC and last traded volume (80 bytes).
+OHLC_BAR_DTYPE = [
+    ("timestamp", "<M8[ms]"),
+    ("open_bid", "<f8"), ("open_ask", "<f8"),
+    ("high_bid", "<f8"), ("high_ask", "<f8"),
+    ("low_bid", "<f8"), ("low_ask", "<f8"),
+    ("close_bid", "<f8"), ("close_ask", "<f8"),
+    ("volume", "<f8"),
+]
+
+def historical_prices_to_array(prices: List[Dict[str, Any]]) -> "np.ndarray":
+    """
+    Converts the 'prices' list of a prices/{epic} response into a NumPy structured array of OHLC_BAR_DTYPE,
+    in a single pass. Missing values become NaN; columns are read as e.g. bars["close_bid"].
+    """
+    _require_numpy("historical_prices_to_array")
+    nan = float("nan")
+    empty: Dict[str, Any] = {}
+    rows = []
+    for bar in prices:
+        o = bar.get("openPrice") or empty
+        h = bar.get("highPrice") or empty
+        l = bar.get("lowPrice") or empty
+        c = bar.get("closePrice") or empty
+        volume = bar.get("lastTradedVolume")
+        rows.append((
+            (bar.get("snapshotTimeUTC") or bar.get("snapshotTime") or "NaT")[:19],
+            o.get("bid", nan), o.get("ask", nan),
+            h.get("bid", nan), h.get("ask", nan),
+            l.get("bid", nan), l.get("ask", nan),
+            c.get("bid", nan), c.get("ask", nan),
+            nan if volume is None else volume,
+        ))
+    return np.array(rows, dtype=OHLC_BAR_DTYPE)
+
 class WebSocketStatus(Enum):
     DISCONNECTED = "DISCONNECTED"
     CONNECTING = "CONNECTING"
     CONNECTED = "CONNECTED"
     STOPPING = "STOPPING"
+    AUTH_FAILED = "AUTH_FAILED"
 
 class WebsocketDataType(Enum):
     MARKET = "MARKET"  
@@ -60,7 +155,1064 @@ class OhlcBarType(Enum):
     CLASSIC = "classic"
     HEIKIN_ASHI = "heikin-ashi"
 
-class CapitalComAPI:
+class WebsocketDispatchMode(Enum):
+    INLINE = "inline"      # callbacks run on the WebSocket reader thread
+    THREADED = "threaded"  # reader thread only parses and enqueues; callbacks run on worker threads
+
+def _open_trade_payload(epic: str, direction: TradeDirection, size: float,
+                        guaranteed_stop: bool = False, stop_level: Optional[float] = None,
+                        stop_distance: Optional[float] = None, profit_level: Optional[float] = None,
+                        profit_distance: Optional[float] = None, trailing_stop: bool = False,
+                        trailing_stop_distance: Optional[float] = None,
+                        force_open: bool = True) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {
+        "epic": epic,
+        "direction": direction.value,
+        "size": str(size), 
+        "guaranteedStop": guaranteed_stop,
+        "trailingStop": trailing_stop,
+
+        "forceOpen": force_open,
+    }
+    if stop_level is not None: payload["stopLevel"] = str(stop_level)
+    if stop_distance is not None: payload["stopDistance"] = str(stop_distance)
+    if profit_level is not None: payload["profitLevel"] = str(profit_level) 
+    if profit_distance is not None: payload["profitDistance"] = str(profit_distance) 
+    if trailing_stop and trailing_stop_distance is not None:
+        payload["trailingStopDistance"] = str(trailing_stop_distance)
+    return payload
+
+_BULK_ORDER_REQUIRED_KEYS = ("epic", "direction", "size")
+
+def _validate_bulk_orders(orders: List[Dict[str, Any]], open_trade: Callable[..., Any]):
+    """Checks every order of a bulk request up front, so a typo fails the call before anything is sent."""
+    accepted = inspect.signature(open_trade).parameters
+    takes_any = any(param.kind == inspect.Parameter.VAR_KEYWORD for param in accepted.values())
+    for index, order in enumerate(orders):
+        missing = [key for key in _BULK_ORDER_REQUIRED_KEYS if key not in order]
+        if missing:
+            raise ValueError(f"Order {index} is missing {', '.join(missing)}.")
+        unknown = [] if takes_any else [key for key in order if key not in accepted]
+        if unknown:
+            raise ValueError(f"Order {index} has unknown open_trade arguments: {', '.join(map(str, unknown))}.")
+        if not isinstance(order["direction"], TradeDirection):
+            raise ValueError(f"Order {index}: direction must be a TradeDirection, got {order['direction']!r}.")
+
+def _bulk_order_result(index: int, order: Dict[str, Any], response: Optional[Dict[str, Any]],
+                       error: Optional[Exception], started: float, finished: float, batch_started: float) -> Dict[str, Any]:
+    return {
+        "index": index,
+        "order": order,
+        "ok": error is None and response is not None,
+        "response": response,
+        "deal_reference": (response or {}).get("dealReference"),
+        "error": str(error) if error is not None else None,
+        "status_code": getattr(error, "status_code", None),
+        "latency_seconds": finished - started,
+        "sent_after_seconds": started - batch_started,
+        "completed_after_seconds": finished - batch_started,
+    }
+
+def _close_trade_payload(deal_id: str, direction: Optional[TradeDirection] = None,
+                         size: Optional[float] = None, order_type: str = "MARKET",
+                         level: Optional[float] = None,
+                         time_in_force: str = "GOOD_TILL_CANCELLED") -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"dealId": deal_id} 
+    if direction: payload["direction"] = direction.value
+    if size is not None: payload["size"] = str(size)
+
+    if order_type.upper() != "MARKET":
+        payload["orderType"] = order_type.upper()
+        if level is None:
+            raise ValueError("Level must be specified for non-market order types for closing.")
+        payload["level"] = str(level)
+        payload["timeInForce"] = time_in_force 
+    return payload
+
+def _update_trade_payload(stop_level: Optional[float] = None,
+                          profit_level: Optional[float] = None, 
+                          trailing_stop: Optional[bool] = None,
+                          trailing_stop_distance: Optional[float] = None,
+                          guaranteed_stop: Optional[bool] = None) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {}
+    if stop_level is not None: payload["stopLevel"] = str(stop_level)
+    if profit_level is not None: payload["profitLevel"] = str(profit_level) 
+    if trailing_stop is not None: payload["trailingStop"] = trailing_stop
+    if trailing_stop_distance is not None:
+        payload["trailingStopDistance"] = str(trailing_stop_distance)
+    if guaranteed_stop is not None:
+         payload["guaranteedStop"] = guaranteed_stop
+    return payload
+
+def _historical_prices_params(resolution: HistoricalPriceResolution, num_points: Optional[int] = None,
+                              start_date: Optional[str] = None, end_date: Optional[str] = None) -> Dict[str, Any]:
+    params: Dict[str, Any] = {"resolution": resolution.value}
+    if num_points is not None: 
+        params["max"] = num_points
+
+    if start_date: params["from"] = start_date
+    if end_date: params["to"] = end_date
+
+    if num_points is None and not (start_date and end_date): 
+        if start_date and not end_date: 
+             params["max"] = 100 
+        elif end_date and not start_date: 
+             params["max"] = 100 
+        elif not start_date and not end_date: 
+             params["max"] = 100 
+             logger.debug("No date range or num_points specified for historical_prices, defaulting to max=100.")
+    return params
+
+def _transaction_history_params(transaction_type: Optional[str] = None, from_date: Optional[str] = None,
+                                to_date: Optional[str] = None, detailed: bool = False,
+                                last_period_seconds: Optional[int] = None) -> Dict[str, Any]:
+    params: Dict[str, Any] = {}
+    if transaction_type: params['type'] = transaction_type
+    if from_date: params['from'] = from_date 
+    if to_date: params['to'] = to_date       
+    if last_period_seconds is not None: params['lastPeriod'] = last_period_seconds
+    if detailed: params['detailed'] = detailed 
+    return params
+
+def _transaction_windows(from_date: Union[str, datetime], to_date: Optional[Union[str, datetime]],
+                         window: timedelta) -> Iterator[Tuple[str, str]]:
+    """Yields consecutive (from, to) API date strings covering the range, lazily."""
+    start = _to_utc_datetime(from_date)
+    end = _to_utc_datetime(to_date) if to_date is not None else datetime.now(timezone.utc).replace(tzinfo=None)
+    if window <= timedelta(0):
+        raise ValueError("window must be a positive timedelta.")
+    if end <= start:
+        raise ValueError(f"End of transaction range ({end}) must be after its start ({start}).")
+    while start < end:
+        window_end = min(start + window, end)
+        yield _format_api_datetime(start), _format_api_datetime(window_end)
+        start = window_end
+
+def _new_window_transactions(transactions: List[Dict[str, Any]], previous_keys: set) -> Tuple[List[Dict[str, Any]], set]:
+    """
+    Orders one window's transactions oldest first and drops those already yielded by the previous
+    window (the API treats both bounds as inclusive). Returns them with this window's keys.
+    """
+    keys = set()
+    fresh = []
+    for transaction in sorted(transactions, key=lambda t: t.get("dateUtc") or t.get("date") or ""):
+        key = transaction.get("reference") or (transaction.get("dateUtc"), transaction.get("transactionType"),
+                                               transaction.get("instrumentName"), transaction.get("size"))
+        keys.add(key)
+        if key not in previous_keys:
+            fresh.append(transaction)
+    return fresh, keys
+
+def _market_details_request(epic: Optional[str] = None, epics: Optional[List[str]] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Returns the (endpoint, params) pair used by get_market_details."""
+    if epic and epics:
+        raise ValueError("Provide either a single 'epic' or a list of 'epics', not both.")
+
+    if epic:
+        logger.info(f"Fetching market details for epic: {epic}")
+        return f"markets/{epic}", None
+    elif epics:
+        logger.info(f"Fetching market details for epics: {','.join(epics)}")
+        return "markets", {"epics": ",".join(epics)}
+    else: 
+        logger.info("Fetching all navigable market details...")
+        return "markets", None
+
+def _log_account_preferences(preferences: Optional[Dict[str, Any]]):
+    if preferences:
+        hedging_status = preferences.get('hedgingMode', 'N/A') 
+        leverages_summary = []
+
+        leverages_dict = preferences.get('leverages', {})
+        if isinstance(leverages_dict, dict):
+            for instrument_type, lev_details in leverages_dict.items():
+                leverages_summary.append((instrument_type, lev_details.get('current')))
+        logger.info(f"Account preferences retrieved: Hedging: {hedging_status}, Leverages: {leverages_summary}")
+
+def _leverage_from_preferences(account_prefs: Dict[str, Any], instrument_type: str) -> Optional[Any]:
+    """Reads the current leverage for an instrument type from an accounts/preferences response."""
+    leverage_val = None
+
+    leverages_data = account_prefs.get("leverages", {}) 
+    instrument_type_leverage_info = leverages_data.get(instrument_type) if isinstance(leverages_data, dict) else None
+
+    if instrument_type_leverage_info and isinstance(instrument_type_leverage_info, dict):
+        leverage_val = instrument_type_leverage_info.get("current") 
+    elif isinstance(account_prefs.get("leverages"), list): 
+         for lev_info in account_prefs.get("leverages", []):
+            if lev_info.get("instrumentType") == instrument_type:
+                leverage_val = lev_info.get("leverage") 
+                break
+    return leverage_val
+
+def _trade_size_for_amount(epic: str, investment_amount_in_quote_currency: float, direction: TradeDirection,
+                           market_data: Optional[Dict[str, Any]], account_prefs: Optional[Dict[str, Any]]) -> float:
+    """Sizing math behind calculate_trade_size_for_amount, given already fetched market details and preferences."""
+    if not market_data:
+        raise CapitalComAPIError(f"Could not fetch market details for epic {epic} to calculate size.")
+
+    snapshot = market_data.get("snapshot")
+    instrument_details = market_data.get("instrument") 
+    dealing_rules = market_data.get("dealingRules")
+
+    if not snapshot or not instrument_details or not dealing_rules:
+        raise CapitalComAPIError(f"Market details for {epic} are incomplete (missing snapshot, instrument, or dealingRules). Cannot calculate size.")
+
+    price = snapshot.get("offer") if direction == TradeDirection.BUY else snapshot.get("bid")
+    if price is None or price <= 0:
+        raise ValueError(f"Invalid or zero price ({price}) for {epic} ({direction.value}). Cannot calculate size.")
+
+    instrument_type = instrument_details.get("type")
+    if not instrument_type:
+        raise ValueError(f"Instrument type not found for epic {epic}. Cannot determine account leverage.")
+
+    if not account_prefs or "leverages" not in account_prefs:
+        raise CapitalComAPIError("Could not fetch account preferences or leverage information.")
+
+    leverage_val = _leverage_from_preferences(account_prefs, instrument_type)
+
+    if leverage_val is None or not isinstance(leverage_val, (int, float)) or leverage_val <= 0:
+        raise ValueError(f"Leverage for instrument type {instrument_type} not found or invalid ({leverage_val}) in account preferences.")
+    logger.debug(f"Using account leverage {leverage_val}:1 for instrument type {instrument_type} (epic {epic}).")
+
+    raw_size = (investment_amount_in_quote_currency*1.22 * leverage_val) / price
+    logger.debug(f"Raw calculated size: {raw_size} (Margin: {investment_amount_in_quote_currency}, Price: {price}, Account Leverage: {leverage_val})")
+
+    min_deal_size_str = dealing_rules.get("minDealSize", {}).get("value")
+    deal_size_step_str = dealing_rules.get("dealSize", {}).get("step") 
+
+    if min_deal_size_str is None or deal_size_step_str is None:
+
+        deal_size_step_str = dealing_rules.get("minSizeIncrement", {}).get("value")
+        if deal_size_step_str is None:
+            raise ValueError(f"Missing dealing rules (minDealSize.value or dealSize.step/minSizeIncrement.value) for {epic}.")
+
+    try:
+        min_size_allowed = float(min_deal_size_str)
+        size_step = float(deal_size_step_str)
+    except (TypeError, ValueError):
+        raise ValueError("Could not convert minDealSize or dealSize.step/minSizeIncrement to float.")
+
+    if size_step <= 0:
+        raise ValueError("Deal size step must be greater than zero.")
+
+    if raw_size < min_size_allowed : 
+        stepped_size = 0.0
+    else:
+        num_steps = math.floor(raw_size / size_step)
+        stepped_size = num_steps * size_step
+
+    logger.debug(f"Size after rounding to step {size_step}: {stepped_size}")
+
+    if stepped_size < min_size_allowed:
+        logger.warning(f"Calculated size {stepped_size} for {epic} is less than minimum allowed {min_size_allowed}. "
+                       f"Investment amount {investment_amount_in_quote_currency} may be too small.")
+        return 0.0
+
+    logger.info(f"Calculated trade size for {epic} ({direction.value}) with margin {investment_amount_in_quote_currency} (account leverage): {stepped_size}")
+    return stepped_size
+
+def _trade_size_for_margin(epic: str, margin_amount_in_quote_currency: float, direction: TradeDirection,
+                           market_data: Optional[Dict[str, Any]]) -> float:
+    """Sizing math behind calculate_trade_size_for_margin, given already fetched market details."""
+    if not market_data:
+        raise CapitalComAPIError(f"Could not fetch market details for epic {epic} to calculate size.")
+
+    snapshot = market_data.get("snapshot")
+    instrument_details = market_data.get("instrument")
+    dealing_rules = market_data.get("dealingRules")
+
+    if not snapshot or not instrument_details or not dealing_rules:
+        raise CapitalComAPIError(f"Market details for {epic} are incomplete. Cannot calculate size.")
+
+    current_price = snapshot.get("offer") if direction == TradeDirection.BUY else snapshot.get("bid")
+    if current_price is None or current_price <= 0:
+        raise ValueError(f"Invalid or zero price ({current_price}) for {epic} ({direction.value}). Cannot calculate size.")
+
+    margin_factor_percentage = instrument_details.get("marginFactor") 
+    margin_factor_unit = instrument_details.get("marginFactorUnit", "PERCENTAGE").upper()
+
+    if margin_factor_percentage is None or not isinstance(margin_factor_percentage, (int, float)) or margin_factor_percentage <= 0:
+        raise ValueError(f"Invalid or missing marginFactor ({margin_factor_percentage}) for {epic}. Must be a positive number.")
+
+    if margin_factor_unit == "PERCENTAGE":
+        margin_factor_decimal = margin_factor_percentage / 100.0
+    elif margin_factor_unit == "ABSOLUTE": 
+         margin_factor_decimal = margin_factor_percentage
+    else: 
+        logger.warning(f"Unknown marginFactorUnit '{margin_factor_unit}' for epic {epic}. Assuming marginFactor is percentage.")
+        margin_factor_decimal = margin_factor_percentage / 100.0
+
+    if margin_factor_decimal <= 0: 
+        raise ValueError(f"Resulting margin factor decimal ({margin_factor_decimal}) is invalid.")
+
+    notional_value_in_quote_currency = margin_amount_in_quote_currency / margin_factor_decimal
+    logger.debug(f"Calculated notional value: {notional_value_in_quote_currency} (Margin: {margin_amount_in_quote_currency}, MarginFactor (decimal): {margin_factor_decimal})")
+
+    raw_size = notional_value_in_quote_currency / current_price
+    logger.debug(f"Raw calculated size: {raw_size} (Notional: {notional_value_in_quote_currency}, Price: {current_price})")
+
+    min_deal_size_str = dealing_rules.get("minDealSize", {}).get("value")
+
+    deal_size_step_str = dealing_rules.get("minSizeIncrement", {}).get("value")
+    if deal_size_step_str is None: 
+         deal_size_step_str = dealing_rules.get("dealSize", {}).get("step")
+
+    if min_deal_size_str is None or deal_size_step_str is None:
+        raise ValueError(f"Missing dealing rules (minDealSize.value or minSizeIncrement.value/dealSize.step) for {epic}.")
+
+    try:
+        min_size_allowed = float(min_deal_size_str)
+        size_step = float(deal_size_step_str)
+    except ValueError:
+        raise ValueError("Could not convert minDealSize or size step to float.")
+
+    if size_step <= 0:
+        raise ValueError("Deal size step must be greater than zero.")
+
+    if raw_size < min_size_allowed:
+        stepped_size = 0.0
+    else:
+        num_steps = math.floor(raw_size / size_step)
+        stepped_size = num_steps * size_step
+
+    logger.debug(f"Size after rounding to step {size_step}: {stepped_size}")
+
+    if stepped_size < min_size_allowed:
+        logger.warning(f"Calculated size {stepped_size} for {epic} is less than minimum allowed {min_size_allowed}. "
+                       f"Margin amount {margin_amount_in_quote_currency} may be too small.")
+        return 0.0
+
+    logger.info(f"Calculated trade size for {epic} ({direction.value}) with margin {margin_amount_in_quote_currency} (using instrument marginFactor): {stepped_size}")
+    return stepped_size
+
+def _balance_from_account_details(details: Dict[str, Any]) -> Optional[float]:
+    balance_info = details.get("balance", {})
+    balance_value = balance_info.get("balance") 
+    if balance_value is None:
+        balance_value = balance_info.get("available") 
+        if balance_value is not None:
+            logger.debug("Using 'available' balance as 'balance.balance' field was not found.")
+
+    if balance_value is not None:
+        try:
+            return float(balance_value)
+        except ValueError:
+            logger.error(f"Could not convert balance value '{balance_value}' to float.")
+            return None
+
+    logger.error("Could not retrieve a valid balance value ('balance' or 'available') from account details.")
+    return None
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Callers reserve tokens up front and are told how long to wait,
+    so concurrent callers queue in arrival order instead of racing each other for refills.
+    """
+    def __init__(self, name: str, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("Token bucket rate and capacity must be positive.")
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.total_requests = 0
+        self.delayed_requests = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.throttled_responses = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._last_refill = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Takes tokens from the bucket and returns how many seconds the caller must wait before using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.total_requests += 1
+            if wait > 0:
+                self.delayed_requests += 1
+                self.total_wait_seconds += wait
+                if wait > self.max_wait_seconds:
+                    self.max_wait_seconds = wait
+            return wait
+
+    def penalize(self, seconds: float):
+        """Drains the bucket so that no new request is released for the given number of seconds."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, -seconds * self.rate)
+            self.throttled_responses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill(time.monotonic())
+            tokens = self._tokens
+            return {
+                "rate_per_second": self.rate,
+                "capacity": self.capacity,
+                "available_tokens": max(tokens, 0.0),
+                "current_wait_seconds": -tokens / self.rate if tokens < 0 else 0.0,
+                "total_requests": self.total_requests,
+                "delayed_requests": self.delayed_requests,
+                "total_wait_seconds": self.total_wait_seconds,
+                "avg_wait_seconds": self.total_wait_seconds / self.delayed_requests if self.delayed_requests else 0.0,
+                "max_wait_seconds": self.max_wait_seconds,
+                "throttled_responses": self.throttled_responses,
+            }
+
+class RateLimiter:
+    """
+    Client-side request budgets modelled on Capital.com's published limits: POST /session once per second,
+    trading requests (POST/PUT/DELETE on positions and workingorders) once per 0.1s, and 10 requests per second
+    overall. Session and trading requests also count against the general budget.
+    Budgets are given as {category: (requests_per_second, burst_capacity)}.
+    """
+    SESSION = "session"
+    TRADING = "trading"
+    GENERAL = "general"
+
+    DEFAULT_BUDGETS: Dict[str, Tuple[float, float]] = {
+        SESSION: (1.0, 1),
+        TRADING: (10.0, 1),
+        GENERAL: (10.0, 10),
+    }
+
+    def __init__(self, budgets: Optional[Dict[str, Tuple[float, float]]] = None, max_throttle_retries: int = 3,
+                 throttle_backoff_seconds: float = 1.0):
+        merged = dict(self.DEFAULT_BUDGETS)
+        if budgets:
+            merged.update(budgets)
+        self.buckets: Dict[str, TokenBucket] = {name: TokenBucket(name, rate, capacity) for name, (rate, capacity) in merged.items()}
+        self.max_throttle_retries = max_throttle_retries
+        self.throttle_backoff_seconds = throttle_backoff_seconds
+
+    @classmethod
+    def category_for(cls, method: str, endpoint: str) -> str:
+        if endpoint == "session":
+            return cls.SESSION
+        if method.upper() != "GET" and endpoint.split("/", 1)[0] in ("positions", "workingorders"):
+            return cls.TRADING
+        return cls.GENERAL
+
+    def _buckets_for(self, method: str, endpoint: str) -> List[TokenBucket]:
+        category = self.category_for(method, endpoint)
+        buckets = [self.buckets[category]]
+        if category != self.GENERAL:
+            buckets.append(self.buckets[self.GENERAL])
+        return buckets
+
+    def reserve(self, method: str, endpoint: str) -> float:
+        """Reserves a request slot in every budget the endpoint belongs to and returns the required delay."""
+        return max(bucket.reserve() for bucket in self._buckets_for(method, endpoint))
+
+    def acquire(self, method: str, endpoint: str) -> float:
+        """Blocks the calling thread until the request may be sent. Returns the time waited."""
+        delay = self.reserve(method, endpoint)
+        if delay > 0:
+            logger.debug(f"Rate limiter delaying {method} {endpoint} by {delay:.3f}s.")
+            time.sleep(delay)
+        return delay
+
+    async def acquire_async(self, method: str, endpoint: str) -> float:
+        """Like acquire(), but yields to the event loop instead of blocking."""
+        delay = self.reserve(method, endpoint)
+        if delay > 0:
+            logger.debug(f"Rate limiter delaying {method} {endpoint} by {delay:.3f}s.")
+            await asyncio.sleep(delay)
+        return delay
+
+    def on_throttled(self, method: str, endpoint: str, retry_after: Optional[str], attempt: int) -> float:
+        """Records a 429 response and pauses the affected budgets. Returns the applied backoff in seconds."""
+        backoff = self.throttle_backoff_seconds * (2 ** (attempt - 1))
+        if retry_after:
+            try:
+                backoff = max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+        for bucket in self._buckets_for(method, endpoint):
+            bucket.penalize(backoff)
+        return backoff
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: bucket.stats() for name, bucket in self.buckets.items()}
+
+class _CachedValue:
+    """A single cached value with a fetch timestamp and a default max age."""
+    def __init__(self, max_age_seconds: float):
+        self.max_age_seconds = max_age_seconds
+        self._value: Optional[Any] = None
+        self._fetched_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def get(self, max_age_seconds: Optional[float] = None) -> Optional[Any]:
+        """Returns the value if it is younger than max_age_seconds (default: the configured max age), else None."""
+        limit = self.max_age_seconds if max_age_seconds is None else max_age_seconds
+        with self._lock:
+            if self._fetched_at is None or time.monotonic() - self._fetched_at > limit:
+                return None
+            return self._value
+
+    def set(self, value: Any):
+        with self._lock:
+            self._value = value
+            self._fetched_at = time.monotonic() if value is not None else None
+
+    def invalidate(self):
+        self.set(None)
+
+    @property
+    def age_seconds(self) -> Optional[float]:
+        with self._lock:
+            return None if self._fetched_at is None else time.monotonic() - self._fetched_at
+
+# One record per quote tick (40 bytes): server timestamp plus bid/offer and their quantities.
+TICK_DTYPE = [
+    ("timestamp", "<M8[ms]"),
+    ("bid", "<f8"), ("ofr", "<f8"),
+    ("bid_qty", "<f8"), ("ofr_qty", "<f8"),
+]
+
+class TickRingBuffer:
+    """
+    Fixed-capacity buffer of the most recent quote ticks for one epic, backed by a preallocated
+    NumPy structured array of TICK_DTYPE. Every tick is written twice (at i and i + capacity) so
+    the last N ticks always form one contiguous slice and last(n) can return a view without copying.
+    Written by a single thread (the WebSocket dispatcher); readers on other threads should use snapshot().
+    """
+    SNAPSHOT_OPTIMISTIC_ATTEMPTS = 4
+
+    def __init__(self, epic: str, capacity: int = 10000):
+        _require_numpy("TickRingBuffer")
+        if capacity <= 0:
+            raise ValueError("capacity must be positive.")
+        self.epic = epic
+        self.capacity = capacity
+        self._buffer = np.zeros(2 * capacity, dtype=TICK_DTYPE)
+        self._next = 0
+        self.total_ticks = 0
+        # Seqlock counter: odd while a tick is being written, bumped again once it is complete.
+        self._sequence = 0
+        # Held by the writer per tick (uncontended, so cheap) and by snapshot() only as a fallback.
+        self._write_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self.total_ticks, self.capacity)
+
+    def append_quote(self, payload: Dict[str, Any]):
+        """Stores one 'quote' payload (epic, bid, bidQty, ofr, ofrQty, timestamp)."""
+        nan = float("nan")
+        record = (payload.get("timestamp") or 0, payload.get("bid", nan), payload.get("ofr", nan),
+                  payload.get("bidQty", nan), payload.get("ofrQty", nan))
+        with self._write_lock:
+            self._sequence += 1
+            i = self._next
+            self._buffer[i] = record
+            self._buffer[i + self.capacity] = record
+            self._next = i + 1 if i + 1 < self.capacity else 0
+            self.total_ticks += 1
+            self._sequence += 1
+
+    def last(self, n: Optional[int] = None) -> "np.ndarray":
+        """Zero-copy view of the last n ticks (default: all held), oldest first. Later ticks may overwrite it."""
+        size = len(self)
+        n = size if n is None else max(0, min(n, size))
+        end = self._next + self.capacity
+        return self._buffer[end - n:end]
+
+    def snapshot(self, n: Optional[int] = None) -> "np.ndarray":
+        """
+        Consistent copy of the last n ticks, safe to call while the buffer is being written. Copies
+        without locking first; if the writer keeps overlapping the copy (always possible when n is the
+        full capacity on a busy feed), the final attempt holds the writer's lock briefly.
+        """
+        for _ in range(self.SNAPSHOT_OPTIMISTIC_ATTEMPTS):
+            before = self._sequence
+            if before & 1:
+                continue
+            data = self.last(n).copy()
+            # Ticks whose write began after `before`; the k-th lands in the copied range only once k > capacity - n.
+            if (self._sequence - before + 1) // 2 <= self.capacity - len(data):
+                return data
+        with self._write_lock:
+            return self.last(n).copy()
+
+
+class OhlcBarAggregator:
+    """
+    Builds OHLC bars of arbitrary durations (e.g. 15s, 7m) from MARKET 'quote' payloads, for any number
+    of epics at once, so one quote subscription can feed every timeframe. Bars are aligned to multiples
+    of the interval since the epoch (server timestamps) and emitted to on_bar once the first tick of the
+    next bar arrives, or by flush(). Emitted bars use the ohlc.event payload layout:
+    {"epic", "resolution", "type", "priceType", "t", "o", "h", "l", "c"} plus "interval_seconds" and "ticks".
+    With bar_type=OhlcBarType.HEIKIN_ASHI the o/h/l/c values are Heikin-Ashi transformed.
+    """
+    PRICE_FIELDS = {"bid": "bid", "ask": "ofr"}
+
+    def __init__(self, intervals_seconds: List[float], on_bar: Callable[[Dict[str, Any]], None],
+                 bar_type: OhlcBarType = OhlcBarType.CLASSIC, price_types: Tuple[str, ...] = ("bid", "ask")):
+        if not intervals_seconds or any(interval <= 0 for interval in intervals_seconds):
+            raise ValueError("intervals_seconds must contain positive durations.")
+        unknown = [p for p in price_types if p not in self.PRICE_FIELDS]
+        if unknown:
+            raise ValueError(f"Unsupported price types {unknown}; use 'bid' and/or 'ask'.")
+        self.intervals_ms = sorted({int(round(interval * 1000)) for interval in intervals_seconds})
+        self.on_bar = on_bar
+        self.bar_type = bar_type
+        self.price_types = tuple(price_types)
+        # (epic, interval_ms, price_type) -> [start_ms, o, h, l, c, ticks]
+        self._bars: Dict[Tuple[str, int, str], List[Any]] = {}
+        # (epic, interval_ms, price_type) -> (previous HA open, previous HA close)
+        self._heikin_ashi_state: Dict[Tuple[str, int, str], Tuple[float, float]] = {}
+        # (epic, interval_ms, price_type) -> start_ms of the last emitted bar, so late ticks can't reopen it
+        self._last_emitted: Dict[Tuple[str, int, str], int] = {}
+        self._lock = threading.Lock()
+        self.bars_emitted = 0
+        self.late_ticks = 0
+
+    @staticmethod
+    def resolution_label(interval_ms: int) -> str:
+        """Names an interval like the API does: MINUTE, MINUTE_7, HOUR_2, or SECOND_15 below a minute."""
+        seconds = interval_ms / 1000
+        for unit_seconds, unit in ((3600, "HOUR"), (60, "MINUTE"), (1, "SECOND")):
+            if seconds >= unit_seconds and seconds % unit_seconds == 0:
+                count = int(seconds // unit_seconds)
+                return unit if count == 1 else f"{unit}_{count}"
+        return f"MILLISECOND_{interval_ms}"
+
+    def on_quote(self, payload: Dict[str, Any]):
+        """Listener for MARKET quote payloads; pass it to subscribe_many / subscribe_to_epic_data."""
+        epic = payload.get("epic")
+        timestamp = payload.get("timestamp")
+        if not epic or timestamp is None:
+            return
+        completed: List[Dict[str, Any]] = []
+        with self._lock:
+            for price_type in self.price_types:
+                price = payload.get(self.PRICE_FIELDS[price_type])
+                if price is None:
+                    continue
+                for interval_ms in self.intervals_ms:
+                    key = (epic, interval_ms, price_type)
+                    start = timestamp - timestamp % interval_ms
+                    bar = self._bars.get(key)
+                    if bar is not None and bar[0] == start:
+                        if price > bar[2]: bar[2] = price
+                        if price < bar[3]: bar[3] = price
+                        bar[4] = price
+                        bar[5] += 1
+                        continue
+                    if (bar is not None and start < bar[0]) or start <= self._last_emitted.get(key, -1):
+                        self.late_ticks += 1
+                        continue
+                    if bar is not None:
+                        completed.append(self._finish_bar(key, bar))
+                    self._bars[key] = [start, price, price, price, price, 1]
+        for finished in completed:
+            self._emit(finished)
+
+    def flush(self, now_ms: Optional[int] = None, force: bool = False) -> int:
+        """
+        Emits bars whose interval has ended by now_ms (default: local clock), e.g. for quiet markets.
+        With force=True all open bars are emitted. Returns the number of bars emitted.
+        """
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        completed: List[Dict[str, Any]] = []
+        with self._lock:
+            for key, bar in list(self._bars.items()):
+                if force or bar[0] + key[1] <= now_ms:
+                    completed.append(self._finish_bar(key, bar))
+                    del self._bars[key]
+        for finished in completed:
+            self._emit(finished)
+        return len(completed)
+
+    def _finish_bar(self, key: Tuple[str, int, str], bar: List[Any]) -> Dict[str, Any]:
+        epic, interval_ms, price_type = key
+        start, o, h, l, c, ticks = bar
+        self._last_emitted[key] = start
+        if self.bar_type == OhlcBarType.HEIKIN_ASHI:
+            ha_close = (o + h + l + c) / 4
+            previous = self._heikin_ashi_state.get(key)
+            ha_open = (previous[0] + previous[1]) / 2 if previous else (o + c) / 2
+            self._heikin_ashi_state[key] = (ha_open, ha_close)
+            o, h, l, c = ha_open, max(h, ha_open, ha_close), min(l, ha_open, ha_close), ha_close
+        return {
+            "epic": epic,
+            "resolution": self.resolution_label(interval_ms),
+            "interval_seconds": interval_ms / 1000,
+            "type": self.bar_type.value,
+            "priceType": price_type,
+            "t": start,
+            "o": o, "h": h, "l": l, "c": c,
+            "ticks": ticks,
+        }
+
+    def _emit(self, bar: Dict[str, Any]):
+        self.bars_emitted += 1
+        try:
+            self.on_bar(bar)
+        except Exception as e:
+            logger.error(f"Error in bar aggregator callback for {bar['epic']} {bar['resolution']}: {e}", exc_info=True)
+
+
+class MarketDetailsCache:
+    """
+    LRU cache of market details keyed by epic. The static parts ('instrument', 'dealingRules') and the
+    volatile 'snapshot' are timestamped separately so each can have its own TTL. Entries are copied on
+    the way in and out, so callers may modify what they get back.
+    """
+    STATIC_KEYS = ("instrument", "dealingRules")
+
+    def __init__(self, static_ttl_seconds: float = 3600.0, snapshot_ttl_seconds: float = 1.0, max_entries: int = 512):
+        if max_entries <= 0:
+            raise ValueError("max_entries must be positive.")
+        self.static_ttl_seconds = static_ttl_seconds
+        self.snapshot_ttl_seconds = snapshot_ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _is_fresh(self, entry: Dict[str, Any], require_snapshot: bool, now: float) -> bool:
+        if now - entry["static_at"] > self.static_ttl_seconds:
+            return False
+        if require_snapshot and (entry["snapshot"] is None or now - entry["snapshot_at"] > self.snapshot_ttl_seconds):
+            return False
+        return True
+
+    def get(self, epic: str, require_snapshot: bool = True) -> Optional[Dict[str, Any]]:
+        """Returns the cached details for epic if fresh enough, else None. Never does any I/O."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(epic)
+            if entry is None or not self._is_fresh(entry, require_snapshot, now):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(epic)
+            self.hits += 1
+            details = copy.deepcopy(entry["static"])
+            if entry["snapshot"] is not None and now - entry["snapshot_at"] <= self.snapshot_ttl_seconds:
+                details["snapshot"] = copy.deepcopy(entry["snapshot"])
+            return details
+
+    def stale_epics(self, epics: List[str], require_snapshot: bool = True) -> List[str]:
+        """Returns the subset of epics that are missing or expired, preserving order."""
+        now = time.monotonic()
+        with self._lock:
+            return [e for e in epics if e not in self._entries or not self._is_fresh(self._entries[e], require_snapshot, now)]
+
+    def put(self, details: Dict[str, Any], epic: Optional[str] = None):
+        epic = epic or (details.get("instrument") or {}).get("epic")
+        if not epic:
+            logger.debug("Market details without instrument.epic not cached.")
+            return
+        now = time.monotonic()
+        static = copy.deepcopy({k: v for k, v in details.items() if k != "snapshot"})
+        snapshot = copy.deepcopy(details.get("snapshot"))
+        with self._lock:
+            self._entries[epic] = {
+                "static": static,
+                "static_at": now,
+                "snapshot": snapshot,
+                "snapshot_at": now,
+            }
+            self._entries.move_to_end(epic)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, epic: Optional[str] = None, snapshot_only: bool = False):
+        with self._lock:
+            targets = [epic] if epic else list(self._entries.keys())
+            for key in targets:
+                if snapshot_only:
+                    entry = self._entries.get(key)
+                    if entry:
+                        entry["snapshot"] = None
+                else:
+                    self._entries.pop(key, None)
+
+    def epics(self) -> List[str]:
+        with self._lock:
+            return list(self._entries.keys())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"size": len(self._entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
+
+class ReconnectPolicy:
+    """
+    Decides how long the WebSocket run loop waits before reconnecting. The first retry after a stable
+    connection drops is immediate; later ones use decorrelated jitter (a random delay between
+    base_delay and three times the previous delay, capped at max_delay). Retries never stop, but after
+    failure_threshold consecutive failed attempts the circuit opens and attempts are spaced
+    circuit_open_seconds apart until one succeeds. A connection only counts as recovered once it has
+    stayed up for stable_after_seconds, so a flapping connection does not earn instant retries.
+    Also records the downtime of every disconnect.
+    """
+    def __init__(self, base_delay: float = 0.5, max_delay: float = 30.0, immediate_first_retry: bool = True,
+                 failure_threshold: int = 20, circuit_open_seconds: float = 300.0, stable_after_seconds: float = 30.0,
+                 history_size: int = 100):
+        if base_delay <= 0 or max_delay < base_delay:
+            raise ValueError("Need 0 < base_delay <= max_delay.")
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.immediate_first_retry = immediate_first_retry
+        self.failure_threshold = failure_threshold
+        self.circuit_open_seconds = circuit_open_seconds
+        self.stable_after_seconds = stable_after_seconds
+        self._lock = threading.Lock()
+        self.attempts = 0
+        self._previous_delay = base_delay
+        self._connected_at: Optional[float] = None
+        self._down_since: Optional[float] = None
+        self._downtimes: deque = deque(maxlen=history_size)
+        self.disconnects = 0
+        self.total_downtime_seconds = 0.0
+        self.max_downtime_seconds = 0.0
+        self.circuit_opened_count = 0
+
+    @property
+    def circuit_open(self) -> bool:
+        """True while disconnected with the breaker tripped; a connection in progress does not count."""
+        with self._lock:
+            return self._circuit_open()
+
+    def _circuit_open(self) -> bool:
+        return self.attempts >= self.failure_threshold and self._connected_at is None
+
+    def reset(self):
+        """Forgets previous failures, e.g. when the WebSocket thread is started afresh."""
+        with self._lock:
+            self.attempts = 0
+            self._previous_delay = self.base_delay
+
+    def on_connected(self):
+        """Called when a connection opens; closes the current downtime window."""
+        now = time.monotonic()
+        with self._lock:
+            self._connected_at = now
+            if self._down_since is not None:
+                downtime = now - self._down_since
+                self._down_since = None
+                self._downtimes.append(downtime)
+                self.total_downtime_seconds += downtime
+                self.max_downtime_seconds = max(self.max_downtime_seconds, downtime)
+
+    def next_delay(self) -> float:
+        """Called after a connection closed or an attempt failed; returns the seconds to wait before the next attempt."""
+        now = time.monotonic()
+        with self._lock:
+            if self._down_since is None:
+                self._down_since = now
+                self.disconnects += 1
+            connected_at, self._connected_at = self._connected_at, None
+            if connected_at is not None and now - connected_at >= self.stable_after_seconds:
+                self.attempts = 0
+                self._previous_delay = self.base_delay
+            self.attempts += 1
+            if self.attempts == 1 and self.immediate_first_retry:
+                return 0.0
+            if self.attempts > self.failure_threshold:
+                return self.circuit_open_seconds
+            if self.attempts == self.failure_threshold:
+                self.circuit_opened_count += 1
+                logger.error(f"WebSocket reconnect circuit opened after {self.attempts} failed attempts; "
+                             f"retrying every {self.circuit_open_seconds}s until a connection succeeds.")
+                return self.circuit_open_seconds
+            delay = min(self.max_delay, random.uniform(self.base_delay, self._previous_delay * 3))
+            self._previous_delay = delay
+            return delay
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            current = time.monotonic() - self._down_since if self._down_since is not None else 0.0
+            return {
+                "attempts": self.attempts,
+                "circuit_open": self._circuit_open(),
+                "circuit_opened_count": self.circuit_opened_count,
+                "disconnects": self.disconnects,
+                "current_downtime_seconds": current,
+                "last_downtime_seconds": self._downtimes[-1] if self._downtimes else None,
+                "max_downtime_seconds": self.max_downtime_seconds,
+                "total_downtime_seconds": self.total_downtime_seconds,
+                "recent_downtimes_seconds": list(self._downtimes),
+            }
+
+class SubscriptionHandle:
+    """Identifies one listener attached to a WebSocket stream; pass it to CapitalComAPI.unsubscribe()."""
+    __slots__ = ("handle_id", "stream_key", "epic", "data_type", "resolution", "bar_type")
+
+    def __init__(self, handle_id: int, stream_key: str, epic: str, data_type: WebsocketDataType,
+                 resolution: Optional[HistoricalPriceResolution], bar_type: OhlcBarType):
+        self.handle_id = handle_id
+        self.stream_key = stream_key
+        self.epic = epic
+        self.data_type = data_type
+        self.resolution = resolution
+        self.bar_type = bar_type
+
+    def __repr__(self) -> str:
+        return f"SubscriptionHandle({self.handle_id}, {self.stream_key})"
+
+def _fan_out_callback(stream_key: str, callbacks: Tuple[Callable[[Dict[str, Any]], None], ...]) -> Callable[[Dict[str, Any]], None]:
+    """Single entry point for a stream's listeners; one failing listener does not starve the others."""
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def fan_out(payload: Dict[str, Any]):
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Error in WebSocket callback for {stream_key}: {e}", exc_info=True)
+    return fan_out
+
+
+def _refresh_listener_callbacks(stream_key: str, sub_info: Dict[str, Any]):
+    """Rebuilds a stream's fan-out callbacks, one for plain listeners and one for conflated ones (None if empty)."""
+    conflated = sub_info["conflated_handles"]
+    plain = tuple(cb for handle_id, cb in sub_info["listeners"].items() if handle_id not in conflated)
+    latest = tuple(cb for handle_id, cb in sub_info["listeners"].items() if handle_id in conflated)
+    sub_info["callback"] = _fan_out_callback(stream_key, plain) if plain else None
+    sub_info["conflated_callback"] = _fan_out_callback(stream_key, latest) if latest else None
+
+
+class WebsocketCallbackDispatcher:
+    """
+    Runs WebSocket subscriber callbacks on a pool of worker threads. Every stream (route key) is pinned
+    to one worker, so callbacks for a stream run in arrival order while a slow stream only delays
+    the streams sharing its worker, never the reader thread.
+    Conflated streams (submit_latest) keep at most one pending payload: a newer one replaces it.
+    """
+    def __init__(self, num_workers: int = 4, max_queue_size: int = 0):
+        if num_workers <= 0:
+            raise ValueError("num_workers must be positive.")
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self._queues: List["queue.Queue"] = []
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._processed = [0] * num_workers
+        self._errors = [0] * num_workers
+        self._latest: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        self._latest_lock = threading.Lock()
+        self._conflated: Dict[Tuple[Any, ...], int] = {}
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._queues = [queue.Queue(self.max_queue_size) for _ in range(self.num_workers)]
+            for index in range(self.num_workers):
+                thread = threading.Thread(target=self._worker_run, args=(index,), name=f"CapitalComWSDispatch-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info(f"WebSocket callback dispatcher started with {self.num_workers} workers.")
+
+    def stop(self, timeout: float = 5.0):
+        """Lets workers finish the payloads already queued, then stops them."""
+        with self._lock:
+            threads, queues = self._threads, self._queues
+            self._threads, self._queues = [], []
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join(timeout=timeout)
+            if thread.is_alive():
+                logger.warning(f"WebSocket dispatch worker {thread.name} did not stop in time.")
+        with self._latest_lock:
+            self._latest.clear()
+
+    def submit(self, route_key: Tuple[Any, ...], callback: Callable[[Dict[str, Any]], None], payload: Dict[str, Any]):
+        queues = self._queues
+        if not queues:
+            self.start()
+            queues = self._queues
+        queues[hash(route_key) % len(queues)].put((route_key, callback, payload))
+
+    def submit_latest(self, route_key: Tuple[Any, ...], callback: Callable[[Dict[str, Any]], None], payload: Dict[str, Any]):
+        """Queues payload unless one for the same stream is still pending, in which case it replaces it."""
+        with self._latest_lock:
+            if route_key in self._latest:
+                self._latest[route_key] = payload
+                self._conflated[route_key] = self._conflated.get(route_key, 0) + 1
+                return
+            self._latest[route_key] = payload
+        # payload=None marks a conflated entry; the worker picks up whatever is newest when it gets there.
+        self.submit(route_key, callback, None)
+
+    def _worker_run(self, index: int):
+        work_queue = self._queues[index]
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            route_key, callback, payload = item
+            if payload is None:
+                with self._latest_lock:
+                    payload = self._latest.pop(route_key, None)
+                if payload is None:
+                    continue
+            try:
+                callback(payload)
+            except Exception as e:
+                self._errors[index] += 1
+                logger.error(f"Error in WebSocket callback for {route_key}: {e}", exc_info=True)
+            self._processed[index] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        queues = self._queues
+        return {
+            "workers": self.num_workers,
+            "running": self.running,
+            "queue_depths": [q.qsize() for q in queues],
+            "processed": sum(self._processed),
+            "callback_errors": sum(self._errors),
+            "conflated": sum(self._conflated.values()),
+            "conflated_by_stream": dict(self._conflated),
+        }
+
+class _AuthTokenMixin:
+    """Token bookkeeping shared by the blocking and the asyncio clients."""
+    cst: Optional[str]
+    x_security_token: Optional[str]
+
+    def _update_auth_tokens(self, response_headers: Any):
+        """Helper to update auth tokens if present in response headers."""
+        new_cst = response_headers.get("CST")
+        new_xst = response_headers.get("X-SECURITY-TOKEN")
+        updated = False
+        if new_cst and new_cst != self.cst:
+            self.cst = new_cst
+            logger.info("CST token updated.")
+            updated = True
+        if new_xst and new_xst != self.x_security_token:
+            self.x_security_token = new_xst
+            logger.info("X-SECURITY-TOKEN updated.")
+            updated = True
+        if updated:
+            logger.debug(f"Current CST: {'******' if self.cst else None}, Current XST: {'******' if self.x_security_token else None}")
+
+class CapitalComAPI(_AuthTokenMixin):
     BASE_URLS = {
         Environment.DEMO: "https://demo-api-capital.backend-capital.com/api/v1",
         Environment.LIVE: "https://api-capital.backend-capital.com/api/v1",
@@ -71,8 +1223,20 @@ class CapitalComAPI:
     }
 
     APP_PING_INTERVAL_SECONDS = 9 * 60 
-
-    def __init__(self, api_key: str, identifier: str, password: str, environment: Environment = Environment.DEMO):
+    MAX_EPICS_PER_MARKETS_REQUEST = 50
+    ACCOUNT_PREFERENCES_MAX_AGE_SECONDS = 300.0
+    ACCOUNTS_CACHE_TTL_SECONDS = 1.0
+    MAX_HISTORICAL_POINTS_PER_REQUEST = 1000
+    WS_MAX_EPICS_PER_SUBSCRIPTION = 40
+    # Default stream budget per connection for ShardedWebsocketManager; several control messages' worth.
+    WS_MAX_STREAMS_PER_CONNECTION = 100
+    # Login responses that retrying cannot fix; the WebSocket loop stops instead of reconnecting.
+    AUTH_FAILURE_STATUS_CODES = (401, 403)
+
+    def __init__(self, api_key: str, identifier: str, password: str, environment: Environment = Environment.DEMO,
+                 rate_limiter: Optional[RateLimiter] = None, rate_limit: bool = True,
+                 ws_dispatch_mode: WebsocketDispatchMode = WebsocketDispatchMode.INLINE, ws_dispatch_workers: int = 4,
+                 offline: bool = False, ws_reconnect_policy: Optional[ReconnectPolicy] = None):
         self.api_key = api_key
         self.identifier = identifier
         self.password = password
@@ -80,22 +1244,39 @@ class CapitalComAPI:
         self.base_url = self.BASE_URLS[environment]
         self.ws_base_url = self.WS_URLS[environment]
 
-        self.session = requests.Session()
-        self.session.headers.update({"X-CAP-API-KEY": self.api_key, "Content-Type": "application/json"})
+        self.session = self._new_http_session()
 
         self.cst: Optional[str] = None
         self.x_security_token: Optional[str] = None
         self.active_account_id: Optional[str] = None
+        self._login_lock = threading.Lock()
+        self._last_login_status_code: Optional[int] = None
+
+        self.rate_limiter: Optional[RateLimiter] = rate_limiter or (RateLimiter() if rate_limit else None)
+        self.market_details_cache: Optional[MarketDetailsCache] = None
+        self._account_preferences_cache = _CachedValue(self.ACCOUNT_PREFERENCES_MAX_AGE_SECONDS)
+        self._accounts_cache = _CachedValue(self.ACCOUNTS_CACHE_TTL_SECONDS)
 
         self.ws_thread: Optional[threading.Thread] = None
         self.ws_connection: Optional[websocket.WebSocketApp] = None
         self._ws_subscriptions: Dict[str, Dict[str, Any]] = {} 
+        # Copy-on-write view of _ws_subscriptions keyed like incoming messages; replaced, never mutated.
+        self._ws_routes: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        self._ws_handle_ids = itertools.count(1)
+        self.ws_dispatch_mode = ws_dispatch_mode
+        self._ws_dispatch_workers = ws_dispatch_workers
+        self._ws_dispatcher: Optional[WebsocketCallbackDispatcher] = None
+        self._ws_recorder: Optional["TickRecorder"] = None
+        # Offline clients only register subscriptions locally (e.g. for TickReplayer) and never open a WebSocket.
+        self.offline = offline
         self._ws_stop_event = threading.Event()
         self._ws_lock = threading.Lock() 
-        self._ws_reconnect_attempts = 0
-        self._ws_max_reconnect_attempts = 10
-        self._ws_initial_reconnect_delay = 5
-        self._ws_max_reconnect_delay = 60
+        self.ws_reconnect_policy = ws_reconnect_policy or ReconnectPolicy()
+        self._ws_connected_at: Optional[float] = None
+        self.stream_watchdog: Optional["StreamWatchdog"] = None
+        self.deal_tracker: Optional["DealConfirmationTracker"] = None
+        self._deal_tracker_lock = threading.Lock()
+        self.position_book: Optional["PositionBook"] = None
         self._ws_status = WebSocketStatus.DISCONNECTED
 
         self._ws_ping_thread: Optional[threading.Thread] = None
@@ -108,21 +1289,44 @@ class CapitalComAPI:
         """Current status of the WebSocket connection."""
         return self._ws_status
 
-    def _update_auth_tokens(self, response_headers: requests.structures.CaseInsensitiveDict):
-        """Helper to update auth tokens if present in response headers."""
-        new_cst = response_headers.get("CST")
-        new_xst = response_headers.get("X-SECURITY-TOKEN")
-        updated = False
-        if new_cst and new_cst != self.cst:
-            self.cst = new_cst
-            logger.info("CST token updated.")
-            updated = True
-        if new_xst and new_xst != self.x_security_token:
-            self.x_security_token = new_xst
-            logger.info("X-SECURITY-TOKEN updated.")
-            updated = True
-        if updated:
-            logger.debug(f"Current CST: {'******' if self.cst else None}, Current XST: {'******' if self.x_security_token else None}")
+    def get_ws_dispatch_stats(self) -> Dict[str, Any]:
+        """Queue depths and counters (including conflated quotes) of the callback dispatcher, if one is in use."""
+        return self._ws_dispatcher.stats() if self._ws_dispatcher else {}
+
+    def get_ws_reconnect_stats(self) -> Dict[str, Any]:
+        """Reconnect attempts, circuit breaker state and per-disconnect downtime of the WebSocket connection."""
+        return self.ws_reconnect_policy.stats()
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Current budget and wait-time statistics of the client-side rate limiter, per budget."""
+        return self.rate_limiter.stats() if self.rate_limiter else {}
+
+    def _new_http_session(self) -> requests.Session:
+        session = requests.Session()
+        session.headers.update({"X-CAP-API-KEY": self.api_key, "Content-Type": "application/json"})
+        return session
+
+    def _send(self, method: str, endpoint: str, url: str, params: Optional[Dict[str, Any]],
+              data: Optional[Dict[str, Any]], headers: Any) -> requests.Response:
+        """Sends one request through the rate limiter, waiting and retrying on 429 instead of failing."""
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(method, endpoint)
+            response = self.session.request(method, url, params=params, json=data, headers=headers)
+            if response.status_code != 429 or not self.rate_limiter or attempt >= self.rate_limiter.max_throttle_retries:
+                return response
+            attempt += 1
+            backoff = self.rate_limiter.on_throttled(method, endpoint, response.headers.get("Retry-After"), attempt)
+            logger.warning(f"Received 429 Too Many Requests for {method} {endpoint}. Backing off {backoff:.2f}s (retry {attempt}/{self.rate_limiter.max_throttle_retries}).")
+
+    def _relogin(self, stale_cst: Optional[str]) -> bool:
+        """Logs in again unless another thread already refreshed the session since stale_cst was used."""
+        with self._login_lock:
+            if self.cst and self.x_security_token and self.cst != stale_cst:
+                logger.debug("Session was already refreshed by a concurrent request. Reusing new tokens.")
+                return True
+            return self.login()
 
     def _request(self, method: str, endpoint: str, params: Optional[Dict[str, Any]] = None,
                  data: Optional[Dict[str, Any]] = None, add_auth_headers: bool = True,
@@ -135,13 +1339,14 @@ class CapitalComAPI:
                 if is_login_retry:
                     raise CapitalComAPIError("Recursive login attempt failed. CST or X-SECURITY-TOKEN still missing.")
                 logger.warning(f"Auth tokens missing for request to {endpoint}. Attempting re-login.")
-                if not self.login():
+                if not self._relogin(None):
                      raise CapitalComAPIError(f"Re-login failed. Cannot proceed with the request to {endpoint}.")
             current_headers["CST"] = self.cst
             current_headers["X-SECURITY-TOKEN"] = self.x_security_token
 
         try:
-            response = self.session.request(method, url, params=params, json=data, headers=current_headers)
+            used_cst = current_headers.get("CST")
+            response = self._send(method, endpoint, url, params, data, current_headers)
             logger.debug(f"Request: {method} {url} | Params: {params} | Data: {data}")
             response_body_for_log = response.text[:500] + ('...' if len(response.text) > 500 else '')
             logger.debug(f"Response: {response.status_code} | Headers: {response.headers} | Body (truncated): {response_body_for_log}")
@@ -151,10 +1356,10 @@ class CapitalComAPI:
 
             if response.status_code == 401 and add_auth_headers and not is_login_retry:
                 logger.warning(f"Received 401 Unauthorized for {endpoint}. Session may have expired. Re-logging in and retrying request.")
-                if self.login(): 
+                if self._relogin(used_cst): 
                     current_headers["CST"] = self.cst
                     current_headers["X-SECURITY-TOKEN"] = self.x_security_token
-                    response = self.session.request(method, url, params=params, json=data, headers=current_headers)
+                    response = self._send(method, endpoint, url, params, data, current_headers)
                     logger.debug(f"Retry Request to {endpoint} after re-login: {method} {url}")
                     logger.debug(f"Retry Response Status: {response.status_code}")
                     self._update_auth_tokens(response.headers) 
@@ -185,8 +1390,8 @@ class CapitalComAPI:
                     error_data = e.response.text
             else:
                 error_data = "No response body"
-            logger.error(f"HTTP Error {e.response.status_code if e.response else 'N/A'} on {method} {url}. Response: {error_data}")
-            raise CapitalComAPIError(f"API request failed: {e}", e.response.status_code if e.response else None, error_data) from e
+            logger.error(f"HTTP Error {e.response.status_code if e.response is not None else 'N/A'} on {method} {url}. Response: {error_data}")
+            raise CapitalComAPIError(f"API request failed: {e}", e.response.status_code if e.response is not None else None, error_data) from e
         except requests.exceptions.RequestException as e:
             logger.error(f"Request Exception for {method} {url}: {e}")
             raise CapitalComAPIError(f"Network or request error: {e}") from e
@@ -196,7 +1401,10 @@ class CapitalComAPI:
         payload = {"identifier": self.identifier, "password": self.password, "encryptedPassword": False}
 
         login_headers = {"X-CAP-API-KEY": self.api_key, "Content-Type": "application/json"}
+        self._last_login_status_code = None
         try:
+            if self.rate_limiter:
+                self.rate_limiter.acquire("POST", "session")
             response = self.session.post(f"{self.base_url}/session", json=payload, headers=login_headers)
             logger.debug(f"Login Response Headers: {response.headers}")
             response_body_for_log = response.text[:500] + ('...' if len(response.text) > 500 else '')
@@ -222,7 +1430,8 @@ class CapitalComAPI:
             try:
                 if e.response is not None and e.response.content: error_body = e.response.json()
             except json.JSONDecodeError: pass 
-            logger.error(f"Login HTTP Error: {e.response.status_code if e.response else 'N/A'}. Response: {error_body}")
+            logger.error(f"Login HTTP Error: {e.response.status_code if e.response is not None else 'N/A'}. Response: {error_body}")
+            self._last_login_status_code = e.response.status_code if e.response is not None else None
             self.cst = None
             self.x_security_token = None
             return False
@@ -247,6 +1456,8 @@ class CapitalComAPI:
             self.cst = None
             self.x_security_token = None
             self.active_account_id = None
+            self._account_preferences_cache.invalidate()
+            self._accounts_cache.invalidate()
             return True
 
         logger.info("Logging out from server...")
@@ -263,6 +1474,8 @@ class CapitalComAPI:
             self.cst = None
             self.x_security_token = None
             self.active_account_id = None
+            self._account_preferences_cache.invalidate()
+            self._accounts_cache.invalidate()
             logger.info("Local session tokens and active account ID cleared.")
         return True
 
@@ -281,15 +1494,39 @@ class CapitalComAPI:
             logger.error(f"Server ping failed: {e}")
             return False
 
-    def get_accounts(self) -> List[Dict[str, Any]]:
+    def get_accounts(self, max_age_seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the account list. A snapshot younger than max_age_seconds (default ACCOUNTS_CACHE_TTL_SECONDS)
+        is reused instead of calling GET accounts again; pass 0 to force a fetch.
+        Every call returns its own copy, so callers may modify the result.
+        """
+        cached = self._accounts_cache.get(max_age_seconds)
+        if cached is not None:
+            logger.debug("Accounts served from cached snapshot.")
+            return copy.deepcopy(cached)
         logger.info("Fetching accounts...")
         response_data = self._request("GET", "accounts")
-        return response_data.get("accounts", []) if response_data else []
+        accounts_list = response_data.get("accounts", []) if response_data else []
+        self._accounts_cache.set(copy.deepcopy(accounts_list))
+        return accounts_list
 
-    def get_active_account_details(self) -> Optional[Dict[str, Any]]:
-        if not self.active_account_id:
-            logger.info("No active account ID set. Attempting to fetch accounts to find a default.")
+    def update_accounts_snapshot(self, accounts: List[Dict[str, Any]]):
+        """Stores a copy of an externally fetched account list as the current accounts snapshot."""
+        self._accounts_cache.set(copy.deepcopy(accounts))
+
+    def get_active_account_details(self, accounts: Optional[List[Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Details of the active account, taken from a single account list: the one passed in,
+        the cached snapshot, or one GET accounts request.
+        """
+        if accounts is not None:
+            self.update_accounts_snapshot(accounts)
+            accounts_list = accounts
+        else:
             accounts_list = self.get_accounts()
+
+        if not self.active_account_id:
+            logger.info("No active account ID set. Using the account list to find a default.")
             if accounts_list and accounts_list[0].get("accountId"):
                 self.active_account_id = accounts_list[0]["accountId"]
                 logger.info(f"Defaulting to first account found: {self.active_account_id}")
@@ -298,37 +1535,19 @@ class CapitalComAPI:
                 logger.error("No active account ID set and no accounts found to default to.")
                 return None
 
-        logger.info(f"Fetching details for active account: {self.active_account_id}")
-        all_accounts_data = self._request("GET", "accounts") 
-        if all_accounts_data and "accounts" in all_accounts_data:
-            for acc in all_accounts_data["accounts"]:
-                if acc.get("accountId") == self.active_account_id:
-                    return acc
+        for acc in accounts_list:
+            if acc.get("accountId") == self.active_account_id:
+                return acc
         logger.error(f"Could not find details for active account ID: {self.active_account_id} in the fetched list.")
         return None
 
-    def get_balance(self) -> Optional[float]:
-        details = self.get_active_account_details()
+    def get_balance(self, accounts: Optional[List[Dict[str, Any]]] = None) -> Optional[float]:
+        details = self.get_active_account_details(accounts)
         if not details:
             logger.error("Cannot get balance: active account details not available.")
             return None
 
-        balance_info = details.get("balance", {})
-        balance_value = balance_info.get("balance") 
-        if balance_value is None:
-            balance_value = balance_info.get("available") 
-            if balance_value is not None:
-                logger.debug("Using 'available' balance as 'balance.balance' field was not found.")
-
-        if balance_value is not None:
-            try:
-                return float(balance_value)
-            except ValueError:
-                logger.error(f"Could not convert balance value '{balance_value}' to float.")
-                return None
-
-        logger.error("Could not retrieve a valid balance value ('balance' or 'available') from account details.")
-        return None
+        return _balance_from_account_details(details)
 
     def switch_account(self, account_id: str) -> bool:
         logger.info(f"Attempting to switch active account to: {account_id}")
@@ -339,6 +1558,8 @@ class CapitalComAPI:
             session_details = self._request("GET", "session")
             if session_details and session_details.get("accountId") == account_id:
                 self.active_account_id = account_id 
+                self._account_preferences_cache.invalidate()
+                self._accounts_cache.invalidate()
                 logger.info(f"Successfully switched to account: {account_id} and confirmed via GET /session.")
 
                 if self._ws_subscriptions: 
@@ -369,12 +1590,7 @@ class CapitalComAPI:
                                 last_period_seconds: Optional[int] = None) -> List[Dict[str, Any]]:
 
         logger.info(f"Fetching transaction history (Type: {transaction_type or 'Any'}, Detailed: {detailed})...")
-        params: Dict[str, Any] = {}
-        if transaction_type: params['type'] = transaction_type
-        if from_date: params['from'] = from_date 
-        if to_date: params['to'] = to_date       
-        if last_period_seconds is not None: params['lastPeriod'] = last_period_seconds
-        if detailed: params['detailed'] = detailed 
+        params = _transaction_history_params(transaction_type, from_date, to_date, detailed, last_period_seconds)
 
         data = self._request("GET", "history/transactions", params=params)
         return data.get("transactions", []) if data else []
@@ -385,6 +1601,50 @@ class CapitalComAPI:
         return self.get_transaction_history(transaction_type="TRADE", from_date=from_date, to_date=to_date,
                                             detailed=True, last_period_seconds=last_period_seconds)
 
+    def iter_transaction_history(self, from_date: Union[str, datetime], to_date: Optional[Union[str, datetime]] = None,
+                                 transaction_type: Optional[str] = None, detailed: bool = False,
+                                 window: timedelta = timedelta(days=1), prefetch: bool = True) -> Iterator[Dict[str, Any]]:
+        """
+        Yields transactions from from_date to to_date (default: now), oldest window first, fetching one
+        window of history/transactions at a time so memory stays bounded by a single window. With
+        prefetch=True the next window is requested on a background thread while the current one is
+        consumed. Windows without transactions (including 404 responses) are skipped.
+        """
+        windows = _transaction_windows(from_date, to_date, window)
+
+        def fetch(bounds: Tuple[str, str]) -> List[Dict[str, Any]]:
+            try:
+                return self.get_transaction_history(transaction_type, bounds[0], bounds[1], detailed)
+            except CapitalComAPIError as e:
+                if e.status_code == 404:
+                    return []
+                raise
+
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="CapitalComHistoryPrefetch") if prefetch else None
+        try:
+            bounds = next(windows, None)
+            pending = pool.submit(fetch, bounds) if pool and bounds else None
+            previous_keys: set = set()
+            while bounds is not None:
+                next_bounds = next(windows, None)
+                if pending is not None:
+                    transactions = pending.result()
+                    pending = pool.submit(fetch, next_bounds) if next_bounds else None
+                else:
+                    transactions = fetch(bounds)
+                fresh, previous_keys = _new_window_transactions(transactions, previous_keys)
+                yield from fresh
+                bounds = next_bounds
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    def iter_closed_trades(self, from_date: Union[str, datetime], to_date: Optional[Union[str, datetime]] = None,
+                           window: timedelta = timedelta(days=1), prefetch: bool = True) -> Iterator[Dict[str, Any]]:
+        """Windowed, streaming counterpart of get_closed_trades (detailed TRADE transactions)."""
+        return self.iter_transaction_history(from_date, to_date, transaction_type="TRADE", detailed=True,
+                                             window=window, prefetch=prefetch)
+
     def open_trade(self, epic: str, direction: TradeDirection, size: float,
                      guaranteed_stop: bool = False, stop_level: Optional[float] = None,
                      stop_distance: Optional[float] = None, profit_level: Optional[float] = None,
@@ -392,23 +1652,83 @@ class CapitalComAPI:
                      trailing_stop_distance: Optional[float] = None,
                      force_open: bool = True) -> Optional[Dict[str, Any]]:
         logger.info(f"Opening {direction.value} trade for {epic}, size {size}")
-        payload: Dict[str, Any] = {
-            "epic": epic,
-            "direction": direction.value,
-            "size": str(size), 
-            "guaranteedStop": guaranteed_stop,
-            "trailingStop": trailing_stop,
+        payload = _open_trade_payload(epic, direction, size, guaranteed_stop, stop_level, stop_distance,
+                                      profit_level, profit_distance, trailing_stop, trailing_stop_distance, force_open)
 
-            "forceOpen": force_open,
-        }
-        if stop_level is not None: payload["stopLevel"] = str(stop_level)
-        if stop_distance is not None: payload["stopDistance"] = str(stop_distance)
-        if profit_level is not None: payload["profitLevel"] = str(profit_level) 
-        if profit_distance is not None: payload["profitDistance"] = str(profit_distance) 
-        if trailing_stop and trailing_stop_distance is not None:
-            payload["trailingStopDistance"] = str(trailing_stop_distance)
+        return self._track_in_position_book(self._request("POST", "positions", data=payload))
+
+    def enable_position_book(self, reconcile_interval: Optional[float] = 30.0) -> "PositionBook":
+        """
+        Seeds a PositionBook from the positions and working orders endpoints, keeps it current from the
+        confirmations of this client's open/close/update_trade calls and reconciles it periodically.
+        """
+        self.disable_position_book()
+        book = PositionBook(self, reconcile_interval)
+        book.seed()
+        book.start()
+        self.position_book = book
+        return book
+
+    def disable_position_book(self):
+        book, self.position_book = self.position_book, None
+        if book is not None:
+            book.stop()
+
+    def _track_in_position_book(self, response: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        book = self.position_book
+        if book is not None and response:
+            book.track(response)
+        return response
+
+    def get_deal_confirmation(self, deal_reference: str) -> Optional[Dict[str, Any]]:
+        """Fetches confirms/{dealReference}; raises CapitalComAPIError with status 404 while it is not available yet."""
+        return self._request("GET", f"confirms/{deal_reference}")
+
+    def track_deal(self, deal: Union[str, Dict[str, Any]], timeout_seconds: Optional[float] = None) -> Future:
+        """
+        Returns a Future resolved with the deal's confirmation (see DealConfirmationTracker). Accepts a
+        dealReference or the response of open_trade / close_trade / update_trade.
+        """
+        if self.deal_tracker is None:
+            with self._deal_tracker_lock:
+                if self.deal_tracker is None:
+                    self.deal_tracker = DealConfirmationTracker(self)
+        return self.deal_tracker.track(deal, timeout_seconds)
+
+    def open_trades_bulk(self, orders: List[Dict[str, Any]], max_workers: int = 10) -> List[Dict[str, Any]]:
+        """
+        Opens several positions concurrently. Each order holds open_trade keyword arguments (epic,
+        direction, size, ...). Requests go out through a pool of max_workers threads as fast as the
+        trading rate limit allows. Returns one result per order in submission order: ok, response,
+        deal_reference, error / status_code, and latency_seconds (request round trip) plus
+        sent_after_seconds / completed_after_seconds relative to the start of the batch.
+        """
+        _validate_bulk_orders(orders, self.open_trade)
+        if not orders:
+            return []
+        logger.info(f"Opening {len(orders)} trades concurrently ({max_workers} workers)...")
+        batch_started = time.perf_counter()
+
+        def place(index_and_order: Tuple[int, Dict[str, Any]]) -> Dict[str, Any]:
+            index, order = index_and_order
+            started = time.perf_counter()
+            response, error = None, None
+            try:
+                response = self.open_trade(**order)
+            except (CapitalComAPIError, requests.exceptions.RequestException) as e:
+                error = e
+                logger.error(f"Bulk order {index} ({order['epic']}) failed: {e}")
+            except Exception as e:
+                # Keep the other orders' results: some of them may already have been sent.
+                error = e
+                logger.error(f"Bulk order {index} ({order['epic']}) raised unexpectedly: {e}", exc_info=True)
+            return _bulk_order_result(index, order, response, error, started, time.perf_counter(), batch_started)
 
-        return self._request("POST", "positions", data=payload)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(orders))), thread_name_prefix="CapitalComOrders") as pool:
+            results = list(pool.map(place, enumerate(orders)))
+        failed = sum(1 for result in results if not result["ok"])
+        logger.info(f"Bulk open finished in {time.perf_counter() - batch_started:.3f}s: {len(orders) - failed} ok, {failed} failed.")
+        return results
 
     def close_trade(self, deal_id: str, direction: Optional[TradeDirection] = None,
                       size: Optional[float] = None, order_type: str = "MARKET",
@@ -422,18 +1742,86 @@ class CapitalComAPI:
         may target a specific OTC or bulk closing mechanism.
         """
         logger.info(f"Attempting to close trade {deal_id} (Size: {size if size else 'Full'}, Direction: {direction.value if direction else 'N/A'})")
-        payload: Dict[str, Any] = {"dealId": deal_id} 
-        if direction: payload["direction"] = direction.value
-        if size is not None: payload["size"] = str(size)
+        payload = _close_trade_payload(deal_id, direction, size, order_type, level, time_in_force)
 
-        if order_type.upper() != "MARKET":
-            payload["orderType"] = order_type.upper()
-            if level is None:
-                raise ValueError("Level must be specified for non-market order types for closing.")
-            payload["level"] = str(level)
-            payload["timeInForce"] = time_in_force 
+        return self._track_in_position_book(self._request("DELETE", "positions", data=payload))
 
-        return self._request("DELETE", "positions", data=payload)
+    def close_positions(self, filter: Optional[Callable[[Dict[str, Any]], bool]] = None,
+                        epics: Optional[List[str]] = None, max_workers: int = 20, max_retries: int = 2,
+                        retry_delay: float = 0.05, reconcile_rounds: int = 1) -> Dict[str, Any]:
+        """
+        Closes every open position matching filter (called with each get_open_positions() entry) and/or
+        epics, concurrently through a pool of max_workers threads. Transient failures (network, 429, 5xx)
+        are retried per position up to max_retries times; a 404 counts as already closed. Afterwards
+        get_open_positions() is checked and positions still open are closed again, up to
+        reconcile_rounds times. Throughput is bounded by the client-side trading rate limit.
+        Returns counts, per-position results, the dealIds still open and wall_clock_seconds.
+        """
+        started = time.perf_counter()
+        positions = self.get_open_positions()
+        targets = [position for position in positions
+                   if (epics is None or (position.get("market") or {}).get("epic") in epics)
+                   and (filter is None or filter(position))]
+        logger.warning(f"Closing {len(targets)} of {len(positions)} open positions ({max_workers} workers)...")
+
+        def close_one(position: Dict[str, Any]) -> Dict[str, Any]:
+            deal_id = position["position"]["dealId"]
+            result = {"deal_id": deal_id, "epic": (position.get("market") or {}).get("epic"), "status": "failed",
+                      "attempts": 0, "response": None, "deal_reference": None, "error": None}
+            position_started = time.perf_counter()
+            for attempt in range(max_retries + 1):
+                result["attempts"] = attempt + 1
+                try:
+                    response = self.close_trade(deal_id)
+                    result.update(status="closed", response=response, deal_reference=(response or {}).get("dealReference"), error=None)
+                    break
+                except CapitalComAPIError as e:
+                    result["error"] = str(e)
+                    if e.status_code == 404:
+                        result.update(status="already_closed", error=None)
+                        break
+                    if not _is_transient_api_error(e) or attempt == max_retries:
+                        logger.error(f"Closing {deal_id} failed after {attempt + 1} attempt(s): {e}")
+                        break
+                    time.sleep(retry_delay * (2 ** attempt))
+            result["latency_seconds"] = time.perf_counter() - position_started
+            return result
+
+        def close_all(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            if not batch:
+                return []
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batch))), thread_name_prefix="CapitalComClose") as pool:
+                return list(pool.map(close_one, batch))
+
+        results = close_all(targets)
+        target_ids = {position["position"]["dealId"] for position in targets}
+        still_open: List[str] = []
+        for round_number in range(reconcile_rounds + 1):
+            if not target_ids:
+                break
+            remaining = [position for position in self.get_open_positions() if position["position"]["dealId"] in target_ids]
+            still_open = [position["position"]["dealId"] for position in remaining]
+            if not remaining or round_number == reconcile_rounds:
+                break
+            logger.warning(f"Reconciliation round {round_number + 1}: {len(remaining)} position(s) still open, closing again.")
+            retried = {result["deal_id"]: result for result in close_all(remaining)}
+            # A 404 on retry for a deal we already closed only confirms that close; keep the original result.
+            results = [result if result["deal_id"] not in retried
+                       or (result["status"] == "closed" and retried[result["deal_id"]]["status"] == "already_closed")
+                       else retried[result["deal_id"]] for result in results]
+
+        report = {
+            "requested": len(targets),
+            "closed": sum(1 for result in results if result["status"] == "closed"),
+            "already_closed": sum(1 for result in results if result["status"] == "already_closed"),
+            "failed": sum(1 for result in results if result["status"] == "failed"),
+            "still_open": still_open,
+            "results": results,
+            "wall_clock_seconds": time.perf_counter() - started,
+        }
+        logger.warning(f"close_positions finished in {report['wall_clock_seconds']:.3f}s: {report['closed']} closed, "
+                       f"{report['already_closed']} already closed, {report['failed']} failed, {len(still_open)} still open.")
+        return report
 
     def update_trade(self, deal_id: str, stop_level: Optional[float] = None,
                        profit_level: Optional[float] = None, 
@@ -441,58 +1829,155 @@ class CapitalComAPI:
                        trailing_stop_distance: Optional[float] = None,
                        guaranteed_stop: Optional[bool] = None) -> Optional[Dict[str, Any]]:
         logger.info(f"Updating trade {deal_id}: SL={stop_level}, TP={profit_level}, TS={trailing_stop}, TSDist={trailing_stop_distance}, GS={guaranteed_stop}")
-        payload: Dict[str, Any] = {}
-        if stop_level is not None: payload["stopLevel"] = str(stop_level)
-        if profit_level is not None: payload["profitLevel"] = str(profit_level) 
-        if trailing_stop is not None: payload["trailingStop"] = trailing_stop
-        if trailing_stop_distance is not None:
-            payload["trailingStopDistance"] = str(trailing_stop_distance)
-        if guaranteed_stop is not None:
-             payload["guaranteedStop"] = guaranteed_stop
+        payload = _update_trade_payload(stop_level, profit_level, trailing_stop, trailing_stop_distance, guaranteed_stop)
 
         if not payload:
             logger.warning("Update_trade called with no parameters to update. No action taken.")
             return None
-        return self._request("PUT", f"positions/{deal_id}", data=payload)
+        return self._track_in_position_book(self._request("PUT", f"positions/{deal_id}", data=payload))
 
     def get_historical_prices(self, epic: str, resolution: HistoricalPriceResolution,
                                 num_points: Optional[int] = None, start_date: Optional[str] = None,
-                                end_date: Optional[str] = None) -> Optional[Dict[str, Any]]:
+                                end_date: Optional[str] = None, as_array: bool = False) -> Optional[Any]:
+        """
+        Fetches OHLC bars for an epic. With as_array=True the bars are returned as a NumPy structured
+        array of OHLC_BAR_DTYPE (see historical_prices_to_array) instead of the raw JSON response.
+        """
         logger.info(f"Fetching historical prices for {epic}, resolution {resolution.value}")
-        params: Dict[str, Any] = {"resolution": resolution.value}
-        if num_points is not None: 
-            params["max"] = num_points
-
-        if start_date: params["from"] = start_date
-        if end_date: params["to"] = end_date
-
-        if num_points is None and not (start_date and end_date): 
-            if start_date and not end_date: 
-                 params["max"] = 100 
-            elif end_date and not start_date: 
-                 params["max"] = 100 
-            elif not start_date and not end_date: 
-                 params["max"] = 100 
-                 logger.debug("No date range or num_points specified for historical_prices, defaulting to max=100.")
-
-        return self._request("GET", f"prices/{epic}", params=params)
-
-    def get_market_details(self, epic: Optional[str] = None, epics: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
-        if epic and epics:
-            raise ValueError("Provide either a single 'epic' or a list of 'epics', not both.")
-
-        if epic:
-            logger.info(f"Fetching market details for epic: {epic}")
-            return self._request("GET", f"markets/{epic}")
-        elif epics:
-            if not epics: 
-                logger.warning("get_market_details called with empty 'epics' list. Fetching all markets instead.")
-                return self._request("GET", "markets") 
-            logger.info(f"Fetching market details for epics: {','.join(epics)}")
-            return self._request("GET", "markets", params={"epics": ",".join(epics)})
-        else: 
-            logger.info("Fetching all navigable market details...")
-            return self._request("GET", "markets") 
+        params = _historical_prices_params(resolution, num_points, start_date, end_date)
+
+        data = self._request("GET", f"prices/{epic}", params=params)
+        if as_array:
+            return historical_prices_to_array(data.get("prices", []) if data else [])
+        return data
+
+    def fetch_history_range(self, epic: str, resolution: HistoricalPriceResolution,
+                            start: Union[str, datetime], end: Optional[Union[str, datetime]] = None,
+                            max_workers: int = 4, points_per_request: Optional[int] = None,
+                            as_array: bool = False) -> Any:
+        """
+        Fetches all bars between start and end (default: now, UTC), which may span far more than one
+        request can return. The range is split into windows of points_per_request bars
+        (default MAX_HISTORICAL_POINTS_PER_REQUEST) fetched concurrently by up to max_workers threads,
+        all going through the rate limiter. Bars are de-duplicated on snapshot time and returned
+        oldest first in the same shape as get_historical_prices: {"prices": [...], "instrumentType": ...},
+        or as an OHLC_BAR_DTYPE structured array when as_array is True.
+        """
+        start_dt = _to_utc_datetime(start)
+        end_dt = _to_utc_datetime(end) if end is not None else datetime.now(timezone.utc).replace(tzinfo=None)
+        if end_dt <= start_dt:
+            raise ValueError(f"End of history range ({end_dt}) must be after its start ({start_dt}).")
+        points = points_per_request or self.MAX_HISTORICAL_POINTS_PER_REQUEST
+        # One bar short of the limit so an inclusive 'to' never pushes a window over the server cap.
+        window = timedelta(seconds=resolution.seconds * max(points - 1, 1))
+
+        windows: List[Tuple[str, str]] = []
+        window_start = start_dt
+        while window_start < end_dt:
+            window_end = min(window_start + window, end_dt)
+            windows.append((_format_api_datetime(window_start), _format_api_datetime(window_end)))
+            window_start = window_end
+        logger.info(f"Fetching {epic} {resolution.value} history from {windows[0][0]} to {windows[-1][1]} in {len(windows)} windows ({max_workers} workers).")
+
+        def fetch_window(bounds: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+            try:
+                return self.get_historical_prices(epic, resolution, num_points=points, start_date=bounds[0], end_date=bounds[1])
+            except CapitalComAPIError as e:
+                if e.status_code == 404:
+                    logger.debug(f"No prices for {epic} between {bounds[0]} and {bounds[1]}.")
+                    return None
+                raise
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(windows))), thread_name_prefix="CapitalComHistory") as pool:
+            responses = list(pool.map(fetch_window, windows))
+
+        bars_by_time: Dict[str, Dict[str, Any]] = {}
+        instrument_type = None
+        for response in responses:
+            if not response:
+                continue
+            instrument_type = instrument_type or response.get("instrumentType")
+            for bar in response.get("prices", []):
+                key = bar.get("snapshotTimeUTC") or bar.get("snapshotTime")
+                if key:
+                    bars_by_time[key] = bar
+        prices = [bars_by_time[key] for key in sorted(bars_by_time)]
+        logger.info(f"Fetched {len(prices)} unique {resolution.value} bars for {epic}.")
+        if as_array:
+            return historical_prices_to_array(prices)
+        return {"prices": prices, "instrumentType": instrument_type}
+
+    def get_market_details(self, epic: Optional[str] = None, epics: Optional[List[str]] = None,
+                           use_cache: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        Fetches market details for one epic, a list of epics, or all navigable markets.
+        When the market details cache is enabled, fresh entries are served locally and only
+        missing/expired epics are requested (in bulk for lists).
+        """
+        cache = self.market_details_cache if use_cache else None
+        if cache and epic and not epics:
+            cached = cache.get(epic)
+            if cached is not None:
+                logger.debug(f"Market details for {epic} served from cache.")
+                return cached
+            details = self._request("GET", f"markets/{epic}")
+            if details:
+                cache.put(details, epic=epic)
+            return details
+        if cache and epics and not epic:
+            by_epic = {e: cache.get(e) for e in epics}
+            for details in self._fetch_market_details_bulk([e for e, d in by_epic.items() if d is None]):
+                by_epic[(details.get("instrument") or {}).get("epic")] = details
+            return {"marketDetails": [by_epic[e] for e in epics if by_epic.get(e) is not None]}
+
+        endpoint, params = _market_details_request(epic, epics)
+        return self._request("GET", endpoint, params=params)
+
+    def enable_market_details_cache(self, static_ttl_seconds: float = 3600.0, snapshot_ttl_seconds: float = 1.0,
+                                    max_entries: int = 512) -> MarketDetailsCache:
+        """
+        Turns on caching of get_market_details results (used by the trade sizing helpers). Sizing needs
+        the snapshot price, so snapshot_ttl_seconds is how stale a price sizing may use: the 1s default
+        keeps prices current but still costs a round-trip per epic and second. Raise it if that
+        staleness is acceptable, or call refresh_market_details(epics) periodically (one request per
+        MAX_EPICS_PER_MARKETS_REQUEST epics) so sizing calls are always served locally.
+        """
+        self.market_details_cache = MarketDetailsCache(static_ttl_seconds, snapshot_ttl_seconds, max_entries)
+        logger.info(f"Market details cache enabled (static TTL {static_ttl_seconds}s, snapshot TTL {snapshot_ttl_seconds}s, max {max_entries} epics).")
+        return self.market_details_cache
+
+    def disable_market_details_cache(self):
+        self.market_details_cache = None
+
+    def refresh_market_details(self, epics: Optional[List[str]] = None) -> int:
+        """
+        Bulk-refills the market details cache through GET markets?epics=, in chunks of
+        MAX_EPICS_PER_MARKETS_REQUEST. Refreshes every cached epic when epics is None.
+        Returns the number of epics stored.
+        """
+        cache = self.market_details_cache
+        if cache is None:
+            raise CapitalComAPIError("Market details cache is not enabled. Call enable_market_details_cache() first.")
+        if epics is None:
+            epics = cache.epics()
+        return len(self._fetch_market_details_bulk(epics))
+
+    def _fetch_market_details_bulk(self, epics: List[str]) -> List[Dict[str, Any]]:
+        fetched: List[Dict[str, Any]] = []
+        for i in range(0, len(epics), self.MAX_EPICS_PER_MARKETS_REQUEST):
+            chunk = epics[i:i + self.MAX_EPICS_PER_MARKETS_REQUEST]
+            logger.info(f"Fetching market details for epics: {','.join(chunk)}")
+            data = self._request("GET", "markets", params={"epics": ",".join(chunk)})
+            for details in (data or {}).get("marketDetails", []):
+                if self.market_details_cache:
+                    self.market_details_cache.put(details)
+                fetched.append(details)
+        return fetched
+
+    def invalidate_market_details(self, epic: Optional[str] = None, snapshot_only: bool = False):
+        """Drops one epic (or all epics) from the market details cache."""
+        if self.market_details_cache:
+            self.market_details_cache.invalidate(epic, snapshot_only)
 
     def calculate_trade_size_for_amount(self, epic: str,
                                         investment_amount_in_quote_currency: float,
@@ -509,78 +1994,8 @@ class CapitalComAPI:
         if not market_data:
             raise CapitalComAPIError(f"Could not fetch market details for epic {epic} to calculate size.")
 
-        snapshot = market_data.get("snapshot")
-        instrument_details = market_data.get("instrument") 
-        dealing_rules = market_data.get("dealingRules")
-
-        if not snapshot or not instrument_details or not dealing_rules:
-            raise CapitalComAPIError(f"Market details for {epic} are incomplete (missing snapshot, instrument, or dealingRules). Cannot calculate size.")
-
-        price = snapshot.get("offer") if direction == TradeDirection.BUY else snapshot.get("bid")
-        if price is None or price <= 0:
-            raise ValueError(f"Invalid or zero price ({price}) for {epic} ({direction.value}). Cannot calculate size.")
-
-        instrument_type = instrument_details.get("type")
-        if not instrument_type:
-            raise ValueError(f"Instrument type not found for epic {epic}. Cannot determine account leverage.")
-
-        account_prefs = self.get_account_preferences() 
-        if not account_prefs or "leverages" not in account_prefs:
-            raise CapitalComAPIError("Could not fetch account preferences or leverage information.")
-
-        leverage_val = None
-
-        leverages_data = account_prefs.get("leverages", {}) 
-        instrument_type_leverage_info = leverages_data.get(instrument_type)
-
-        if instrument_type_leverage_info and isinstance(instrument_type_leverage_info, dict):
-            leverage_val = instrument_type_leverage_info.get("current") 
-        elif isinstance(account_prefs.get("leverages"), list): 
-             for lev_info in account_prefs.get("leverages", []):
-                if lev_info.get("instrumentType") == instrument_type:
-                    leverage_val = lev_info.get("leverage") 
-                    break
-
-        if leverage_val is None or not isinstance(leverage_val, (int, float)) or leverage_val <= 0:
-            raise ValueError(f"Leverage for instrument type {instrument_type} not found or invalid ({leverage_val}) in account preferences.")
-        logger.debug(f"Using account leverage {leverage_val}:1 for instrument type {instrument_type} (epic {epic}).")
-
-        raw_size = (investment_amount_in_quote_currency*1.22 * leverage_val) / price
-        logger.debug(f"Raw calculated size: {raw_size} (Margin: {investment_amount_in_quote_currency}, Price: {price}, Account Leverage: {leverage_val})")
-
-        min_deal_size_str = dealing_rules.get("minDealSize", {}).get("value")
-        deal_size_step_str = dealing_rules.get("dealSize", {}).get("step") 
-
-        if min_deal_size_str is None or deal_size_step_str is None:
-
-            deal_size_step_str = dealing_rules.get("minSizeIncrement", {}).get("value")
-            if deal_size_step_str is None:
-                raise ValueError(f"Missing dealing rules (minDealSize.value or dealSize.step/minSizeIncrement.value) for {epic}.")
-
-        try:
-            min_size_allowed = float(min_deal_size_str)
-            size_step = float(deal_size_step_str)
-        except ValueError:
-            raise ValueError("Could not convert minDealSize or dealSize.step/minSizeIncrement to float.")
-
-        if size_step <= 0:
-            raise ValueError("Deal size step must be greater than zero.")
-
-        if raw_size < min_size_allowed : 
-            stepped_size = 0.0
-        else:
-            num_steps = math.floor(raw_size / size_step)
-            stepped_size = num_steps * size_step
-
-        logger.debug(f"Size after rounding to step {size_step}: {stepped_size}")
-
-        if stepped_size < min_size_allowed:
-            logger.warning(f"Calculated size {stepped_size} for {epic} is less than minimum allowed {min_size_allowed}. "
-                           f"Investment amount {investment_amount_in_quote_currency} may be too small.")
-            return 0.0
-
-        logger.info(f"Calculated trade size for {epic} ({direction.value}) with margin {investment_amount_in_quote_currency} (account leverage): {stepped_size}")
-        return stepped_size
+        account_prefs = self.get_cached_account_preferences() 
+        return _trade_size_for_amount(epic, investment_amount_in_quote_currency, direction, market_data, account_prefs)
 
     def calculate_trade_size_for_margin(self, epic: str,
                                         margin_amount_in_quote_currency: float,
@@ -596,95 +2011,44 @@ class CapitalComAPI:
             return 0.0
 
         market_data = self.get_market_details(epic=epic)
-        if not market_data:
-            raise CapitalComAPIError(f"Could not fetch market details for epic {epic} to calculate size.")
-
-        snapshot = market_data.get("snapshot")
-        instrument_details = market_data.get("instrument")
-        dealing_rules = market_data.get("dealingRules")
-
-        if not snapshot or not instrument_details or not dealing_rules:
-            raise CapitalComAPIError(f"Market details for {epic} are incomplete. Cannot calculate size.")
-
-        current_price = snapshot.get("offer") if direction == TradeDirection.BUY else snapshot.get("bid")
-        if current_price is None or current_price <= 0:
-            raise ValueError(f"Invalid or zero price ({current_price}) for {epic} ({direction.value}). Cannot calculate size.")
-
-        margin_factor_percentage = instrument_details.get("marginFactor") 
-        margin_factor_unit = instrument_details.get("marginFactorUnit", "PERCENTAGE").upper()
-
-        if margin_factor_percentage is None or not isinstance(margin_factor_percentage, (int, float)) or margin_factor_percentage <= 0:
-            raise ValueError(f"Invalid or missing marginFactor ({margin_factor_percentage}) for {epic}. Must be a positive number.")
-
-        if margin_factor_unit == "PERCENTAGE":
-            margin_factor_decimal = margin_factor_percentage / 100.0
-        elif margin_factor_unit == "ABSOLUTE": 
-             margin_factor_decimal = margin_factor_percentage
-        else: 
-            logger.warning(f"Unknown marginFactorUnit '{margin_factor_unit}' for epic {epic}. Assuming marginFactor is percentage.")
-            margin_factor_decimal = margin_factor_percentage / 100.0
-
-        if margin_factor_decimal <= 0: 
-            raise ValueError(f"Resulting margin factor decimal ({margin_factor_decimal}) is invalid.")
-
-        notional_value_in_quote_currency = margin_amount_in_quote_currency / margin_factor_decimal
-        logger.debug(f"Calculated notional value: {notional_value_in_quote_currency} (Margin: {margin_amount_in_quote_currency}, MarginFactor (decimal): {margin_factor_decimal})")
-
-        raw_size = notional_value_in_quote_currency / current_price
-        logger.debug(f"Raw calculated size: {raw_size} (Notional: {notional_value_in_quote_currency}, Price: {current_price})")
-
-        min_deal_size_str = dealing_rules.get("minDealSize", {}).get("value")
-
-        deal_size_step_str = dealing_rules.get("minSizeIncrement", {}).get("value")
-        if deal_size_step_str is None: 
-             deal_size_step_str = dealing_rules.get("dealSize", {}).get("step")
-
-        if min_deal_size_str is None or deal_size_step_str is None:
-            raise ValueError(f"Missing dealing rules (minDealSize.value or minSizeIncrement.value/dealSize.step) for {epic}.")
-
-        try:
-            min_size_allowed = float(min_deal_size_str)
-            size_step = float(deal_size_step_str)
-        except ValueError:
-            raise ValueError("Could not convert minDealSize or size step to float.")
-
-        if size_step <= 0:
-            raise ValueError("Deal size step must be greater than zero.")
-
-        if raw_size < min_size_allowed:
-            stepped_size = 0.0
-        else:
-            num_steps = math.floor(raw_size / size_step)
-            stepped_size = num_steps * size_step
-
-        logger.debug(f"Size after rounding to step {size_step}: {stepped_size}")
-
-        if stepped_size < min_size_allowed:
-            logger.warning(f"Calculated size {stepped_size} for {epic} is less than minimum allowed {min_size_allowed}. "
-                           f"Margin amount {margin_amount_in_quote_currency} may be too small.")
-            return 0.0
-
-        logger.info(f"Calculated trade size for {epic} ({direction.value}) with margin {margin_amount_in_quote_currency} (using instrument marginFactor): {stepped_size}")
-        return stepped_size
+        return _trade_size_for_margin(epic, margin_amount_in_quote_currency, direction, market_data)
 
     def get_account_preferences(self) -> Optional[Dict[str, Any]]:
         logger.info("Fetching account preferences...")
         try:
             preferences = self._request("GET", "accounts/preferences")
-            if preferences:
-                hedging_status = preferences.get('hedgingMode', 'N/A') 
-                leverages_summary = []
-
-                leverages_dict = preferences.get('leverages', {})
-                if isinstance(leverages_dict, dict):
-                    for instrument_type, lev_details in leverages_dict.items():
-                        leverages_summary.append((instrument_type, lev_details.get('current')))
-                logger.info(f"Account preferences retrieved: Hedging: {hedging_status}, Leverages: {leverages_summary}")
+            _log_account_preferences(preferences)
+            self._account_preferences_cache.set(copy.deepcopy(preferences))
             return preferences
         except CapitalComAPIError as e:
             logger.error(f"Failed to get account preferences: {e}")
             return None
 
+    def get_cached_account_preferences(self, max_age_seconds: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Returns account preferences from the local cache, fetching them only when the cached copy is
+        older than max_age_seconds (default ACCOUNT_PREFERENCES_MAX_AGE_SECONDS) or was invalidated.
+        """
+        preferences = self._account_preferences_cache.get(max_age_seconds)
+        if preferences is not None:
+            logger.debug("Account preferences served from cache.")
+            return copy.deepcopy(preferences)
+        return self.get_account_preferences()
+
+    def refresh_account_preferences(self) -> Optional[Dict[str, Any]]:
+        """Forces a fetch of account preferences and updates the cache."""
+        return self.get_account_preferences()
+
+    def invalidate_account_preferences(self):
+        self._account_preferences_cache.invalidate()
+
+    def get_account_leverage(self, instrument_type: str) -> Optional[Any]:
+        """Current account leverage for an instrument type (e.g. 'CURRENCIES'), read from cached preferences."""
+        preferences = self.get_cached_account_preferences()
+        if not preferences:
+            return None
+        return _leverage_from_preferences(preferences, instrument_type)
+
     def set_account_preferences(self, hedging_enabled: Optional[bool] = None,
                                 leverages: Optional[Dict[str, int]] = None) -> bool:
         """
@@ -712,12 +2076,15 @@ class CapitalComAPI:
         except CapitalComAPIError as e:
             logger.error(f"Failed to set account preferences: {e}")
             return False
+        finally:
+            self._account_preferences_cache.invalidate()
 
     def _get_ws_url(self) -> str:
         if not self.cst or not self.x_security_token:
             logger.warning("CST/X-SECURITY-TOKEN missing for WebSocket. Attempting re-login.")
             if not self.login(): 
-                raise CapitalComAPIError("Cannot connect to WebSocket: Re-login failed, tokens still missing.")
+                raise CapitalComAPIError("Cannot connect to WebSocket: Re-login failed, tokens still missing.",
+                                         status_code=self._last_login_status_code)
         return f"{self.ws_base_url}?cst={self.cst}&x-security-token={self.x_security_token}"
 
     def _ws_application_ping_run(self):
@@ -748,76 +2115,107 @@ class CapitalComAPI:
     def _ws_on_message(self, ws: websocket.WebSocketApp, message_str: str):
         try:
             message = json.loads(message_str)
-            logger.debug(f"WebSocket received message: {message_str[:300]}") 
-
-            if message.get("errorCode"):
-                logger.error(
-                    f"WebSocket error from server: {message.get('errorMessage', str(message))} "
-                    f"(Code: {message.get('errorCode')}, CorrelationID: {message.get('correlationId')})"
-                )
-                if message.get("errorCode") == "exceptions.security.authentication-failure":
-                    logger.error("WebSocket authentication failure. Signaling WebSocket stop.")
-                    self._ws_stop_event.set() 
-                    if self.ws_connection: self.ws_connection.close()
-                return
-
-            if "status" in message and message.get("status") == "OK" and "correlationId" in message and "payload" in message:
-                subs_payload = message["payload"].get("subscriptions")
-                if subs_payload and isinstance(subs_payload, dict) and list(subs_payload.values())[0] == "PROCESSED":
-                    logger.info(
-                        f"WebSocket control response (e.g. sub/unsub ack): Dest: {message.get('destination')}, "
-                        f"Status: {message['status']}, CorrID: {message['correlationId']}, "
-                        f"Subscriptions processed: {subs_payload}"
-                    )
-                    return
-
-            server_destination = message.get("destination")
-            payload = message.get("payload")
-
-            if payload and "epic" in payload:
-                epic = payload["epic"]
-                stream_destination_key_for_lookup: Optional[str] = None
+        except json.JSONDecodeError:
+            logger.warning(f"WebSocket received non-JSON message: {message_str}")
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"WebSocket received message: {message_str[:300]}") 
 
-                if server_destination == "quote": 
-                    stream_destination_key_for_lookup = f"/market/{epic}"
-                elif server_destination == "ohlc.event": 
-                    resolution = payload.get("resolution")
-                    bar_type = payload.get("type", OhlcBarType.CLASSIC.value) 
-                    if resolution:
-                        stream_destination_key_for_lookup = f"/ohlc/{epic}/{resolution}/{bar_type}"
-                    else:
-                        logger.warning(f"OHLC message for {epic} missing resolution in payload: {payload}")
+        try:
+            destination = message.get("destination")
+            if destination == "quote" or destination == "ohlc.event":
+                recorder = self._ws_recorder
+                if recorder is not None:
+                    recorder.record(destination, message.get("payload"))
+                self._ws_dispatch(destination, message.get("payload"))
+            else:
+                self._ws_handle_control_message(message, message_str)
+        except Exception as e:
+            logger.error(f"General error processing WebSocket message: {e}\nMessage: {message_str[:300]}", exc_info=True)
 
-                if stream_destination_key_for_lookup:
-                    with self._ws_lock:
-                        subscription_info = self._ws_subscriptions.get(stream_destination_key_for_lookup)
+    def _ws_dispatch(self, destination: str, payload: Optional[Dict[str, Any]]) -> bool:
+        """
+        Hands a parsed 'quote' / 'ohlc.event' payload to its subscriber. Lookups go through the
+        tuple-keyed _ws_routes snapshot, so this path builds no strings and takes no locks.
+        Returns True if a subscriber was found.
+        """
+        if not payload:
+            return False
+        if destination == "quote":
+            route_key: Tuple[Any, ...] = (destination, payload.get("epic"))
+        else:
+            route_key = (destination, payload.get("epic"), payload.get("resolution"), payload.get("type", "classic"))
+        sub_info = self._ws_routes.get(route_key)
+        if sub_info is None:
+            if destination == "ohlc.event" and not payload.get("resolution"):
+                logger.warning(f"OHLC message for {payload.get('epic')} missing resolution in payload: {payload}")
+            elif logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"No active subscription found for route {route_key}. Current routes: {list(self._ws_routes.keys())}")
+            return False
+        sub_info["last_message_at"] = time.monotonic()
+        tick_buffer = sub_info["tick_buffer"]
+        if tick_buffer is not None:
+            tick_buffer.append_quote(payload)
+            if not sub_info["listeners"]:
+                return True
+        conflated_callback = sub_info["conflated_callback"]
+        if conflated_callback is not None:
+            self._ws_get_dispatcher().submit_latest(route_key, conflated_callback, payload)
+        callback = sub_info["callback"]
+        if callback is None:
+            return True
+        if self.ws_dispatch_mode == WebsocketDispatchMode.THREADED:
+            self._ws_get_dispatcher().submit(route_key, callback, payload)
+            return True
+        try:
+            callback(payload)
+        except Exception as e:
+            logger.error(f"Error in WebSocket callback for {route_key}: {e}", exc_info=True)
+        return True
 
-                    if subscription_info:
-                        if subscription_info["active"] and subscription_info["callback"]:
-                            try:
-                                subscription_info["callback"](payload) 
-                            except Exception as e:
-                                logger.error(f"Error in WebSocket callback for {stream_destination_key_for_lookup}: {e}", exc_info=True)
+    def _ws_get_dispatcher(self) -> WebsocketCallbackDispatcher:
+        dispatcher = self._ws_dispatcher
+        if dispatcher is None:
+            with self._ws_lock:
+                if self._ws_dispatcher is None:
+                    self._ws_dispatcher = WebsocketCallbackDispatcher(self._ws_dispatch_workers)
+                dispatcher = self._ws_dispatcher
+        return dispatcher
+
+    def _ws_handle_control_message(self, message: Dict[str, Any], message_str: str):
+        """Errors, subscription acks, pongs and anything else that is not market data."""
+        if message.get("errorCode"):
+            logger.error(
+                f"WebSocket error from server: {message.get('errorMessage', str(message))} "
+                f"(Code: {message.get('errorCode')}, CorrelationID: {message.get('correlationId')})"
+            )
+            if message.get("errorCode") == "exceptions.security.authentication-failure":
+                logger.error("WebSocket authentication failure. Signaling WebSocket stop.")
+                self._ws_stop_event.set() 
+                if self.ws_connection: self.ws_connection.close()
+            return
 
-                    else:
-                        logger.debug(f"No active subscription found for stream key {stream_destination_key_for_lookup} from message destination {server_destination}. Current sub keys: {list(self._ws_subscriptions.keys())}")
-                elif server_destination == "ping": 
-                    if message.get("status") == "OK":
-                        logger.info(f"Application-level WebSocket PONG received: {message}")
-                    else:
-                        logger.warning(f"Application-level WebSocket PING response with unexpected status: {message}")
+        if message.get("destination") == "ping":
+            if message.get("status") == "OK":
+                logger.info(f"Application-level WebSocket PONG received: {message}")
+            else:
+                logger.warning(f"Application-level WebSocket PING response with unexpected status: {message}")
+            return
 
-                else: 
-                    logger.debug(f"Data message received for server destination '{server_destination}' with epic '{epic}', but no specific handler: {payload}")
+        payload = message.get("payload")
+        if message.get("status") == "OK" and "correlationId" in message and isinstance(payload, dict):
+            subs_payload = payload.get("subscriptions")
+            if subs_payload and isinstance(subs_payload, dict) and list(subs_payload.values())[0] == "PROCESSED":
+                logger.info(
+                    f"WebSocket control response (e.g. sub/unsub ack): Dest: {message.get('destination')}, "
+                    f"Status: {message['status']}, CorrID: {message['correlationId']}, "
+                    f"Subscriptions processed: {subs_payload}"
+                )
                 return
 
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Unprocessed WebSocket message (format/type not recognized or no handler): {message_str[:300]}")
 
-        except json.JSONDecodeError:
-            logger.warning(f"WebSocket received non-JSON message: {message_str}")
-        except Exception as e:
-            logger.error(f"General error processing WebSocket message: {e}\nMessage: {message_str[:300]}", exc_info=True)
-
     def _ws_on_error(self, ws: websocket.WebSocketApp, error: Exception):
         logger.error(f"WebSocket low-level error: {error}")
 
@@ -843,7 +2241,8 @@ class CapitalComAPI:
     def _ws_on_open(self, ws: websocket.WebSocketApp):
         logger.info("WebSocket connection opened successfully.")
         self._ws_status = WebSocketStatus.CONNECTED
-        self._ws_reconnect_attempts = 0 
+        self._ws_connected_at = time.monotonic()
+        self.ws_reconnect_policy.on_connected()
 
         if not self.cst or not self.x_security_token:
             logger.error("CRITICAL: WebSocket opened but CST/X-SECURITY-TOKEN are missing. Cannot (re)subscribe. Closing WS.")
@@ -857,55 +2256,19 @@ class CapitalComAPI:
         self._ws_ping_thread.start()
 
         with self._ws_lock:
-
-            subscriptions_to_resubscribe = list(self._ws_subscriptions.items())
+            subscriptions_to_resubscribe = [sub_info for sub_info in self._ws_subscriptions.values() if sub_info["active"]]
 
         if not subscriptions_to_resubscribe:
             logger.info("No active subscriptions to process on WebSocket open/reconnect.")
             return
 
-        logger.info(f"Processing {len(subscriptions_to_resubscribe)} existing subscriptions on WebSocket (re)open.")
-        for stream_dest, sub_info in subscriptions_to_resubscribe:
-            if sub_info["active"]:
-                epic = sub_info["epic"]
-                data_type: WebsocketDataType = sub_info["data_type"]
-                resolution: Optional[HistoricalPriceResolution] = sub_info.get("resolution")
-                bar_type_enum: Optional[OhlcBarType] = sub_info.get("bar_type") 
-                correlation_id = f"reopen-{epic}-{data_type.value}-{int(time.time())}"
-
-                payload_data: Dict[str, Any] = {"epics": [epic]}
-                control_destination: str
-
-                if data_type == WebsocketDataType.MARKET:
-                    control_destination = "marketData.subscribe"
-                elif data_type == WebsocketDataType.OHLC:
-                    control_destination = "OHLCMarketData.subscribe" 
-                    if not resolution or not bar_type_enum:
-                        logger.error(f"Cannot resubscribe to OHLC for {epic}: Resolution or bar_type missing. Skipping. Sub info: {sub_info}")
-                        continue
-                    payload_data["resolutions"] = [resolution.value] 
-                    payload_data["type"] = bar_type_enum.value       
-                else:
-                    logger.error(f"Unknown data type {data_type} for {epic} during resubscription. Skipping.")
-                    continue
-
-                subscribe_msg = {
-                    "destination": control_destination,
-                    "correlationId": correlation_id,
-                    "cst": self.cst,
-                    "securityToken": self.x_security_token,
-                    "payload": payload_data
-                }
-                try:
-                    logger.info(f"Resubscribing to {stream_dest} (Control: {control_destination}, Epic: {epic}, Payload: {payload_data})")
-                    ws.send(json.dumps(subscribe_msg))
-                except Exception as e:
-                    logger.error(f"Failed to send resubscription for {stream_dest} (Epic: {epic}): {e}")
-            else: 
-                logger.debug(f"Skipping inactive subscription found in list for {stream_dest} during on_open processing.")
+        messages = self._ws_build_control_messages(subscriptions_to_resubscribe, subscribe=True, correlation_prefix="reopen")
+        logger.info(f"Resubscribing {len(subscriptions_to_resubscribe)} existing subscriptions on WebSocket (re)open using {len(messages)} control message(s).")
+        self._ws_send_control_messages(ws, messages)
 
     def _ws_run(self):
         self._ws_status = WebSocketStatus.CONNECTING 
+        auth_failed = False
         while not self._ws_stop_event.is_set():
             try:
                 ws_url = self._get_ws_url() 
@@ -921,9 +2284,12 @@ class CapitalComAPI:
                 self.ws_connection.run_forever(ping_interval=30, ping_timeout=10, sslopt={"check_hostname": True})
 
             except CapitalComAPIError as e: 
-                logger.error(f"Cannot start or maintain WebSocket due to API error: {e}. Stopping WebSocket attempts.")
-                self._ws_stop_event.set() 
-                break 
+                if e.status_code in self.AUTH_FAILURE_STATUS_CODES:
+                    logger.error(f"WebSocket login was rejected, not reconnecting: {e}")
+                    auth_failed = True
+                    self._ws_stop_event.set()
+                    break
+                logger.error(f"Cannot start or maintain WebSocket due to API error: {e}")
             except websocket.WebSocketException as e: 
                 logger.error(f"WebSocket connection/setup exception: {e}")
             except Exception as e: 
@@ -933,25 +2299,11 @@ class CapitalComAPI:
                 logger.info("WebSocket stop event is set. Exiting run loop.")
                 break 
 
-            if self._ws_reconnect_attempts < self._ws_max_reconnect_attempts:
-                delay = min(self._ws_initial_reconnect_delay * (2 ** self._ws_reconnect_attempts), self._ws_max_reconnect_delay)
-                logger.info(f"WebSocket disconnected. Reconnect attempt {self._ws_reconnect_attempts + 1}/{self._ws_max_reconnect_attempts} in {delay} seconds...")
-                self._ws_status = WebSocketStatus.CONNECTING 
-
-                wait_interval = 1 
-                slept_time = 0
-                while slept_time < delay and not self._ws_stop_event.is_set():
-                    time.sleep(wait_interval)
-                    slept_time += wait_interval
-
-                if self._ws_stop_event.is_set(): 
-                    logger.info("WebSocket stop event received during reconnect delay. Aborting reconnect.")
-                    break 
-
-                self._ws_reconnect_attempts += 1
-            else:
-                logger.error(f"WebSocket max reconnect attempts ({self._ws_max_reconnect_attempts}) reached. Stopping WebSocket thread.")
-                self._ws_stop_event.set() 
+            delay = self.ws_reconnect_policy.next_delay()
+            logger.info(f"WebSocket disconnected. Reconnect attempt {self.ws_reconnect_policy.attempts} in {delay:.2f} seconds...")
+            self._ws_status = WebSocketStatus.CONNECTING 
+            if delay > 0 and self._ws_stop_event.wait(delay):
+                logger.info("WebSocket stop event received during reconnect delay. Aborting reconnect.")
                 break 
 
         if self.ws_connection: 
@@ -967,22 +2319,31 @@ class CapitalComAPI:
             self._ws_ping_thread.join(timeout=3)
         self._ws_ping_thread = None
 
-        if self._ws_status != WebSocketStatus.STOPPING: 
+        if auth_failed:
+            self._ws_status = WebSocketStatus.AUTH_FAILED
+        elif self._ws_status != WebSocketStatus.STOPPING: 
              self._ws_status = WebSocketStatus.DISCONNECTED
         logger.info("WebSocket thread run loop has finished.")
 
     def _start_websocket_thread(self) -> bool:
-        if self.ws_thread and self.ws_thread.is_alive():
-            logger.info("WebSocket thread already running.")
-            if self.ws_status == WebSocketStatus.CONNECTED:
-                return True 
+        thread = self.ws_thread
+        if thread and thread.is_alive():
+            if not self._ws_stop_event.is_set():
+                # Connected or (re)connecting: queued subscriptions go out from on_open, so never start a second loop.
+                logger.info("WebSocket thread already running.")
+                return True
+            logger.info("Waiting for the stopping WebSocket thread to finish before starting a new one.")
+            thread.join(timeout=5)
+            if thread.is_alive():
+                logger.warning("Previous WebSocket thread is still shutting down; not starting another.")
+                return False
 
         if not self.cst or not self.x_security_token:
             logger.info("CST/XST tokens not immediately available for WS start. _get_ws_url in run loop will attempt login.")
 
         self._ws_stop_event.clear()       
         self._ws_ping_stop_event.clear()  
-        self._ws_reconnect_attempts = 0   
+        self.ws_reconnect_policy.reset()
         self._ws_status = WebSocketStatus.CONNECTING 
 
         self.ws_thread = threading.Thread(target=self._ws_run, name="CapitalComWSThread", daemon=True)
@@ -999,6 +2360,8 @@ class CapitalComAPI:
                 self._ws_ping_stop_event.set()
                 self._ws_ping_thread.join(timeout=3)
             self._ws_ping_thread = None
+            if self._ws_dispatcher is not None and self._ws_dispatcher.running:
+                self._ws_dispatcher.stop()
             return
 
         logger.info("Attempting to stop WebSocket thread and application ping thread...")
@@ -1032,126 +2395,374 @@ class CapitalComAPI:
             else:
                 logger.info(f"WebSocket application ping thread ({self._ws_ping_thread.name}) joined successfully.")
 
+        if self._ws_dispatcher is not None and self._ws_dispatcher.running:
+            self._ws_dispatcher.stop()
+
         self.ws_thread = None
         self.ws_connection = None 
         self._ws_ping_thread = None
         self._ws_status = WebSocketStatus.DISCONNECTED 
         logger.info("WebSocket thread and related processes stopped.")
 
+    def _ws_stream_key(self, epic: str, data_type: WebsocketDataType,
+                       resolution: Optional[HistoricalPriceResolution] = None,
+                       bar_type: OhlcBarType = OhlcBarType.CLASSIC) -> str:
+        if data_type == WebsocketDataType.MARKET:
+            return f"/market/{epic}"
+        elif data_type == WebsocketDataType.OHLC:
+            if resolution is None:
+                raise ValueError("Resolution must be provided for OHLC data type subscriptions.")
+            return f"/ohlc/{epic}/{resolution.value}/{bar_type.value}"
+        raise ValueError(f"Unsupported WebSocket data_type: {data_type}")
+
+    def _ws_build_control_messages(self, subscriptions: List[Dict[str, Any]], subscribe: bool,
+                                   correlation_prefix: str) -> List[Tuple[Dict[str, Any], List[str]]]:
+        """
+        Coalesces subscriptions sharing (data_type, resolution, bar_type) into as few control messages
+        as possible, at most WS_MAX_EPICS_PER_SUBSCRIPTION epics each. Returns (message, epics) pairs.
+        """
+        groups: "OrderedDict[Tuple[WebsocketDataType, Optional[HistoricalPriceResolution], Optional[OhlcBarType]], List[str]]" = OrderedDict()
+        for sub_info in subscriptions:
+            data_type: WebsocketDataType = sub_info["data_type"]
+            resolution: Optional[HistoricalPriceResolution] = sub_info.get("resolution")
+            bar_type: Optional[OhlcBarType] = sub_info.get("bar_type")
+            if data_type == WebsocketDataType.MARKET:
+                group_key = (data_type, None, None)
+            elif data_type == WebsocketDataType.OHLC:
+                if not resolution or not bar_type:
+                    logger.error(f"Cannot build OHLC control message for {sub_info['epic']}: Resolution or bar_type missing. Skipping. Sub info: {sub_info}")
+                    continue
+                group_key = (data_type, resolution, bar_type)
+            else:
+                logger.error(f"Unknown data type {data_type} for {sub_info['epic']}. Skipping.")
+                continue
+            epics = groups.setdefault(group_key, [])
+            if sub_info["epic"] not in epics:
+                epics.append(sub_info["epic"])
+
+        action = "subscribe" if subscribe else "unsubscribe"
+        messages: List[Tuple[Dict[str, Any], List[str]]] = []
+        timestamp_ms = int(time.time() * 1000)
+        for (data_type, resolution, bar_type), epics in groups.items():
+            for i in range(0, len(epics), self.WS_MAX_EPICS_PER_SUBSCRIPTION):
+                chunk = epics[i:i + self.WS_MAX_EPICS_PER_SUBSCRIPTION]
+                payload_data: Dict[str, Any] = {"epics": chunk}
+                if data_type == WebsocketDataType.MARKET:
+                    control_destination = f"marketData.{action}"
+                else:
+                    control_destination = f"OHLCMarketData.{action}"
+                    payload_data["resolutions"] = [resolution.value]
+                    if subscribe:
+                        payload_data["type"] = bar_type.value
+                    else:
+                        payload_data["types"] = [bar_type.value]
+                messages.append(({
+                    "destination": control_destination,
+                    "correlationId": f"{correlation_prefix}-{data_type.value}-{timestamp_ms}-{len(messages)}",
+                    "cst": self.cst,
+                    "securityToken": self.x_security_token,
+                    "payload": payload_data
+                }, chunk))
+        return messages
+
+    def _ws_send_control_messages(self, ws: Any, messages: List[Tuple[Dict[str, Any], List[str]]]) -> int:
+        """Sends prepared control messages. Returns how many were sent successfully."""
+        sent = 0
+        for message, epics in messages:
+            try:
+                logger.info(f"Sending {message['destination']} for {len(epics)} epic(s): {','.join(epics)}")
+                ws.send(json.dumps(message))
+                sent += 1
+            except Exception as e:
+                logger.error(f"Failed to send {message['destination']} for {','.join(epics)}: {e}")
+        return sent
+
+    @staticmethod
+    def _ws_route_key(sub_info: Dict[str, Any]) -> Tuple[Any, ...]:
+        if sub_info["data_type"] == WebsocketDataType.MARKET:
+            return ("quote", sub_info["epic"])
+        return ("ohlc.event", sub_info["epic"], sub_info["resolution"].value, sub_info["bar_type"].value)
+
+    def _ws_rebuild_routes(self):
+        """Publishes a fresh routing table. Must be called with _ws_lock held after changing _ws_subscriptions."""
+        self._ws_routes = {self._ws_route_key(sub_info): sub_info
+                           for sub_info in self._ws_subscriptions.values() if sub_info["active"]}
+
+    def _ws_register_subscriptions(self, epics: List[str], data_type: WebsocketDataType,
+                                   callback: Optional[Callable[[Dict[str, Any]], None]],
+                                   resolution: Optional[HistoricalPriceResolution] = None,
+                                   bar_type: OhlcBarType = OhlcBarType.CLASSIC,
+                                   conflate: bool = False) -> Tuple[List[SubscriptionHandle], List[Dict[str, Any]]]:
+        """
+        Adds callback as a listener on each epic's stream locally (no server traffic); with callback None
+        the streams are only created. Returns the listener handles and the sub_info entries of streams
+        that did not exist before.
+        """
+        if conflate and data_type != WebsocketDataType.MARKET:
+            raise ValueError("Conflation is only supported for WebsocketDataType.MARKET subscriptions.")
+        handles: List[SubscriptionHandle] = []
+        new_subscriptions: List[Dict[str, Any]] = []
+        with self._ws_lock:
+            for epic in epics:
+                stream_destination_key = self._ws_stream_key(epic, data_type, resolution, bar_type)
+                sub_info = self._ws_subscriptions.get(stream_destination_key)
+                if sub_info is None:
+                    sub_info = {
+                        "listeners": OrderedDict(),
+                        # Handle ids of listeners that asked for conflation; the others see every payload.
+                        "conflated_handles": set(),
+                        "callback": None,
+                        "conflated_callback": None,
+                        "tick_buffer": None,
+                        "epic": epic,
+                        "data_type": data_type,
+                        "resolution": resolution, 
+                        "bar_type": bar_type,     
+                        "subscribed_at": time.monotonic(),
+                        "last_message_at": None,
+                        "active": True            
+                    }
+                    self._ws_subscriptions[stream_destination_key] = sub_info
+                    new_subscriptions.append(sub_info)
+                elif callback is not None:
+                    logger.info(f"Adding listener to existing subscription for {stream_destination_key} ({len(sub_info['listeners'])} already attached).")
+                if callback is None:
+                    continue
+                handle = SubscriptionHandle(next(self._ws_handle_ids), stream_destination_key, epic, data_type, resolution, bar_type)
+                sub_info["listeners"][handle.handle_id] = callback
+                if conflate:
+                    sub_info["conflated_handles"].add(handle.handle_id)
+                _refresh_listener_callbacks(stream_destination_key, sub_info)
+                handles.append(handle)
+            self._ws_rebuild_routes()
+        return handles, new_subscriptions
+
     def subscribe_to_epic_data(self,
                                epic: str,
                                data_type: WebsocketDataType,
                                callback: Callable[[Dict[str, Any]], None],
                                resolution: Optional[HistoricalPriceResolution] = None,
-                               bar_type: OhlcBarType = OhlcBarType.CLASSIC):
-        if not self.cst or not self.x_security_token:
-            logger.error(f"Cannot subscribe to {epic} ({data_type.value}): API not logged in (CST/XST missing). Please login first.")
+                               bar_type: OhlcBarType = OhlcBarType.CLASSIC,
+                               conflate: bool = False) -> Optional[SubscriptionHandle]:
+        """
+        Subscribes callback to live data for an epic and returns a handle for unsubscribe(handle).
+        Several callbacks may listen to the same stream; each parsed payload is fanned out to all of them
+        and the server subscription is shared.
+        With conflate=True (MARKET only) the callback runs on a dispatcher thread and only ever sees
+        the newest pending quote; quotes that arrive while an earlier one is still waiting replace it
+        and are counted in get_ws_dispatch_stats(). Conflation applies to this listener only: other
+        listeners on the same epic still receive every quote.
+        """
+        handles = self.subscribe_many([epic], data_type, callback, resolution=resolution, bar_type=bar_type, conflate=conflate)
+        return handles[0] if handles else None
+
+    def subscribe_many(self,
+                       epics: List[str],
+                       data_type: WebsocketDataType,
+                       callback: Callable[[Dict[str, Any]], None],
+                       resolution: Optional[HistoricalPriceResolution] = None,
+                       bar_type: OhlcBarType = OhlcBarType.CLASSIC,
+                       conflate: bool = False) -> List[SubscriptionHandle]:
+        """
+        Subscribes several epics to the same stream type with one callback and returns one handle per epic.
+        The server is sent one control message per WS_MAX_EPICS_PER_SUBSCRIPTION epics instead of
+        one per epic, and only for streams that had no listener yet.
+        """
+        if not self.offline and (not self.cst or not self.x_security_token):
+            logger.error(f"Cannot subscribe to {','.join(epics)} ({data_type.value}): API not logged in (CST/XST missing). Please login first.")
 
-            return
+            return []
+        if data_type == WebsocketDataType.OHLC and resolution is None:
+            raise ValueError("Resolution must be provided for OHLC data type subscription.")
 
-        stream_destination_key: str 
-        control_destination_api: str 
-        payload_data: Dict[str, Any] = {"epics": [epic]}
+        handles, new_subscriptions = self._ws_register_subscriptions(epics, data_type, callback, resolution, bar_type, conflate)
+        logger.info(f"Listeners added to {len(handles)} {data_type.value} stream(s), {len(new_subscriptions)} of them new.")
 
-        if data_type == WebsocketDataType.MARKET:
-            stream_destination_key = f"/market/{epic}"
-            control_destination_api = "marketData.subscribe"
-        elif data_type == WebsocketDataType.OHLC:
-            if resolution is None:
-                raise ValueError("Resolution must be provided for OHLC data type subscription.")
-            stream_destination_key = f"/ohlc/{epic}/{resolution.value}/{bar_type.value}"
-            control_destination_api = "OHLCMarketData.subscribe" 
-            payload_data["resolutions"] = [resolution.value]     
-            payload_data["type"] = bar_type.value                
-        else:
-            raise ValueError(f"Unsupported WebSocket data_type: {data_type}")
-
-        with self._ws_lock:
-            if stream_destination_key in self._ws_subscriptions and self._ws_subscriptions[stream_destination_key]["active"]:
-                logger.warning(f"Already subscribed or subscription pending for {stream_destination_key}. Updating callback if different.")
-            self._ws_subscriptions[stream_destination_key] = {
-                "callback": callback,
-                "epic": epic,
-                "data_type": data_type,
-                "resolution": resolution, 
-                "bar_type": bar_type,     
-                "active": True            
-            }
-        logger.info(f"Subscription for {stream_destination_key} queued/updated.")
+        self._ws_send_new_subscriptions(new_subscriptions)
+        return handles
 
+    def _ws_send_new_subscriptions(self, new_subscriptions: List[Dict[str, Any]]):
+        """Makes sure the WebSocket thread runs and subscribes newly created streams on the server."""
+        if self.offline:
+            return
         if not self._start_websocket_thread(): 
-            logger.error(f"WebSocket thread could not be started. Subscription to {stream_destination_key} is queued but won't be sent yet.")
+            logger.error("WebSocket thread could not be started. Subscriptions are queued but won't be sent yet.")
             return
 
+        if not new_subscriptions:
+            return
         if self.ws_status == WebSocketStatus.CONNECTED and self.ws_connection:
-            correlation_id = f"sub-{epic}-{data_type.value}-{resolution.value if resolution else ''}-{bar_type.value if data_type == WebsocketDataType.OHLC else ''}-{int(time.time())}"
-            subscribe_msg = {
-                "destination": control_destination_api,
-                "correlationId": correlation_id,
-                "cst": self.cst,
-                "securityToken": self.x_security_token,
-                "payload": payload_data
-            }
-            try:
-                logger.info(f"Sending subscription request for {stream_destination_key} (API Dest: {control_destination_api}, Payload: {payload_data})")
-                self.ws_connection.send(json.dumps(subscribe_msg))
-            except Exception as e: 
-                logger.error(f"Failed to send subscription message for {stream_destination_key} (WS might be closing/connected): {e}. It may be picked up by reconnect/on_open logic if WS restarts.")
+            messages = self._ws_build_control_messages(new_subscriptions, subscribe=True, correlation_prefix="sub")
+            self._ws_send_control_messages(self.ws_connection, messages)
         elif self.ws_status == WebSocketStatus.CONNECTING:
-            logger.info(f"WebSocket is currently connecting. Subscription for {stream_destination_key} is queued and will be handled by on_open handler upon connection.")
+            logger.info("WebSocket is currently connecting. Subscriptions are queued and will be handled by on_open handler upon connection.")
         else: 
-             logger.warning(f"WebSocket status is {self.ws_status}. Subscription for {stream_destination_key} is queued. Ensure WebSocket connects/restarts for it to be processed.")
+             logger.warning(f"WebSocket status is {self.ws_status}. Subscriptions are queued. Ensure WebSocket connects/restarts for them to be processed.")
+
+    def enable_tick_buffer(self, epic: str, capacity: int = 10000) -> TickRingBuffer:
+        """
+        Keeps the last `capacity` MARKET quotes of epic in a TickRingBuffer, filled by the WebSocket
+        dispatcher before any callbacks run. Subscribes to the epic's quote stream if needed.
+        Returns the existing buffer if one is already enabled.
+        """
+        stream_destination_key = self._ws_stream_key(epic, WebsocketDataType.MARKET)
+        _, new_subscriptions = self._ws_register_subscriptions([epic], WebsocketDataType.MARKET, None)
+        with self._ws_lock:
+            sub_info = self._ws_subscriptions[stream_destination_key]
+            if sub_info["tick_buffer"] is None:
+                sub_info["tick_buffer"] = TickRingBuffer(epic, capacity)
+                logger.info(f"Tick buffer enabled for {epic} (capacity {capacity}).")
+            tick_buffer = sub_info["tick_buffer"]
+
+        if self.cst and self.x_security_token:
+            self._ws_send_new_subscriptions(new_subscriptions)
+        elif new_subscriptions:
+            logger.warning(f"Tick buffer for {epic} registered locally, but the API is not logged in; the quote subscription is not sent yet.")
+        return tick_buffer
+
+    def attach_tick_recorder(self, recorder: "TickRecorder"):
+        """Records every incoming 'quote' / 'ohlc.event' payload (subscribed or not) with recorder, starting its writer."""
+        recorder.start()
+        self._ws_recorder = recorder
+
+    def detach_tick_recorder(self, stop: bool = True) -> Optional["TickRecorder"]:
+        """Stops recording; with stop=True the recorder's queue is written out and its file closed."""
+        recorder, self._ws_recorder = self._ws_recorder, None
+        if recorder is not None and stop:
+            recorder.stop()
+        return recorder
+
+    def enable_stream_watchdog(self, **options: Any) -> "StreamWatchdog":
+        """
+        Starts a StreamWatchdog (options are passed to it) that resubscribes streams which went silent
+        while their market is open. Enable the market details cache to give it market hours.
+        """
+        self.disable_stream_watchdog()
+        self.stream_watchdog = StreamWatchdog(self, **options)
+        self.stream_watchdog.start()
+        return self.stream_watchdog
+
+    def disable_stream_watchdog(self):
+        watchdog, self.stream_watchdog = self.stream_watchdog, None
+        if watchdog is not None:
+            watchdog.stop()
+
+    def get_stream_staleness(self) -> Dict[str, Any]:
+        """Per-stream silence, thresholds and market state plus resubscribe/reconnect counters of the watchdog."""
+        return self.stream_watchdog.stats() if self.stream_watchdog else {}
+
+    def _ws_resubscribe_stream(self, stream_key: str) -> bool:
+        """Sends unsubscribe + subscribe for one stream on the live connection, leaving its listeners untouched."""
+        with self._ws_lock:
+            sub_info = self._ws_subscriptions.get(stream_key)
+        ws = self.ws_connection
+        if sub_info is None or ws is None or self.ws_status != WebSocketStatus.CONNECTED:
+            return False
+        messages = self._ws_build_control_messages([sub_info], subscribe=False, correlation_prefix="resub-unsub")
+        messages += self._ws_build_control_messages([sub_info], subscribe=True, correlation_prefix="resub")
+        sub_info["subscribed_at"] = time.monotonic()
+        return self._ws_send_control_messages(ws, messages) == len(messages)
+
+    def _ws_force_reconnect(self):
+        """Closes the current connection; _ws_run reconnects and resubscribes everything."""
+        ws = self.ws_connection
+        if ws is not None:
+            logger.warning("Forcing WebSocket reconnect.")
+            try:
+                ws.close()
+            except Exception as e:
+                logger.warning(f"Exception while closing WebSocket for reconnect: {e}")
+
+    def subscribe_bar_aggregator(self, aggregator: OhlcBarAggregator, epics: List[str]) -> List[SubscriptionHandle]:
+        """Feeds the MARKET quotes of epics into a local OhlcBarAggregator (one quote stream per epic serves all its intervals)."""
+        return self.subscribe_many(epics, WebsocketDataType.MARKET, aggregator.on_quote)
+
+    def get_tick_buffer(self, epic: str) -> Optional[TickRingBuffer]:
+        sub_info = self._ws_routes.get(("quote", epic))
+        return sub_info["tick_buffer"] if sub_info else None
+
+    def disable_tick_buffer(self, epic: str):
+        """Drops the tick buffer of epic, and the quote subscription too if no listener uses it."""
+        stream_destination_key = self._ws_stream_key(epic, WebsocketDataType.MARKET)
+        removed: List[Dict[str, Any]] = []
+        with self._ws_lock:
+            sub_info = self._ws_subscriptions.get(stream_destination_key)
+            if sub_info is None or sub_info["tick_buffer"] is None:
+                logger.warning(f"No tick buffer enabled for {epic}.")
+                return
+            sub_info["tick_buffer"] = None
+            if not sub_info["listeners"]:
+                del self._ws_subscriptions[stream_destination_key]
+                removed.append(sub_info)
+            self._ws_rebuild_routes()
+        self._ws_finish_unsubscribe(removed)
+
+    def unsubscribe(self, handles: Union[SubscriptionHandle, List[SubscriptionHandle]]):
+        """
+        Detaches listeners returned by subscribe_to_epic_data/subscribe_many. A stream's server
+        subscription is only dropped once its last listener has been removed.
+        """
+        if isinstance(handles, SubscriptionHandle):
+            handles = [handles]
+        removed: List[Dict[str, Any]] = []
+        with self._ws_lock:
+            for handle in handles:
+                sub_info = self._ws_subscriptions.get(handle.stream_key)
+                if sub_info is None or sub_info["listeners"].pop(handle.handle_id, None) is None:
+                    logger.warning(f"Listener {handle} is not subscribed (already removed?).")
+                    continue
+                sub_info["conflated_handles"].discard(handle.handle_id)
+                _refresh_listener_callbacks(handle.stream_key, sub_info)
+                if sub_info["listeners"] or sub_info["tick_buffer"] is not None:
+                    logger.info(f"Removed listener from {handle.stream_key}; {len(sub_info['listeners'])} listener(s) remain.")
+                else:
+                    del self._ws_subscriptions[handle.stream_key]
+                    removed.append(sub_info)
+            self._ws_rebuild_routes()
+        self._ws_finish_unsubscribe(removed)
 
     def unsubscribe_from_epic_data(self,
                                    epic: str,
                                    data_type: WebsocketDataType,
                                    resolution: Optional[HistoricalPriceResolution] = None,
                                    bar_type: OhlcBarType = OhlcBarType.CLASSIC):
-        stream_destination_key: str
-        control_destination_api: str
-        unsubscribe_payload: Dict[str, Any] = {"epics": [epic]} 
+        self.unsubscribe_many([epic], data_type, resolution=resolution, bar_type=bar_type)
 
-        if data_type == WebsocketDataType.MARKET:
-            stream_destination_key = f"/market/{epic}"
-            control_destination_api = "marketData.unsubscribe"
-        elif data_type == WebsocketDataType.OHLC:
-            if resolution is None:
-                raise ValueError("Resolution must be provided for OHLC data type unsubscription to identify the correct stream.")
-            stream_destination_key = f"/ohlc/{epic}/{resolution.value}/{bar_type.value}"
-            control_destination_api = "OHLCMarketData.unsubscribe" 
-
-            unsubscribe_payload["resolutions"] = [resolution.value]
-            unsubscribe_payload["types"] = [bar_type.value]
-
-        else:
-            raise ValueError(f"Unsupported WebSocket data_type: {data_type}")
+    def unsubscribe_many(self,
+                         epics: List[str],
+                         data_type: WebsocketDataType,
+                         resolution: Optional[HistoricalPriceResolution] = None,
+                         bar_type: OhlcBarType = OhlcBarType.CLASSIC):
+        """
+        Unsubscribes several epics of the same stream type, detaching all of their listeners,
+        using batched control messages. Use unsubscribe(handle) to remove a single listener.
+        """
+        if data_type == WebsocketDataType.OHLC and resolution is None:
+            raise ValueError("Resolution must be provided for OHLC data type unsubscription to identify the correct stream.")
 
-        sub_info_popped = None
+        removed: List[Dict[str, Any]] = []
         with self._ws_lock:
+            for epic in epics:
+                stream_destination_key = self._ws_stream_key(epic, data_type, resolution, bar_type)
+                sub_info_popped = self._ws_subscriptions.pop(stream_destination_key, None)
+                if sub_info_popped:
+                    removed.append(sub_info_popped)
+                else:
+                    logger.warning(f"No active subscription found locally for {stream_destination_key} to unsubscribe.")
+            self._ws_rebuild_routes()
 
-            sub_info_popped = self._ws_subscriptions.pop(stream_destination_key, None)
+        self._ws_finish_unsubscribe(removed)
 
-        if sub_info_popped:
-            logger.info(f"Locally removed/marked inactive subscription tracking for {stream_destination_key}.")
+    def _ws_finish_unsubscribe(self, removed: List[Dict[str, Any]]):
+        """Sends server unsubscribes for streams already removed locally and stops the WebSocket when none remain."""
+        if removed:
+            logger.info(f"Locally removed subscription tracking for {len(removed)} stream(s).")
 
             if self.ws_status == WebSocketStatus.CONNECTED and self.ws_connection and self.cst and self.x_security_token:
-                correlation_id = f"unsub-{epic}-{data_type.value}-{resolution.value if resolution else ''}-{bar_type.value if data_type == WebsocketDataType.OHLC else ''}-{int(time.time())}"
-                unsubscribe_msg = {
-                    "destination": control_destination_api,
-                    "correlationId": correlation_id,
-                    "cst": self.cst,
-                    "securityToken": self.x_security_token,
-                    "payload": unsubscribe_payload
-                }
-                try:
-                    logger.info(f"Sending unsubscribe request for {stream_destination_key} (API Dest: {control_destination_api}, Payload: {unsubscribe_payload}) to server.")
-                    self.ws_connection.send(json.dumps(unsubscribe_msg))
-                except Exception as e:
-                    logger.error(f"Failed to send unsubscribe message for {stream_destination_key} to server: {e}")
+                messages = self._ws_build_control_messages(removed, subscribe=False, correlation_prefix="unsub")
+                self._ws_send_control_messages(self.ws_connection, messages)
             else:
-                logger.info(f"Unsubscribed {stream_destination_key} locally. WebSocket not in a state to send server message (Status: {self.ws_status}, Tokens Present: {bool(self.cst and self.x_security_token)}).")
-        else:
-            logger.warning(f"No active subscription found locally for {stream_destination_key} to unsubscribe.")
+                logger.info(f"Unsubscribed locally. WebSocket not in a state to send server message (Status: {self.ws_status}, Tokens Present: {bool(self.cst and self.x_security_token)}).")
 
         with self._ws_lock:
             no_active_subscriptions = not bool(self._ws_subscriptions)
@@ -1165,64 +2776,25 @@ class CapitalComAPI:
     def stop_all_websocket_subscriptions(self):
         logger.info("Stopping all WebSocket subscriptions and initiating WebSocket thread shutdown...")
 
-        destinations_to_unsubscribe_server: List[Dict[str, Any]] = []
         with self._ws_lock:
-            if not self._ws_subscriptions:
+            subscriptions_to_unsubscribe = list(self._ws_subscriptions.values())
+            if not subscriptions_to_unsubscribe:
                 logger.info("No local WebSocket subscriptions to clear or send unsubscribe messages for.")
             else:
-                for stream_dest, sub_info in self._ws_subscriptions.items():
-
-                    destinations_to_unsubscribe_server.append({
-                        "stream_destination_key": stream_dest, 
-                        "epic": sub_info["epic"],
-                        "data_type": sub_info["data_type"],
-                        "resolution": sub_info.get("resolution"), 
-                        "bar_type": sub_info.get("bar_type")      
-                    })
                 self._ws_subscriptions.clear() 
-                logger.debug(f"Cleared all {len(destinations_to_unsubscribe_server)} local WebSocket subscription tracking entries.")
+                self._ws_rebuild_routes()
+                logger.debug(f"Cleared all {len(subscriptions_to_unsubscribe)} local WebSocket subscription tracking entries.")
 
         if self.ws_status == WebSocketStatus.CONNECTED and self.ws_connection and self.cst and self.x_security_token:
-            if destinations_to_unsubscribe_server:
-                logger.info(f"Sending server unsubscribe messages for {len(destinations_to_unsubscribe_server)} streams.")
-                for item in destinations_to_unsubscribe_server:
-                    epic = item["epic"]
-                    data_type: WebsocketDataType = item["data_type"]
-                    unsubscribe_payload = {"epics": [epic]}
-                    control_dest_api: str
-
-                    if data_type == WebsocketDataType.MARKET:
-                        control_dest_api = "marketData.unsubscribe"
-                    elif data_type == WebsocketDataType.OHLC:
-                        control_dest_api = "OHLCMarketData.unsubscribe"
-                        resolution: Optional[HistoricalPriceResolution] = item.get("resolution")
-                        bar_type: Optional[OhlcBarType] = item.get("bar_type")
-                        if resolution and bar_type: 
-                            unsubscribe_payload["resolutions"] = [resolution.value]
-                            unsubscribe_payload["types"] = [bar_type.value]
-                        else: 
-                            logger.warning(f"OHLC resolution/type missing for {epic} during stop_all; sending generic epic unsubscribe.")
-                    else:
-                        logger.warning(f"Unknown data_type {data_type} for epic {epic} during stop_all server unsubscribe. Skipping.")
-                        continue
-
-                    unsubscribe_msg = {
-                        "destination": control_dest_api,
-                        "correlationId": f"unsub-all-{epic}-{data_type.value}-{int(time.time())}",
-                        "cst": self.cst,
-                        "securityToken": self.x_security_token,
-                        "payload": unsubscribe_payload
-                    }
-                    try:
-                        self.ws_connection.send(json.dumps(unsubscribe_msg))
-                        logger.debug(f"Sent server unsubscribe for {item['stream_destination_key']} (API Dest: {control_dest_api}, Epic: {epic}, Payload: {unsubscribe_payload})")
-                    except Exception as e:
-                        logger.warning(f"Failed to send server unsubscribe for {item['stream_destination_key']} during stop_all: {e}")
+            if subscriptions_to_unsubscribe:
+                messages = self._ws_build_control_messages(subscriptions_to_unsubscribe, subscribe=False, correlation_prefix="unsub-all")
+                logger.info(f"Sending {len(messages)} batched server unsubscribe messages for {len(subscriptions_to_unsubscribe)} streams.")
+                self._ws_send_control_messages(self.ws_connection, messages)
             else:
                 logger.info("No subscriptions were active to send unsubscribe messages for during stop_all.")
         else:
-            if destinations_to_unsubscribe_server: 
-                logger.info(f"WebSocket not connected or tokens missing; server unsubscribe messages for {len(destinations_to_unsubscribe_server)} streams not sent during stop_all. Local subscriptions cleared.")
+            if subscriptions_to_unsubscribe: 
+                logger.info(f"WebSocket not connected or tokens missing; server unsubscribe messages for {len(subscriptions_to_unsubscribe)} streams not sent during stop_all. Local subscriptions cleared.")
 
         self._stop_websocket_thread() 
         logger.info("All WebSocket subscriptions processed for stopping, and WebSocket thread shutdown initiated/confirmed.")
@@ -1236,4 +2808,1741 @@ class CapitalComAPI:
     def __exit__(self, exc_type, exc_val, exc_tb):
         logger.info("Exiting context manager, ensuring logout and WebSocket shutdown...")
         self.logout() 
-        logger.info("Context manager exited.")
\ No newline at end of file
+        logger.info("Context manager exited.")
+
+
+class _WebsocketShard(CapitalComAPI):
+    """
+    One WebSocket connection of a ShardedWebsocketManager. It uses the HTTP session and reads and
+    refreshes the session tokens of the parent client instead of opening a session of its own.
+    """
+    def __init__(self, parent: CapitalComAPI, index: int):
+        self._parent = parent
+        self.index = index
+        super().__init__(parent.api_key, parent.identifier, parent.password, parent.environment,
+                         rate_limiter=parent.rate_limiter, rate_limit=parent.rate_limiter is not None,
+                         ws_dispatch_mode=parent.ws_dispatch_mode, ws_dispatch_workers=parent._ws_dispatch_workers)
+
+    @property
+    def cst(self) -> Optional[str]:
+        return self._parent.cst
+
+    @cst.setter
+    def cst(self, value: Optional[str]):
+        if value is not None:
+            self._parent.cst = value
+
+    @property
+    def x_security_token(self) -> Optional[str]:
+        return self._parent.x_security_token
+
+    @x_security_token.setter
+    def x_security_token(self, value: Optional[str]):
+        if value is not None:
+            self._parent.x_security_token = value
+
+    def _new_http_session(self) -> requests.Session:
+        return self._parent.session
+
+    def login(self) -> bool:
+        logged_in = self._parent.login()
+        self._last_login_status_code = self._parent._last_login_status_code
+        return logged_in
+
+    def _relogin(self, stale_cst: Optional[str]) -> bool:
+        return self._parent._relogin(stale_cst)
+
+
+class ShardedWebsocketManager:
+    """
+    Spreads WebSocket subscriptions over up to max_connections connections ("shards") of one logged-in
+    CapitalComAPI, each holding at most max_streams_per_connection streams and running its own
+    _ws_run reconnect loop. subscribe()/unsubscribe() mirror subscribe_many()/unsubscribe() across all
+    shards. A monitor thread moves the streams of a shard whose connection was lost (down for longer
+    than lost_after_seconds) to the least loaded healthy shards; listener handles stay valid across
+    such moves.
+    """
+    def __init__(self, api: CapitalComAPI, max_connections: int = 10,
+                 max_streams_per_connection: int = CapitalComAPI.WS_MAX_STREAMS_PER_CONNECTION, monitor_interval: float = 5.0,
+                 lost_after_seconds: float = 15.0):
+        if max_connections < 1 or max_streams_per_connection < 1:
+            raise ValueError("max_connections and max_streams_per_connection must be at least 1.")
+        self.api = api
+        self.max_connections = max_connections
+        self.max_streams_per_connection = max_streams_per_connection
+        self.monitor_interval = monitor_interval
+        self.lost_after_seconds = lost_after_seconds
+        self._shards: List[_WebsocketShard] = []
+        self._streams: Dict[str, Dict[str, Any]] = {}
+        # Copy-on-write: route key (as in CapitalComAPI._ws_routes) -> stream entry; replaced, never mutated.
+        self._routes: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        self._handle_ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._monitor_thread: Optional[threading.Thread] = None
+        self.migrations = 0
+
+    def subscribe(self, epics: List[str], data_type: WebsocketDataType, callback: Callable[[Dict[str, Any]], None],
+                  resolution: Optional[HistoricalPriceResolution] = None, bar_type: OhlcBarType = OhlcBarType.CLASSIC,
+                  conflate: bool = False) -> List[SubscriptionHandle]:
+        """
+        Adds callback as a listener on each epic's stream; new streams go to the least loaded shards.
+        Unlike subscribe_many, conflate applies to the whole stream, so it must match the setting of
+        the stream's existing listeners (ValueError otherwise).
+        """
+        if data_type == WebsocketDataType.OHLC and resolution is None:
+            raise ValueError("Resolution must be provided for OHLC data type subscription.")
+        handles: List[SubscriptionHandle] = []
+        new_streams: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            mixed = [epic for epic in epics if self._streams.get(self.api._ws_stream_key(epic, data_type, resolution, bar_type),
+                                                                 {}).get("conflate", conflate) != conflate]
+            if mixed:
+                raise ValueError(f"Streams for {mixed} already exist with conflate={not conflate}; "
+                                 f"sharded streams use one conflation setting for all their listeners.")
+            for epic in epics:
+                stream_key = self.api._ws_stream_key(epic, data_type, resolution, bar_type)
+                if stream_key not in self._streams and stream_key not in new_streams:
+                    new_streams[stream_key] = {
+                        "stream_key": stream_key, "epic": epic, "data_type": data_type, "resolution": resolution,
+                        "bar_type": bar_type, "conflate": conflate, "listeners": OrderedDict(),
+                        "callback": None, "shard": None, "shard_handle": None,
+                    }
+            self._assign(list(new_streams.values()))
+            self._streams.update(new_streams)
+            for epic in epics:
+                stream_key = self.api._ws_stream_key(epic, data_type, resolution, bar_type)
+                stream = self._streams[stream_key]
+                handle = SubscriptionHandle(next(self._handle_ids), stream_key, epic, data_type, resolution, bar_type)
+                stream["listeners"][handle.handle_id] = callback
+                stream["callback"] = _fan_out_callback(stream_key, tuple(stream["listeners"].values()))
+                handles.append(handle)
+            self._rebuild_routes()
+            self._subscribe_on_shards(list(new_streams.values()))
+        self._start_monitor()
+        return handles
+
+    def unsubscribe(self, handles: Union[SubscriptionHandle, List[SubscriptionHandle]]):
+        """Removes listeners; a stream is unsubscribed on its shard once its last listener is gone."""
+        if isinstance(handles, SubscriptionHandle):
+            handles = [handles]
+        released: List[Tuple[_WebsocketShard, SubscriptionHandle]] = []
+        with self._lock:
+            for handle in handles:
+                stream = self._streams.get(handle.stream_key)
+                if stream is None or stream["listeners"].pop(handle.handle_id, None) is None:
+                    logger.warning(f"Listener {handle} is not subscribed (already removed?).")
+                    continue
+                if stream["listeners"]:
+                    stream["callback"] = _fan_out_callback(stream["stream_key"], tuple(stream["listeners"].values()))
+                    continue
+                del self._streams[stream["stream_key"]]
+                if stream["shard_handle"] is not None:
+                    released.append((self._shards[stream["shard"]], stream["shard_handle"]))
+            self._rebuild_routes()
+        # The last unsubscribe on a shard joins its thread; keep that off the lock like rebalance() does.
+        for shard, shard_handle in released:
+            shard.unsubscribe(shard_handle)
+
+    def stop(self):
+        """Stops the monitor and closes every shard connection."""
+        self._stop_event.set()
+        if self._monitor_thread:
+            self._monitor_thread.join(timeout=self.monitor_interval + 5)
+            self._monitor_thread = None
+        with self._lock:
+            shards, self._shards = self._shards, []
+            self._streams.clear()
+            self._rebuild_routes()
+        for shard in shards:
+            shard.stop_all_websocket_subscriptions()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "streams": len(self._streams),
+                "migrations": self.migrations,
+                "shards": [{"index": shard.index, "status": shard.ws_status.value,
+                            "streams": self._load(shard.index)} for shard in self._shards],
+            }
+
+    def _dispatch(self, payload: Dict[str, Any]):
+        """The single callback every shard stream is registered with; routes to the stream's listeners."""
+        if "resolution" in payload:
+            route_key = ("ohlc.event", payload.get("epic"), payload.get("resolution"), payload.get("type", "classic"))
+        else:
+            route_key = ("quote", payload.get("epic"))
+        stream = self._routes.get(route_key)
+        if stream is not None:
+            stream["callback"](payload)
+
+    def _rebuild_routes(self):
+        self._routes = {CapitalComAPI._ws_route_key(stream): stream for stream in self._streams.values()}
+
+    def _load(self, index: int) -> int:
+        return sum(1 for stream in self._streams.values() if stream["shard"] == index)
+
+    def _pick_shard(self, loads: Dict[int, int]) -> int:
+        # An idle shard whose thread has ended is fine: subscribing restarts its connection.
+        candidates = [index for index, load in loads.items()
+                      if load < self.max_streams_per_connection and (load == 0 or not self._is_lost(self._shards[index]))]
+        if candidates:
+            return min(candidates, key=lambda index: loads[index])
+        if len(self._shards) >= self.max_connections:
+            raise CapitalComAPIError(f"All {self.max_connections} WebSocket connections are full "
+                                     f"({self.max_streams_per_connection} streams each).")
+        index = len(self._shards)
+        self._shards.append(_WebsocketShard(self.api, index))
+        loads[index] = 0
+        logger.info(f"Opened WebSocket shard {index}.")
+        return index
+
+    def _assign(self, streams: List[Dict[str, Any]]):
+        """Picks a shard for each stream; raises before assigning anything if they do not all fit."""
+        loads = {shard.index: self._load(shard.index) for shard in self._shards}
+        picked = []
+        for _ in streams:
+            index = self._pick_shard(loads)
+            loads[index] += 1
+            picked.append(index)
+        for stream, index in zip(streams, picked):
+            stream["shard"] = index
+
+    def _subscribe_on_shards(self, streams: List[Dict[str, Any]]):
+        """Subscribes assigned streams on their shards, batched per shard and stream type."""
+        batches: Dict[Tuple[Any, ...], List[Dict[str, Any]]] = {}
+        for stream in streams:
+            key = (stream["shard"], stream["data_type"], stream["resolution"], stream["bar_type"], stream["conflate"])
+            batches.setdefault(key, []).append(stream)
+        for (index, data_type, resolution, bar_type, conflate), batch in batches.items():
+            shard_handles = self._shards[index].subscribe_many([stream["epic"] for stream in batch], data_type,
+                                                               self._dispatch, resolution, bar_type, conflate)
+            for stream, shard_handle in zip(batch, shard_handles):
+                stream["shard_handle"] = shard_handle
+
+    def _is_lost(self, shard: _WebsocketShard) -> bool:
+        """A shard whose thread has ended, or that has been reconnecting for longer than lost_after_seconds."""
+        # All shards log in with the same credentials, so moving streams off a rejected one can't help.
+        if shard.ws_thread is None or shard.ws_status == WebSocketStatus.AUTH_FAILED:
+            return False
+        if not shard.ws_thread.is_alive():
+            return True
+        if shard.ws_status == WebSocketStatus.CONNECTED:
+            return False
+        policy = shard.ws_reconnect_policy
+        return policy.circuit_open or policy.stats()["current_downtime_seconds"] > self.lost_after_seconds
+
+    def _start_monitor(self):
+        if self._monitor_thread and self._monitor_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._monitor_thread = threading.Thread(target=self._monitor_run, name="CapitalComWSShardMonitor", daemon=True)
+        self._monitor_thread.start()
+
+    def _monitor_run(self):
+        while not self._stop_event.wait(self.monitor_interval):
+            try:
+                self.rebalance()
+            except Exception as e:
+                logger.error(f"Error while rebalancing WebSocket shards: {e}", exc_info=True)
+
+    def rebalance(self) -> int:
+        """
+        Moves the streams of lost shards to healthy ones and replaces each lost shard with a fresh
+        connection. Called periodically by the monitor. Returns the number of streams moved.
+        """
+        moved = 0
+        replaced: List[_WebsocketShard] = []
+        with self._lock:
+            for index, shard in enumerate(self._shards):
+                if not self._is_lost(shard):
+                    continue
+                streams = [stream for stream in self._streams.values() if stream["shard"] == index]
+                self._shards[index] = _WebsocketShard(self.api, index)
+                replaced.append(shard)
+                if not streams:
+                    continue
+                logger.warning(f"WebSocket shard {index} lost its connection; moving {len(streams)} stream(s).")
+                for stream in streams:
+                    stream["shard"] = None
+                    stream["shard_handle"] = None
+                self._assign(streams)
+                self._subscribe_on_shards(streams)
+                moved += len(streams)
+            self.migrations += moved
+        # Joining the old connections' threads can take a while; don't block subscribe() meanwhile.
+        for shard in replaced:
+            shard.stop_all_websocket_subscriptions()
+        return moved
+
+
+_WEEKDAY_KEYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def _market_open_at(details: Optional[Dict[str, Any]], now: datetime) -> Optional[bool]:
+    """
+    Whether a market is open at now (UTC) according to cached market details: a fresh snapshot's
+    marketStatus wins, otherwise the instrument's openingHours ("HH:MM - HH:MM" ranges per weekday,
+    an empty side or an end of 00:00 meaning start/end of day). None when the details do not tell.
+    """
+    if not details:
+        return None
+    status = (details.get("snapshot") or {}).get("marketStatus")
+    if status:
+        return status == "TRADEABLE"
+    opening_hours = (details.get("instrument") or {}).get("openingHours")
+    if not opening_hours or opening_hours.get("zone", "UTC") != "UTC":
+        return None
+    minute = now.hour * 60 + now.minute
+    for period in opening_hours.get(_WEEKDAY_KEYS[now.weekday()]) or []:
+        start, _, end = str(period).partition("-")
+        start, end = start.strip(), end.strip()
+        try:
+            start_minute = int(start[:2]) * 60 + int(start[3:5]) if start else 0
+            end_minute = int(end[:2]) * 60 + int(end[3:5]) if end else 24 * 60
+        except ValueError:
+            logger.debug(f"Unparseable opening hours period {period!r}; market state unknown.")
+            return None
+        if end_minute == 0:
+            end_minute = 24 * 60  # "22:05 - 00:00" runs until midnight
+        if start_minute <= minute <= end_minute:
+            return True
+    return False
+
+
+class StreamWatchdog:
+    """
+    Watches every active WebSocket stream for silence while the socket itself stays up. A stream is
+    stale once it has been quiet for stale_after_factor times its expected tick interval (per epic
+    override, else per instrument type, else default_interval_seconds) and at least
+    min_silence_seconds, while its market is open according to the market details cache (streams of
+    epics without cached details are assumed open). Stale streams are resubscribed one by one; if
+    resubscribing does not help after max_resubscribes tries, or at least reconnect_fraction of the
+    streams are stale at once, the connection is closed so _ws_run reconnects it.
+    """
+    DEFAULT_INTERVALS_BY_INSTRUMENT_TYPE = {
+        "CURRENCIES": 5.0,
+        "CRYPTOCURRENCIES": 5.0,
+        "INDICES": 5.0,
+        "COMMODITIES": 10.0,
+        "SHARES": 30.0,
+    }
+
+    def __init__(self, api: CapitalComAPI, check_interval: float = 5.0, stale_after_factor: float = 6.0,
+                 min_silence_seconds: float = 10.0, default_interval_seconds: float = 30.0,
+                 expected_intervals: Optional[Dict[str, float]] = None,
+                 intervals_by_instrument_type: Optional[Dict[str, float]] = None,
+                 resubscribe_cooldown_seconds: float = 30.0, max_resubscribes: int = 2,
+                 reconnect_fraction: float = 0.5, reconnect_cooldown_seconds: float = 120.0):
+        self.api = api
+        self.check_interval = check_interval
+        self.stale_after_factor = stale_after_factor
+        self.min_silence_seconds = min_silence_seconds
+        self.default_interval_seconds = default_interval_seconds
+        self.expected_intervals = dict(expected_intervals or {})
+        self.intervals_by_instrument_type = dict(self.DEFAULT_INTERVALS_BY_INSTRUMENT_TYPE)
+        self.intervals_by_instrument_type.update(intervals_by_instrument_type or {})
+        self.resubscribe_cooldown_seconds = resubscribe_cooldown_seconds
+        self.max_resubscribes = max_resubscribes
+        self.reconnect_fraction = reconnect_fraction
+        self.reconnect_cooldown_seconds = reconnect_cooldown_seconds
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_reconnect: Optional[float] = None
+        self._streams: Dict[str, Dict[str, Any]] = {}
+        self.resubscribes = 0
+        self.reconnects = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="CapitalComWSWatchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.check_interval + 5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Error in WebSocket stream watchdog: {e}", exc_info=True)
+
+    def expected_interval(self, epic: str, details: Optional[Dict[str, Any]]) -> float:
+        if epic in self.expected_intervals:
+            return self.expected_intervals[epic]
+        instrument_type = ((details or {}).get("instrument") or {}).get("type")
+        return self.intervals_by_instrument_type.get(instrument_type, self.default_interval_seconds)
+
+    def check(self) -> List[str]:
+        """Runs one pass; returns the stream keys found stale. Does nothing unless the socket is connected."""
+        api = self.api
+        if api.ws_status != WebSocketStatus.CONNECTED or api._ws_connected_at is None:
+            return []
+        now = time.monotonic()
+        now_utc = datetime.now(timezone.utc)
+        cache = api.market_details_cache
+        with api._ws_lock:
+            subscriptions = [(key, sub_info) for key, sub_info in api._ws_subscriptions.items() if sub_info["active"]]
+
+        watched: Dict[str, Dict[str, Any]] = {}
+        stale: List[str] = []
+        for stream_key, sub_info in subscriptions:
+            details = cache.get(sub_info["epic"], require_snapshot=False) if cache else None
+            previous = self._streams.get(stream_key, {})
+            state = {
+                "epic": sub_info["epic"],
+                "resubscribes": previous.get("resubscribes", 0),
+                "resubscribed_at": previous.get("resubscribed_at"),
+                "market_open": _market_open_at(details, now_utc),
+            }
+            last_message_at = sub_info["last_message_at"]
+            since = max(last_message_at or 0.0, sub_info["subscribed_at"], api._ws_connected_at)
+            state["silence_seconds"] = now - since
+            state["last_message_age_seconds"] = now - last_message_at if last_message_at is not None else None
+            state["threshold_seconds"] = max(self.min_silence_seconds,
+                                             self.stale_after_factor * self.expected_interval(sub_info["epic"], details))
+            if last_message_at is not None and state["resubscribed_at"] is not None and last_message_at > state["resubscribed_at"]:
+                state["resubscribes"] = 0
+            state["stale"] = state["market_open"] is not False and state["silence_seconds"] > state["threshold_seconds"]
+            if state["stale"]:
+                stale.append(stream_key)
+            watched[stream_key] = state
+        self._streams = watched
+        if not stale:
+            return stale
+
+        open_streams = sum(1 for state in watched.values() if state["market_open"] is not False)
+        exhausted = [key for key in stale if watched[key]["resubscribes"] >= self.max_resubscribes]
+        widespread = len(stale) >= 2 and len(stale) >= self.reconnect_fraction * open_streams
+        if (exhausted or widespread) and (self._last_reconnect is None or now - self._last_reconnect >= self.reconnect_cooldown_seconds):
+            logger.warning(f"Watchdog: {len(stale)} of {open_streams} streams silent; forcing a WebSocket reconnect.")
+            self._last_reconnect = now
+            self.reconnects += 1
+            for key in stale:
+                watched[key]["resubscribes"] = 0
+                watched[key]["resubscribed_at"] = now
+            api._ws_force_reconnect()
+            return stale
+
+        for key in stale:
+            state = watched[key]
+            if state["resubscribed_at"] is not None and now - state["resubscribed_at"] < self.resubscribe_cooldown_seconds:
+                continue
+            logger.warning(f"Watchdog: {key} silent for {state['silence_seconds']:.1f}s "
+                           f"(threshold {state['threshold_seconds']:.1f}s); resubscribing.")
+            if api._ws_resubscribe_stream(key):
+                state["resubscribes"] += 1
+                state["resubscribed_at"] = now
+                self.resubscribes += 1
+        return stale
+
+    def stats(self) -> Dict[str, Any]:
+        streams = self._streams
+        return {
+            "streams": {key: dict(state) for key, state in streams.items()},
+            "stale": [key for key, state in streams.items() if state["stale"]],
+            "resubscribes": self.resubscribes,
+            "reconnects": self.reconnects,
+        }
+
+
+def _is_transient_api_error(error: CapitalComAPIError) -> bool:
+    """Network failures (no status), throttling and server errors are worth retrying."""
+    return error.status_code is None or error.status_code == 429 or error.status_code >= 500
+
+
+class DealConfirmationTracker:
+    """
+    Resolves deal references into confirmations without a blocking loop per order. track() returns
+    a Future; one scheduler thread polls confirms/{dealReference} for every in-flight deal through a
+    small worker pool, starting after initial_interval and backing off by backoff_factor up to
+    max_interval. A 404 or a transient error means "not yet". The Future gets the confirmation dict
+    once dealStatus is ACCEPTED or REJECTED, or a CapitalComAPIError after timeout_seconds.
+    """
+    FINAL_DEAL_STATUSES = ("ACCEPTED", "REJECTED")
+
+    def __init__(self, api: CapitalComAPI, max_workers: int = 4, initial_interval: float = 0.05,
+                 max_interval: float = 1.0, backoff_factor: float = 1.5, timeout_seconds: float = 30.0):
+        if initial_interval <= 0 or max_interval < initial_interval or backoff_factor < 1:
+            raise ValueError("Need 0 < initial_interval <= max_interval and backoff_factor >= 1.")
+        self.api = api
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.timeout_seconds = timeout_seconds
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="CapitalComConfirms")
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._schedule: List[Tuple[float, int, str]] = []
+        self._sequence = itertools.count()
+        # Guards _pending, _schedule, each deal's polling state and the counters below.
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._stopped = False
+        self.polls = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name="CapitalComConfirmTracker", daemon=True)
+        self._thread.start()
+
+    def track(self, deal: Union[str, Dict[str, Any]], timeout_seconds: Optional[float] = None) -> Future:
+        """
+        Starts tracking a deal reference (or an open/close/update_trade response containing one).
+        Tracking the same reference twice returns the same Future.
+        """
+        deal_reference = deal.get("dealReference") if isinstance(deal, dict) else deal
+        if not deal_reference:
+            raise ValueError(f"No dealReference to track in {deal!r}.")
+        now = time.monotonic()
+        with self._condition:
+            if self._stopped:
+                raise CapitalComAPIError("Deal confirmation tracker is stopped.")
+            pending = self._pending.get(deal_reference)
+            if pending is not None:
+                return pending["future"]
+            future: Future = Future()
+            self._pending[deal_reference] = {
+                "future": future,
+                "interval": self.initial_interval,
+                "deadline": now + (timeout_seconds if timeout_seconds is not None else self.timeout_seconds),
+                "started": now,
+                "polls": 0,
+            }
+            heapq.heappush(self._schedule, (now + self.initial_interval, next(self._sequence), deal_reference))
+            self._condition.notify()
+        return future
+
+    def wait(self, deal: Union[str, Dict[str, Any]], timeout_seconds: Optional[float] = None) -> Dict[str, Any]:
+        """Tracks a deal and blocks until its confirmation arrives."""
+        return self.track(deal, timeout_seconds).result()
+
+    def stop(self):
+        """Stops polling; Futures still pending fail with CapitalComAPIError."""
+        with self._condition:
+            self._stopped = True
+            pending, self._pending = self._pending, {}
+            self._schedule.clear()
+            self._condition.notify()
+        self._thread.join(timeout=5)
+        self._pool.shutdown(wait=True)
+        for deal_reference, deal in pending.items():
+            if not deal["future"].done():
+                deal["future"].set_exception(CapitalComAPIError(f"Tracking of deal {deal_reference} stopped before it was confirmed."))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"in_flight": len(self._pending), "polls": self.polls, "accepted": self.accepted,
+                    "rejected": self.rejected, "failed": self.failed}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                if not self._schedule:
+                    self._condition.wait()
+                    continue
+                due, _, deal_reference = self._schedule[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._schedule)
+            self._pool.submit(self._poll, deal_reference)
+
+    def _poll(self, deal_reference: str):
+        with self._lock:
+            deal = self._pending.get(deal_reference)
+            if deal is None:
+                return
+            deal["polls"] += 1
+            self.polls += 1
+        try:
+            confirmation = self.api.get_deal_confirmation(deal_reference)
+        except CapitalComAPIError as e:
+            if e.status_code != 404 and not _is_transient_api_error(e):
+                self._finish(deal_reference, error=e)
+                return
+            logger.debug(f"Confirmation for {deal_reference} not available yet ({e.status_code}).")
+            confirmation = None
+        status = (confirmation or {}).get("dealStatus")
+        if status in self.FINAL_DEAL_STATUSES:
+            self._finish(deal_reference, confirmation=confirmation)
+            return
+        now = time.monotonic()
+        with self._condition:
+            if deal_reference not in self._pending:
+                return
+            timed_out = now >= deal["deadline"]
+            if not timed_out:
+                deal["interval"] = min(deal["interval"] * self.backoff_factor, self.max_interval)
+                heapq.heappush(self._schedule, (min(now + deal["interval"], deal["deadline"]), next(self._sequence), deal_reference))
+                self._condition.notify()
+            polls = deal["polls"]
+        if timed_out:
+            self._finish(deal_reference, error=CapitalComAPIError(
+                f"Deal {deal_reference} not confirmed within {deal['deadline'] - deal['started']:.1f}s "
+                f"({polls} polls, last status {status})."))
+
+    def _finish(self, deal_reference: str, confirmation: Optional[Dict[str, Any]] = None,
+                error: Optional[Exception] = None):
+        with self._lock:
+            deal = self._pending.pop(deal_reference, None)
+            if deal is None or deal["future"].done():
+                return
+            if error is not None:
+                self.failed += 1
+            elif confirmation.get("dealStatus") == "ACCEPTED":
+                self.accepted += 1
+            else:
+                self.rejected += 1
+            polls = deal["polls"]
+        if error is not None:
+            logger.error(f"Deal {deal_reference} confirmation failed: {error}")
+            deal["future"].set_exception(error)
+            return
+        logger.info(f"Deal {deal_reference} {confirmation.get('dealStatus')} after {time.monotonic() - deal['started']:.3f}s "
+                    f"({polls} polls), dealId {confirmation.get('dealId')}.")
+        deal["future"].set_result(confirmation)
+
+
+_POSITION_DIFF_FIELDS = ("direction", "size", "level", "stopLevel", "profitLevel", "trailingStop", "guaranteedStop")
+_ORDER_DIFF_FIELDS = ("direction", "orderSize", "orderLevel", "orderType", "stopLevel", "profitLevel", "goodTillDate")
+
+
+class _DealIndex:
+    """Entries keyed by dealId plus an epic -> dealIds index (dicts used as ordered sets)."""
+    __slots__ = ("entries", "by_epic", "epic_of")
+
+    def __init__(self):
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.by_epic: Dict[Optional[str], Dict[str, None]] = {}
+        self.epic_of: Dict[str, Optional[str]] = {}
+
+    def put(self, deal_id: str, epic: Optional[str], entry: Dict[str, Any]):
+        if self.epic_of.get(deal_id, epic) != epic:
+            self._unindex(deal_id)
+        self.entries[deal_id] = entry
+        self.epic_of[deal_id] = epic
+        self.by_epic.setdefault(epic, {})[deal_id] = None
+
+    def pop(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        entry = self.entries.pop(deal_id, None)
+        if entry is not None:
+            self._unindex(deal_id)
+            del self.epic_of[deal_id]
+        return entry
+
+    def for_epic(self, epic: str) -> List[Dict[str, Any]]:
+        return [self.entries[deal_id] for deal_id in self.by_epic.get(epic, ())]
+
+    def _unindex(self, deal_id: str):
+        epic = self.epic_of.get(deal_id)
+        deal_ids = self.by_epic.get(epic)
+        if deal_ids is not None:
+            deal_ids.pop(deal_id, None)
+            if not deal_ids:
+                del self.by_epic[epic]
+
+
+class PositionBook:
+    """
+    Local copy of open positions and working orders, indexed by dealId and by epic for O(1) lookups
+    without HTTP. Seeded from get_open_positions() / get_working_orders(), kept current from deal
+    confirmations (apply_confirmation, or track() for an open/close/update_trade response) and
+    reconciled against the server every reconcile_interval seconds. Entries have the same shape as
+    the API lists ({"position": ..., "market": ...} and {"workingOrderData": ..., "marketData": ...})
+    and must be treated as read-only.
+    """
+    def __init__(self, api: CapitalComAPI, reconcile_interval: Optional[float] = 30.0):
+        self.api = api
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._positions = _DealIndex()
+        self._orders = _DealIndex()
+        # dealId -> time.monotonic() of the last local update, so a reconcile never undoes a newer confirmation.
+        self._touched: Dict[str, float] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_reconciled_at: Optional[float] = None
+        self.last_diff: Dict[str, Dict[str, List[str]]] = {}
+
+    @staticmethod
+    def _position_epic(entry: Dict[str, Any]) -> Optional[str]:
+        return (entry.get("market") or {}).get("epic") or entry["position"].get("epic")
+
+    @staticmethod
+    def _order_epic(entry: Dict[str, Any]) -> Optional[str]:
+        return entry["workingOrderData"].get("epic") or (entry.get("marketData") or {}).get("epic")
+
+    # Lookups (no I/O)
+
+    def get_position(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._positions.entries.get(deal_id)
+
+    def get_order(self, deal_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._orders.entries.get(deal_id)
+
+    def positions_for_epic(self, epic: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._positions.for_epic(epic)
+
+    def orders_for_epic(self, epic: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return self._orders.for_epic(epic)
+
+    def positions(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._positions.entries.values())
+
+    def orders(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._orders.entries.values())
+
+    def epics(self) -> List[str]:
+        with self._lock:
+            return [epic for epic in set(self._positions.by_epic) | set(self._orders.by_epic) if epic]
+
+    # Updates
+
+    def track(self, response: Optional[Dict[str, Any]]) -> Optional[Future]:
+        """Applies the confirmation of an open/close/update_trade response once it arrives (via api.track_deal)."""
+        if not response or not response.get("dealReference"):
+            return None
+        future = self.api.track_deal(response)
+
+        def on_confirmed(done: Future):
+            if done.exception() is None:
+                self.apply_confirmation(done.result())
+            else:
+                logger.warning(f"Position book could not confirm deal {response.get('dealReference')}; next reconcile will catch up.")
+        future.add_done_callback(on_confirmed)
+        return future
+
+    def apply_confirmation(self, confirmation: Dict[str, Any]):
+        """Updates the book from a confirms/{dealReference} result; rejected deals change nothing."""
+        if not confirmation or confirmation.get("dealStatus") != "ACCEPTED":
+            return
+        now = time.monotonic()
+        epic = confirmation.get("epic")
+        affected = confirmation.get("affectedDeals") or [{"dealId": confirmation.get("dealId"), "status": confirmation.get("status")}]
+        with self._lock:
+            for deal in affected:
+                deal_id, status = deal.get("dealId"), deal.get("status")
+                if not deal_id:
+                    continue
+                self._touched[deal_id] = now
+                if status in ("OPENED", "OPEN") and deal_id not in self._orders.entries:
+                    position = {key: confirmation[key] for key in _POSITION_DIFF_FIELDS if key in confirmation}
+                    position["dealId"] = deal_id
+                    position["dealReference"] = confirmation.get("dealReference")
+                    self._positions.put(deal_id, epic, {"position": position, "market": {"epic": epic}})
+                elif status in ("FULLY_CLOSED", "CLOSED", "DELETED"):
+                    self._positions.pop(deal_id)
+                    self._orders.pop(deal_id)
+                elif status == "AMENDED":
+                    entry = self._positions.entries.get(deal_id)
+                    if entry is not None:
+                        position = dict(entry["position"])
+                        for key in ("stopLevel", "profitLevel", "trailingStop", "guaranteedStop"):
+                            if key in confirmation:
+                                position[key] = confirmation[key]
+                        self._positions.put(deal_id, self._positions.epic_of[deal_id], dict(entry, position=position))
+                else:
+                    # e.g. PARTIALLY_CLOSED: the remaining size is not in the confirmation; leave it to the next reconcile.
+                    self._touched.pop(deal_id, None)
+
+    def reconcile(self) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Replaces the book with server state (deals updated locally while the request was in flight
+        are kept) and returns the differences found: added / removed / changed dealIds for positions
+        and for orders. Also used for the initial seed.
+        """
+        fetch_started = time.monotonic()
+        server_positions = self.api.get_open_positions()
+        server_orders = self.api.get_working_orders()
+        diff = {
+            "positions": self._sync_table(self._positions, server_positions, "position",
+                                          self._position_epic, _POSITION_DIFF_FIELDS, fetch_started),
+            "orders": self._sync_table(self._orders, server_orders, "workingOrderData",
+                                       self._order_epic, _ORDER_DIFF_FIELDS, fetch_started),
+        }
+        self.last_reconciled_at = time.monotonic()
+        self.last_diff = diff
+        if any(ids for table in diff.values() for ids in table.values()):
+            logger.info(f"Position book reconciled: {diff}")
+        return diff
+
+    seed = reconcile
+
+    def _sync_table(self, table: "_DealIndex", server_entries: List[Dict[str, Any]], body_key: str, epic_of: Callable[[Dict[str, Any]], Optional[str]],
+                    fields: Tuple[str, ...], fetch_started: float) -> Dict[str, List[str]]:
+        added: List[str] = []
+        removed: List[str] = []
+        changed: List[str] = []
+        with self._lock:
+            server_ids = set()
+            for entry in server_entries:
+                deal_id = entry[body_key]["dealId"]
+                server_ids.add(deal_id)
+                if self._touched.get(deal_id, 0.0) > fetch_started:
+                    continue
+                local = table.entries.get(deal_id)
+                if local is None:
+                    added.append(deal_id)
+                elif any(local[body_key].get(key) != entry[body_key].get(key) for key in fields):
+                    changed.append(deal_id)
+                table.put(deal_id, epic_of(entry), entry)
+            for deal_id in [deal_id for deal_id in table.entries if deal_id not in server_ids]:
+                if self._touched.get(deal_id, 0.0) > fetch_started:
+                    continue
+                table.pop(deal_id)
+                removed.append(deal_id)
+            for deal_id in [deal_id for deal_id, at in self._touched.items() if at <= fetch_started]:
+                del self._touched[deal_id]
+        return {"added": added, "removed": removed, "changed": changed}
+
+    def start(self):
+        """Starts periodic reconciliation on a background thread (no-op without reconcile_interval)."""
+        if not self.reconcile_interval or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="CapitalComPositionBook", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.reconcile_interval):
+            try:
+                self.reconcile()
+            except CapitalComAPIError as e:
+                logger.error(f"Position book reconcile failed: {e}")
+
+
+class CandleStore:
+    """
+    Local on-disk OHLC store: one append-only file of OHLC_BAR_DTYPE records per (epic, resolution),
+    read back through memory maps. sync() only downloads bars newer than the last stored one.
+    """
+    FILE_MAGIC = b"CAPOHLC1"
+    HEADER_SIZE = 16
+    FILE_SUFFIX = ".ohlc"
+
+    def __init__(self, root_dir: str):
+        _require_numpy("CandleStore")
+        self.root_dir = os.path.abspath(root_dir)
+        self.dtype = np.dtype(OHLC_BAR_DTYPE)
+        self._locks: Dict[str, threading.RLock] = {}
+        self._locks_guard = threading.Lock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def _path(self, epic: str, resolution: HistoricalPriceResolution) -> str:
+        safe_epic = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in epic)
+        return os.path.join(self.root_dir, safe_epic, f"{resolution.value}{self.FILE_SUFFIX}")
+
+    def _lock_for(self, path: str) -> threading.RLock:
+        # Re-entrant: append() holds it while reading back the last stored timestamp.
+        with self._locks_guard:
+            return self._locks.setdefault(path, threading.RLock())
+
+    def _check_header(self, path: str):
+        with open(path, "rb") as f:
+            header = f.read(self.HEADER_SIZE)
+        if header[:len(self.FILE_MAGIC)] != self.FILE_MAGIC or int.from_bytes(header[8:16], "little") != self.dtype.itemsize:
+            raise CapitalComAPIError(f"{path} is not a candle store file of the current format.")
+
+    def _repair(self, path: str):
+        """
+        Cuts off a torn trailing record (or a torn header) left by a crash mid-write, so later appends
+        stay aligned to whole records. Must be called with the path's lock held.
+        """
+        if not os.path.exists(path):
+            return
+        size = os.path.getsize(path)
+        if size < self.HEADER_SIZE:
+            logger.warning(f"Removing {path}: only {size} bytes, the header was never fully written.")
+            os.remove(path)
+            return
+        torn = (size - self.HEADER_SIZE) % self.dtype.itemsize
+        if torn:
+            logger.warning(f"Truncating torn trailing record ({torn} bytes) from {path}.")
+            with open(path, "r+b") as f:
+                f.truncate(size - torn)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def count(self, epic: str, resolution: HistoricalPriceResolution) -> int:
+        path = self._path(epic, resolution)
+        if not os.path.exists(path):
+            return 0
+        return (os.path.getsize(path) - self.HEADER_SIZE) // self.dtype.itemsize
+
+    def read(self, epic: str, resolution: HistoricalPriceResolution,
+             start: Optional[Union[str, datetime]] = None, end: Optional[Union[str, datetime]] = None) -> "np.ndarray":
+        """
+        Returns stored bars (oldest first) as a read-only memory-mapped OHLC_BAR_DTYPE array,
+        optionally limited to start <= timestamp <= end. No data is copied until it is touched.
+        """
+        path = self._path(epic, resolution)
+        with self._lock_for(path):
+            self._repair(path)
+        n = self.count(epic, resolution)
+        if n <= 0:
+            return np.empty(0, dtype=self.dtype)
+        self._check_header(path)
+        bars = np.memmap(path, dtype=self.dtype, mode="r", offset=self.HEADER_SIZE, shape=(n,))
+        timestamps = bars["timestamp"]
+        lo = 0 if start is None else int(np.searchsorted(timestamps, np.datetime64(_to_utc_datetime(start), "ms"), side="left"))
+        hi = n if end is None else int(np.searchsorted(timestamps, np.datetime64(_to_utc_datetime(end), "ms"), side="right"))
+        return bars[lo:hi]
+
+    def last_timestamp(self, epic: str, resolution: HistoricalPriceResolution) -> Optional["np.datetime64"]:
+        n = self.count(epic, resolution)
+        if n <= 0:
+            return None
+        return self.read(epic, resolution)[n - 1]["timestamp"]
+
+    def append(self, epic: str, resolution: HistoricalPriceResolution, bars: "np.ndarray") -> int:
+        """Appends bars newer than the last stored bar (others are ignored). Returns the number written."""
+        path = self._path(epic, resolution)
+        with self._lock_for(path):
+            self._repair(path)
+            bars = np.asarray(bars, dtype=self.dtype)
+            bars = bars[~np.isnat(bars["timestamp"])]
+            bars = np.sort(bars, order="timestamp")
+            if len(bars):
+                _, unique_index = np.unique(bars["timestamp"], return_index=True)
+                bars = bars[unique_index]
+            last = self.last_timestamp(epic, resolution)
+            if last is not None:
+                bars = bars[bars["timestamp"] > last]
+            if not len(bars):
+                return 0
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            is_new = not os.path.exists(path)
+            with open(path, "ab") as f:
+                if is_new:
+                    f.write(self.FILE_MAGIC + self.dtype.itemsize.to_bytes(8, "little"))
+                f.write(bars.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            return len(bars)
+
+    def sync(self, api: "CapitalComAPI", epic: str, resolution: HistoricalPriceResolution,
+             start: Optional[Union[str, datetime]] = None, max_workers: int = 4) -> int:
+        """
+        Downloads bars newer than the last stored one (or from start for an empty store) up to now and
+        appends them. The still-forming current bar is left out so it is never stored half-built.
+        Returns the number of bars added.
+        """
+        last = self.last_timestamp(epic, resolution)
+        if last is not None:
+            fetch_from = last.astype("datetime64[ms]").astype(datetime)
+        elif start is not None:
+            fetch_from = _to_utc_datetime(start)
+        else:
+            raise ValueError(f"Candle store has no {resolution.value} bars for {epic}; a start date is required for the first sync.")
+
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if fetch_from >= now:
+            return 0
+        bars = api.fetch_history_range(epic, resolution, fetch_from, now, max_workers=max_workers, as_array=True)
+        cutoff = np.datetime64(now, "ms") - np.timedelta64(resolution.seconds, "s")
+        added = self.append(epic, resolution, bars[bars["timestamp"] <= cutoff])
+        logger.info(f"Candle store sync for {epic} {resolution.value}: {added} new bars (total {self.count(epic, resolution)}).")
+        return added
+
+TICK_RECORD_KIND_QUOTE = 0
+TICK_RECORD_KIND_OHLC = 1
+_RECORDER_RESOLUTIONS = [None] + [resolution.value for resolution in HistoricalPriceResolution]
+_RECORDER_BAR_TYPES = [bar_type.value for bar_type in OhlcBarType]
+_RECORDER_PRICE_TYPES = ["bid", "ask"]
+
+
+def _record_value(payload: Dict[str, Any], key: str) -> float:
+    value = payload.get(key)
+    return math.nan if value is None else value
+
+
+class TickRecorder:
+    """
+    Records raw WebSocket 'quote' / 'ohlc.event' payloads to append-only binary files of fixed-size
+    little-endian records (RECORD_STRUCT, 88 bytes) behind a 16-byte header (FILE_MAGIC + record size).
+    record() only queues the payload with its receive time; packing, batched writes and size-based
+    rotation happen on a background writer thread. Attach with CapitalComAPI.attach_tick_recorder().
+
+    Record fields: recv_ns (local receive time), timestamp (ms, payload 'timestamp' or 't'), kind
+    (0 quote, 1 ohlc), resolution / bar_type / price_type codes (see the _RECORDER_* tables), epic
+    (32 bytes ASCII) and four values: bid, bidQty, ofr, ofrQty for quotes, o, h, l, c for bars.
+    """
+    FILE_MAGIC = b"CAPTICK1"
+    HEADER_SIZE = 16
+    FILE_SUFFIX = ".ticks"
+    RECORD_STRUCT = struct.Struct("<qqBBBB4x32s4d")
+
+    def __init__(self, directory: str, rotate_bytes: int = 256 * 1024 * 1024, flush_interval: float = 0.5,
+                 max_pending: int = 1_000_000, prefix: str = "ticks"):
+        if rotate_bytes <= self.HEADER_SIZE + self.RECORD_STRUCT.size:
+            raise ValueError("rotate_bytes is too small to hold a single record.")
+        self.directory = os.path.abspath(directory)
+        self.rotate_bytes = rotate_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.prefix = prefix
+        self._pending: deque = deque()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file = None
+        self._file_bytes = 0
+        self._file_seq = 0
+        self.files: List[str] = []
+        self.records_written = 0
+        self.records_dropped = 0
+        self.write_errors = 0
+        # records_dropped is bumped by both the WebSocket thread and the writer thread.
+        self._stats_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="TickRecorder", daemon=True)
+        self._thread.start()
+        logger.info(f"Tick recorder writing to {self.directory}")
+
+    def stop(self, timeout: Optional[float] = 10):
+        """Writes out everything queued so far and closes the current file."""
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            if self._thread.is_alive():
+                logger.warning("Tick recorder writer did not finish within the timeout.")
+                return
+            self._thread = None
+        self._write_pending()
+        self._close_file()
+
+    def record(self, destination: str, payload: Optional[Dict[str, Any]]):
+        """Queues one payload; called from the WebSocket thread, so it does no formatting or I/O."""
+        if not payload:
+            return
+        if len(self._pending) >= self.max_pending:
+            with self._stats_lock:
+                self.records_dropped += 1
+            return
+        self._pending.append((time.time_ns(), destination, payload))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "records_written": self.records_written,
+            "records_dropped": self.records_dropped,
+            "write_errors": self.write_errors,
+            "pending": len(self._pending),
+            "files": list(self.files),
+        }
+
+    @classmethod
+    def pack(cls, recv_ns: int, destination: str, payload: Dict[str, Any]) -> bytes:
+        epic = str(payload.get("epic", "")).encode("ascii", "replace")[:32]
+        if destination == "quote":
+            return cls.RECORD_STRUCT.pack(
+                recv_ns, int(payload.get("timestamp") or 0), TICK_RECORD_KIND_QUOTE, 0, 0, 0, epic,
+                _record_value(payload, "bid"), _record_value(payload, "bidQty"),
+                _record_value(payload, "ofr"), _record_value(payload, "ofrQty"),
+            )
+        resolution = payload.get("resolution")
+        bar_type = payload.get("type", "classic")
+        price_type = payload.get("priceType", "bid")
+        return cls.RECORD_STRUCT.pack(
+            recv_ns, int(payload.get("t") or 0), TICK_RECORD_KIND_OHLC,
+            _RECORDER_RESOLUTIONS.index(resolution) if resolution in _RECORDER_RESOLUTIONS else 0,
+            _RECORDER_BAR_TYPES.index(bar_type) if bar_type in _RECORDER_BAR_TYPES else 0,
+            _RECORDER_PRICE_TYPES.index(price_type) if price_type in _RECORDER_PRICE_TYPES else 0,
+            epic,
+            _record_value(payload, "o"), _record_value(payload, "h"),
+            _record_value(payload, "l"), _record_value(payload, "c"),
+        )
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._write_pending()
+
+    def _write_pending(self):
+        pending = self._pending
+        pack = self.pack
+        record_size = self.RECORD_STRUCT.size
+        while pending:
+            if self._file is None:
+                self._open_file()
+            room = max(1, (self.rotate_bytes - self._file_bytes) // record_size)
+            batch = bytearray()
+            count = 0
+            while pending and count < room:
+                recv_ns, destination, payload = pending.popleft()
+                try:
+                    batch += pack(recv_ns, destination, payload)
+                    count += 1
+                except (struct.error, TypeError, ValueError) as e:
+                    with self._stats_lock:
+                        self.records_dropped += 1
+                    logger.warning(f"Tick recorder skipped malformed {destination} payload: {e}")
+            try:
+                self._file.write(batch)
+                self._file.flush()
+            except OSError as e:
+                with self._stats_lock:
+                    self.write_errors += 1
+                    self.records_dropped += count
+                logger.error(f"Tick recorder write to {self.files[-1]} failed, {count} record(s) lost: {e}")
+                self._close_file()
+                continue
+            self._file_bytes += len(batch)
+            self.records_written += count
+            if self._file_bytes + record_size > self.rotate_bytes:
+                self._close_file()
+
+    def _open_file(self):
+        self._file_seq += 1
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(self.directory, f"{self.prefix}-{stamp}-{self._file_seq:04d}{self.FILE_SUFFIX}")
+        self._file = open(path, "wb", buffering=1024 * 1024)
+        self._file.write(self.FILE_MAGIC + self.RECORD_STRUCT.size.to_bytes(8, "little"))
+        self._file_bytes = self.HEADER_SIZE
+        self.files.append(path)
+        logger.debug(f"Tick recorder opened {path}")
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError as e:
+                logger.error(f"Tick recorder failed to close {self.files[-1]}: {e}")
+            self._file = None
+            self._file_bytes = 0
+
+
+# NumPy view of TickRecorder.RECORD_STRUCT, used to memory-map recorded files.
+TICK_RECORD_DTYPE = [
+    ("recv_ns", "<i8"),
+    ("timestamp", "<i8"),
+    ("kind", "u1"), ("resolution", "u1"), ("bar_type", "u1"), ("price_type", "u1"),
+    ("_pad", "V4"),
+    ("epic", "S32"),
+    ("v0", "<f8"), ("v1", "<f8"), ("v2", "<f8"), ("v3", "<f8"),
+]
+
+
+def _replay_value(value: float) -> Optional[float]:
+    return None if value != value else value
+
+
+class TickReplayer:
+    """
+    Plays TickRecorder files back through api._ws_dispatch, i.e. through the same routing, tick buffers,
+    listener fan-out and dispatch mode as live 'quote' / 'ohlc.event' messages, so callbacks registered
+    with subscribe_to_epic_data / subscribe_many see the recorded payloads in recorded order.
+    Files are read through memory maps in chunks. speed=None replays as fast as possible; otherwise
+    speed is a multiple of real time based on the recorded receive times (1.0 = as recorded).
+    Use CapitalComAPI(..., offline=True) to subscribe callbacks without logging in.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, api: "CapitalComAPI", paths: Union[str, List[str]], speed: Optional[float] = None,
+                 epics: Optional[List[str]] = None):
+        _require_numpy("TickReplayer")
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be positive, or None for maximum speed.")
+        self.api = api
+        self.speed = speed
+        self.epics = epics
+        self.paths = self._resolve_paths(paths)
+        self.dtype = np.dtype(TICK_RECORD_DTYPE)
+        if self.dtype.itemsize != TickRecorder.RECORD_STRUCT.size:
+            raise CapitalComAPIError("TICK_RECORD_DTYPE does not match TickRecorder.RECORD_STRUCT.")
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _resolve_paths(paths: Union[str, List[str]]) -> List[str]:
+        """A directory expands to its recorder files in name (i.e. recording) order."""
+        if isinstance(paths, str):
+            if os.path.isdir(paths):
+                return sorted(os.path.join(paths, name) for name in os.listdir(paths)
+                              if name.endswith(TickRecorder.FILE_SUFFIX))
+            return [paths]
+        return list(paths)
+
+    def read_records(self, path: str) -> "np.ndarray":
+        """Returns the records of one recorder file as a read-only memory-mapped TICK_RECORD_DTYPE array."""
+        with open(path, "rb") as f:
+            header = f.read(TickRecorder.HEADER_SIZE)
+        if header[:len(TickRecorder.FILE_MAGIC)] != TickRecorder.FILE_MAGIC or int.from_bytes(header[8:16], "little") != self.dtype.itemsize:
+            raise CapitalComAPIError(f"{path} is not a tick recorder file of the current format.")
+        n = (os.path.getsize(path) - TickRecorder.HEADER_SIZE) // self.dtype.itemsize
+        if n <= 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.memmap(path, dtype=self.dtype, mode="r", offset=TickRecorder.HEADER_SIZE, shape=(n,))
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self) -> Dict[str, Any]:
+        """Replays all files and returns counts and the achieved message rate."""
+        self._stop_event.clear()
+        wanted = None if self.epics is None else np.array([epic.encode("ascii") for epic in self.epics], dtype="S32")
+        dispatch = self.api._ws_dispatch
+        epic_names: Dict[bytes, str] = {}
+        messages = dispatched = 0
+        first_recv_ns: Optional[int] = None
+        started = time.perf_counter()
+
+        for path in self.paths:
+            records = self.read_records(path)
+            logger.info(f"Replaying {len(records)} records from {path}")
+            for offset in range(0, len(records), self.CHUNK_SIZE):
+                chunk = records[offset:offset + self.CHUNK_SIZE]
+                if wanted is not None:
+                    chunk = chunk[np.isin(chunk["epic"], wanted)]
+                if self.speed is not None and len(chunk):
+                    if first_recv_ns is None:
+                        first_recv_ns = int(chunk["recv_ns"][0])
+                    recv_times = chunk["recv_ns"].tolist()
+                else:
+                    recv_times = None
+                columns = zip(chunk["kind"].tolist(), chunk["epic"].tolist(), chunk["timestamp"].tolist(),
+                              chunk["resolution"].tolist(), chunk["bar_type"].tolist(), chunk["price_type"].tolist(),
+                              chunk["v0"].tolist(), chunk["v1"].tolist(), chunk["v2"].tolist(), chunk["v3"].tolist())
+                for i, (kind, raw_epic, timestamp, resolution, bar_type, price_type, v0, v1, v2, v3) in enumerate(columns):
+                    if self._stop_event.is_set():
+                        return self._stats(messages, dispatched, started)
+                    if recv_times is not None:
+                        due = (recv_times[i] - first_recv_ns) / 1e9 / self.speed - (time.perf_counter() - started)
+                        if due > 0.001:
+                            self._stop_event.wait(due)
+                    epic = epic_names.get(raw_epic)
+                    if epic is None:
+                        epic = epic_names[raw_epic] = raw_epic.decode("ascii", "replace")
+                    if kind == TICK_RECORD_KIND_QUOTE:
+                        payload = {"epic": epic, "timestamp": timestamp,
+                                   "bid": _replay_value(v0), "bidQty": _replay_value(v1),
+                                   "ofr": _replay_value(v2), "ofrQty": _replay_value(v3)}
+                        destination = "quote"
+                    else:
+                        payload = {"epic": epic, "resolution": _RECORDER_RESOLUTIONS[resolution],
+                                   "type": _RECORDER_BAR_TYPES[bar_type], "priceType": _RECORDER_PRICE_TYPES[price_type],
+                                   "t": timestamp, "o": _replay_value(v0), "h": _replay_value(v1),
+                                   "l": _replay_value(v2), "c": _replay_value(v3)}
+                        destination = "ohlc.event"
+                    messages += 1
+                    if dispatch(destination, payload):
+                        dispatched += 1
+            del records
+
+        return self._stats(messages, dispatched, started)
+
+    @staticmethod
+    def _stats(messages: int, dispatched: int, started: float) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - started
+        stats = {
+            "messages": messages,
+            "dispatched": dispatched,
+            "elapsed_seconds": elapsed,
+            "messages_per_second": messages / elapsed if elapsed > 0 else 0.0,
+        }
+        logger.info(f"Replay finished: {messages} messages ({dispatched} routed) in {elapsed:.3f}s")
+        return stats
+
+
+class AsyncCapitalComAPI(_AuthTokenMixin):
+    """
+    asyncio counterpart of CapitalComAPI for the REST endpoints, built on aiohttp.
+    Token refresh and 401 re-login/retry follow CapitalComAPI._request; concurrent requests that
+    hit an expired session share a single re-login. WebSocket streaming stays on CapitalComAPI.
+    """
+    BASE_URLS = CapitalComAPI.BASE_URLS
+
+    def __init__(self, api_key: str, identifier: str, password: str, environment: Environment = Environment.DEMO,
+                 max_connections: int = 100, rate_limiter: Optional[RateLimiter] = None, rate_limit: bool = True):
+        if aiohttp is None:
+            raise ImportError("AsyncCapitalComAPI requires the 'aiohttp' package (pip install aiohttp).")
+        self.api_key = api_key
+        self.identifier = identifier
+        self.password = password
+        self.environment = environment
+        self.base_url = self.BASE_URLS[environment]
+        self.max_connections = max_connections
+
+        self.session: Optional["aiohttp.ClientSession"] = None
+        self._base_headers = {"X-CAP-API-KEY": self.api_key, "Content-Type": "application/json"}
+
+        self.cst: Optional[str] = None
+        self.x_security_token: Optional[str] = None
+        self.active_account_id: Optional[str] = None
+
+        self._login_lock: Optional[asyncio.Lock] = None
+        self.rate_limiter: Optional[RateLimiter] = rate_limiter or (RateLimiter() if rate_limit else None)
+
+        logger.info(f"AsyncCapitalComAPI initialized for {environment.value} environment.")
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(headers=self._base_headers, connector=connector)
+        return self.session
+
+    def _get_login_lock(self) -> asyncio.Lock:
+        # Created lazily so the lock binds to the loop the client is actually used on.
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        return self._login_lock
+
+    def get_rate_limit_stats(self) -> Dict[str, Dict[str, Any]]:
+        return self.rate_limiter.stats() if self.rate_limiter else {}
+
+    async def _send(self, method: str, endpoint: str, url: str, params: Optional[Dict[str, Any]],
+                    data: Optional[Dict[str, Any]], headers: Dict[str, str]) -> Tuple[int, bytes, Any]:
+        """Async counterpart of CapitalComAPI._send. Returns (status, body, headers)."""
+        session = self._get_session()
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async(method, endpoint)
+            async with session.request(method, url, params=params, json=data, headers=headers) as response:
+                body = await response.read()
+                status = response.status
+                response_headers = response.headers
+            if status != 429 or not self.rate_limiter or attempt >= self.rate_limiter.max_throttle_retries:
+                return status, body, response_headers
+            attempt += 1
+            backoff = self.rate_limiter.on_throttled(method, endpoint, response_headers.get("Retry-After"), attempt)
+            logger.warning(f"Received 429 Too Many Requests for {method} {endpoint}. Backing off {backoff:.2f}s (retry {attempt}/{self.rate_limiter.max_throttle_retries}).")
+
+    async def close(self):
+        """Closes the underlying HTTP session. Does not log out."""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _relogin(self, stale_cst: Optional[str]) -> bool:
+        """Logs in again unless another coroutine already refreshed the session since stale_cst was used."""
+        async with self._get_login_lock():
+            if self.cst and self.x_security_token and self.cst != stale_cst:
+                logger.debug("Session was already refreshed by a concurrent request. Reusing new tokens.")
+                return True
+            return await self.login()
+
+    async def _request(self, method: str, endpoint: str, params: Optional[Dict[str, Any]] = None,
+                       data: Optional[Dict[str, Any]] = None, add_auth_headers: bool = True,
+                       is_login_retry: bool = False) -> Optional[Any]:
+        url = f"{self.base_url}/{endpoint}"
+        current_headers: Dict[str, str] = {}
+
+        if add_auth_headers:
+            if not self.cst or not self.x_security_token:
+                if is_login_retry:
+                    raise CapitalComAPIError("Recursive login attempt failed. CST or X-SECURITY-TOKEN still missing.")
+                logger.warning(f"Auth tokens missing for request to {endpoint}. Attempting re-login.")
+                if not await self._relogin(None):
+                     raise CapitalComAPIError(f"Re-login failed. Cannot proceed with the request to {endpoint}.")
+            current_headers["CST"] = self.cst
+            current_headers["X-SECURITY-TOKEN"] = self.x_security_token
+
+        try:
+            used_cst = current_headers.get("CST")
+            status, body, response_headers = await self._send(method, endpoint, url, params, data, current_headers)
+            logger.debug(f"Request: {method} {url} | Params: {params} | Data: {data}")
+
+            if add_auth_headers or endpoint == "session":
+                self._update_auth_tokens(response_headers)
+
+            if status == 401 and add_auth_headers and not is_login_retry:
+                logger.warning(f"Received 401 Unauthorized for {endpoint}. Session may have expired. Re-logging in and retrying request.")
+                if await self._relogin(used_cst):
+                    current_headers["CST"] = self.cst
+                    current_headers["X-SECURITY-TOKEN"] = self.x_security_token
+                    status, body, response_headers = await self._send(method, endpoint, url, params, data, current_headers)
+                    logger.debug(f"Retry Response Status for {endpoint} after re-login: {status}")
+                    self._update_auth_tokens(response_headers)
+                else:
+                    raise CapitalComAPIError(f"Re-login failed during request retry for {endpoint}.", status, body.decode(errors="replace"))
+
+            text = body.decode(errors="replace")
+            if status >= 400:
+                try:
+                    error_data = json.loads(text) if body else "No response body"
+                except json.JSONDecodeError:
+                    error_data = text
+                logger.error(f"HTTP Error {status} on {method} {url}. Response: {error_data}")
+                raise CapitalComAPIError(f"API request failed: {status} for url {url}", status, error_data)
+
+            if endpoint == "ping" and status == 200:
+                return text
+
+            if status == 204:
+                return None
+            if body:
+                try:
+                    return json.loads(text)
+                except json.JSONDecodeError:
+                    logger.error(f"Failed to decode JSON from response for {endpoint}: {text}")
+                    raise CapitalComAPIError("Failed to decode JSON response", status, text)
+            return None
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Request Exception for {method} {url}: {e!r}")
+            raise CapitalComAPIError(f"Network or request error: {e!r}") from e
+
+    async def login(self) -> bool:
+        logger.info("Attempting to login...")
+        payload = {"identifier": self.identifier, "password": self.password, "encryptedPassword": False}
+        session = self._get_session()
+        try:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async("POST", "session")
+            async with session.post(f"{self.base_url}/session", json=payload) as response:
+                body = await response.read()
+                status = response.status
+                self._update_auth_tokens(response.headers)
+
+            if status >= 400:
+                logger.error(f"Login HTTP Error: {status}. Response: {body.decode(errors='replace')}")
+                self.cst = None
+                self.x_security_token = None
+                return False
+
+            if not self.cst or not self.x_security_token:
+                logger.error("Login failed: CST or X-SECURITY-TOKEN not found in response headers despite successful status code.")
+                return False
+
+            logger.info("Login successful.")
+            data = json.loads(body) if body else None
+            if data and data.get("currentAccountId"):
+                self.active_account_id = data["currentAccountId"]
+                logger.info(f"Active account ID set from login response: {self.active_account_id}")
+            else:
+                logger.warning("currentAccountId not found in login response. Active account may need to be set manually or fetched.")
+            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Login Request Exception: {e!r}")
+            self.cst = None
+            self.x_security_token = None
+            return False
+        except json.JSONDecodeError:
+            logger.error(f"Failed to decode JSON from login response: {body}")
+            self.cst = None
+            self.x_security_token = None
+            return False
+
+    async def logout(self) -> bool:
+        if not self.cst or not self.x_security_token:
+            logger.info("Not logged in (no active session tokens), no server logout needed.")
+        else:
+            logger.info("Logging out from server...")
+            try:
+                await self._request("DELETE", "session")
+                logger.info("Logout successful on server.")
+            except CapitalComAPIError as e:
+                logger.error(f"Logout request to server failed: {e}. Clearing local session tokens anyway.")
+        self.cst = None
+        self.x_security_token = None
+        self.active_account_id = None
+        return True
+
+    async def ping_server(self) -> bool:
+        """Pings the server to check general connectivity. This does not keep the trading session alive."""
+        try:
+            response_text = await self._request("GET", "ping", add_auth_headers=False)
+            if response_text == "pong":
+                return True
+            logger.warning(f"Server ping returned unexpected response: '{response_text}'")
+            return False
+        except CapitalComAPIError as e:
+            logger.error(f"Server ping failed: {e}")
+            return False
+
+    async def get_accounts(self) -> List[Dict[str, Any]]:
+        response_data = await self._request("GET", "accounts")
+        return response_data.get("accounts", []) if response_data else []
+
+    async def get_active_account_details(self) -> Optional[Dict[str, Any]]:
+        accounts_list = await self.get_accounts()
+        if not self.active_account_id:
+            if accounts_list and accounts_list[0].get("accountId"):
+                self.active_account_id = accounts_list[0]["accountId"]
+                logger.info(f"Defaulting to first account found: {self.active_account_id}")
+                return accounts_list[0]
+            logger.error("No active account ID set and no accounts found to default to.")
+            return None
+
+        for acc in accounts_list:
+            if acc.get("accountId") == self.active_account_id:
+                return acc
+        logger.error(f"Could not find details for active account ID: {self.active_account_id} in the fetched list.")
+        return None
+
+    async def get_balance(self) -> Optional[float]:
+        details = await self.get_active_account_details()
+        if not details:
+            logger.error("Cannot get balance: active account details not available.")
+            return None
+        return _balance_from_account_details(details)
+
+    async def switch_account(self, account_id: str) -> bool:
+        logger.info(f"Attempting to switch active account to: {account_id}")
+        try:
+            await self._request("PUT", "session", data={"accountId": account_id})
+            session_details = await self._request("GET", "session")
+            if session_details and session_details.get("accountId") == account_id:
+                self.active_account_id = account_id
+                logger.info(f"Successfully switched to account: {account_id} and confirmed via GET /session.")
+                return True
+            logger.error(f"Failed to confirm account switch to {account_id} via GET /session. Current session account: {session_details.get('accountId') if session_details else 'N/A'}")
+            return False
+        except CapitalComAPIError as e:
+            logger.error(f"Error during account switch to {account_id}: {e}")
+            return False
+
+    async def get_open_positions(self) -> List[Dict[str, Any]]:
+        data = await self._request("GET", "positions")
+        return data.get("positions", []) if data else []
+
+    async def get_working_orders(self) -> List[Dict[str, Any]]:
+        data = await self._request("GET", "workingorders")
+        return data.get("workingOrders", []) if data else []
+
+    async def get_transaction_history(self, transaction_type: Optional[str] = None, from_date: Optional[str] = None,
+                                      to_date: Optional[str] = None, detailed: bool = False,
+                                      last_period_seconds: Optional[int] = None) -> List[Dict[str, Any]]:
+        params = _transaction_history_params(transaction_type, from_date, to_date, detailed, last_period_seconds)
+        data = await self._request("GET", "history/transactions", params=params)
+        return data.get("transactions", []) if data else []
+
+    async def get_closed_trades(self, from_date: Optional[str] = None, to_date: Optional[str] = None,
+                                last_period_seconds: Optional[int] = None) -> List[Dict[str, Any]]:
+        return await self.get_transaction_history(transaction_type="TRADE", from_date=from_date, to_date=to_date,
+                                                  detailed=True, last_period_seconds=last_period_seconds)
+
+    async def iter_transaction_history(self, from_date: Union[str, datetime], to_date: Optional[Union[str, datetime]] = None,
+                                       transaction_type: Optional[str] = None, detailed: bool = False,
+                                       window: timedelta = timedelta(days=1), prefetch: bool = True) -> AsyncIterator[Dict[str, Any]]:
+        """Async counterpart of CapitalComAPI.iter_transaction_history; prefetching uses a task instead of a thread."""
+        windows = _transaction_windows(from_date, to_date, window)
+
+        async def fetch(bounds: Tuple[str, str]) -> List[Dict[str, Any]]:
+            try:
+                return await self.get_transaction_history(transaction_type, bounds[0], bounds[1], detailed)
+            except CapitalComAPIError as e:
+                if e.status_code == 404:
+                    return []
+                raise
+
+        bounds = next(windows, None)
+        pending = asyncio.ensure_future(fetch(bounds)) if prefetch and bounds else None
+        previous_keys: set = set()
+        try:
+            while bounds is not None:
+                next_bounds = next(windows, None)
+                if pending is not None:
+                    transactions = await pending
+                    pending = asyncio.ensure_future(fetch(next_bounds)) if next_bounds else None
+                else:
+                    transactions = await fetch(bounds)
+                fresh, previous_keys = _new_window_transactions(transactions, previous_keys)
+                for transaction in fresh:
+                    yield transaction
+                bounds = next_bounds
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+
+    async def iter_closed_trades(self, from_date: Union[str, datetime], to_date: Optional[Union[str, datetime]] = None,
+                                 window: timedelta = timedelta(days=1), prefetch: bool = True) -> AsyncIterator[Dict[str, Any]]:
+        async for transaction in self.iter_transaction_history(from_date, to_date, transaction_type="TRADE", detailed=True,
+                                                               window=window, prefetch=prefetch):
+            yield transaction
+
+    async def open_trade(self, epic: str, direction: TradeDirection, size: float,
+                         guaranteed_stop: bool = False, stop_level: Optional[float] = None,
+                         stop_distance: Optional[float] = None, profit_level: Optional[float] = None,
+                         profit_distance: Optional[float] = None, trailing_stop: bool = False,
+                         trailing_stop_distance: Optional[float] = None,
+                         force_open: bool = True) -> Optional[Dict[str, Any]]:
+        logger.info(f"Opening {direction.value} trade for {epic}, size {size}")
+        payload = _open_trade_payload(epic, direction, size, guaranteed_stop, stop_level, stop_distance,
+                                      profit_level, profit_distance, trailing_stop, trailing_stop_distance, force_open)
+        return await self._request("POST", "positions", data=payload)
+
+    async def get_deal_confirmation(self, deal_reference: str) -> Optional[Dict[str, Any]]:
+        return await self._request("GET", f"confirms/{deal_reference}")
+
+    async def wait_for_confirmation(self, deal: Union[str, Dict[str, Any]], timeout_seconds: float = 30.0,
+                                    initial_interval: float = 0.05, max_interval: float = 1.0,
+                                    backoff_factor: float = 1.5) -> Dict[str, Any]:
+        """
+        Polls confirms/{dealReference} with the same backoff as DealConfirmationTracker until the deal is
+        ACCEPTED or REJECTED. Gather several of these to follow many deals concurrently.
+        """
+        deal_reference = deal.get("dealReference") if isinstance(deal, dict) else deal
+        if not deal_reference:
+            raise ValueError(f"No dealReference to wait for in {deal!r}.")
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        interval = initial_interval
+        polls = 0
+        status = None
+        while True:
+            await asyncio.sleep(min(interval, max(0.0, started + timeout_seconds - loop.time())))
+            polls += 1
+            try:
+                confirmation = await self.get_deal_confirmation(deal_reference)
+            except CapitalComAPIError as e:
+                if e.status_code != 404 and not _is_transient_api_error(e):
+                    raise
+                confirmation = None
+            status = (confirmation or {}).get("dealStatus")
+            if status in DealConfirmationTracker.FINAL_DEAL_STATUSES:
+                logger.info(f"Deal {deal_reference} {status} after {loop.time() - started:.3f}s ({polls} polls).")
+                return confirmation
+            if loop.time() - started >= timeout_seconds:
+                raise CapitalComAPIError(f"Deal {deal_reference} not confirmed within {timeout_seconds:.1f}s "
+                                         f"({polls} polls, last status {status}).")
+            interval = min(interval * backoff_factor, max_interval)
+
+    async def open_trades_bulk(self, orders: List[Dict[str, Any]], max_concurrency: int = 10) -> List[Dict[str, Any]]:
+        """Async counterpart of CapitalComAPI.open_trades_bulk; at most max_concurrency requests are in flight."""
+        _validate_bulk_orders(orders, self.open_trade)
+        if not orders:
+            return []
+        logger.info(f"Opening {len(orders)} trades concurrently (max {max_concurrency} in flight)...")
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        batch_started = time.perf_counter()
+
+        async def place(index: int, order: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                started = time.perf_counter()
+                response, error = None, None
+                try:
+                    response = await self.open_trade(**order)
+                except CapitalComAPIError as e:
+                    error = e
+                    logger.error(f"Bulk order {index} ({order['epic']}) failed: {e}")
+                except Exception as e:
+                    # Keep the other orders' results: some of them may already have been sent.
+                    error = e
+                    logger.error(f"Bulk order {index} ({order['epic']}) raised unexpectedly: {e}", exc_info=True)
+                return _bulk_order_result(index, order, response, error, started, time.perf_counter(), batch_started)
+
+        results = await asyncio.gather(*(place(index, order) for index, order in enumerate(orders)))
+        failed = sum(1 for result in results if not result["ok"])
+        logger.info(f"Bulk open finished in {time.perf_counter() - batch_started:.3f}s: {len(orders) - failed} ok, {failed} failed.")
+        return list(results)
+
+    async def close_trade(self, deal_id: str, direction: Optional[TradeDirection] = None,
+                          size: Optional[float] = None, order_type: str = "MARKET",
+                          level: Optional[float] = None,
+                          time_in_force: str = "GOOD_TILL_CANCELLED") -> Optional[Dict[str, Any]]:
+        """Closes an OTC trade. Uses the same DELETE /positions request body as CapitalComAPI.close_trade."""
+        logger.info(f"Attempting to close trade {deal_id} (Size: {size if size else 'Full'}, Direction: {direction.value if direction else 'N/A'})")
+        payload = _close_trade_payload(deal_id, direction, size, order_type, level, time_in_force)
+        return await self._request("DELETE", "positions", data=payload)
+
+    async def update_trade(self, deal_id: str, stop_level: Optional[float] = None,
+                           profit_level: Optional[float] = None,
+                           trailing_stop: Optional[bool] = None,
+                           trailing_stop_distance: Optional[float] = None,
+                           guaranteed_stop: Optional[bool] = None) -> Optional[Dict[str, Any]]:
+        payload = _update_trade_payload(stop_level, profit_level, trailing_stop, trailing_stop_distance, guaranteed_stop)
+        if not payload:
+            logger.warning("Update_trade called with no parameters to update. No action taken.")
+            return None
+        return await self._request("PUT", f"positions/{deal_id}", data=payload)
+
+    async def get_historical_prices(self, epic: str, resolution: HistoricalPriceResolution,
+                                    num_points: Optional[int] = None, start_date: Optional[str] = None,
+                                    end_date: Optional[str] = None, as_array: bool = False) -> Optional[Any]:
+        params = _historical_prices_params(resolution, num_points, start_date, end_date)
+        data = await self._request("GET", f"prices/{epic}", params=params)
+        if as_array:
+            return historical_prices_to_array(data.get("prices", []) if data else [])
+        return data
+
+    async def get_market_details(self, epic: Optional[str] = None, epics: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        endpoint, params = _market_details_request(epic, epics)
+        return await self._request("GET", endpoint, params=params)
+
+    async def get_account_preferences(self) -> Optional[Dict[str, Any]]:
+        try:
+            preferences = await self._request("GET", "accounts/preferences")
+            _log_account_preferences(preferences)
+            return preferences
+        except CapitalComAPIError as e:
+            logger.error(f"Failed to get account preferences: {e}")
+            return None
+
+    async def set_account_preferences(self, hedging_enabled: Optional[bool] = None,
+                                      leverages: Optional[Dict[str, int]] = None) -> bool:
+        payload: Dict[str, Any] = {}
+        if hedging_enabled is not None:
+            payload["hedgingMode"] = hedging_enabled
+        if leverages is not None:
+            payload["leverages"] = leverages
+        if not payload:
+            logger.warning("set_account_preferences called with no parameters to update. No action taken.")
+            return False
+        try:
+            await self._request("PUT", "account/preferences", data=payload)
+            return True
+        except CapitalComAPIError as e:
+            logger.error(f"Failed to set account preferences: {e}")
+            return False
+
+    async def calculate_trade_size_for_amount(self, epic: str,
+                                              investment_amount_in_quote_currency: float,
+                                              direction: TradeDirection) -> float:
+        """Async version of CapitalComAPI.calculate_trade_size_for_amount. Market details and preferences are fetched concurrently."""
+        if investment_amount_in_quote_currency <= 0:
+            logger.warning(f"Investment amount (margin) {investment_amount_in_quote_currency} must be positive. Returning size 0.0.")
+            return 0.0
+        market_data, account_prefs = await asyncio.gather(self.get_market_details(epic=epic),
+                                                          self.get_account_preferences())
+        return _trade_size_for_amount(epic, investment_amount_in_quote_currency, direction, market_data, account_prefs)
+
+    async def calculate_trade_size_for_margin(self, epic: str,
+                                              margin_amount_in_quote_currency: float,
+                                              direction: TradeDirection) -> float:
+        if margin_amount_in_quote_currency <= 0:
+            logger.warning(f"Margin amount {margin_amount_in_quote_currency} must be positive. Returning size 0.0.")
+            return 0.0
+        market_data = await self.get_market_details(epic=epic)
+        return _trade_size_for_margin(epic, margin_amount_in_quote_currency, direction, market_data)
+
+    async def __aenter__(self):
+        if not await self.login():
+            await self.close()
+            raise CapitalComAPIError("Failed to login upon entering context manager.")
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        logger.info("Exiting async context manager, ensuring logout...")
+        try:
+            await self.logout()
+        finally:
+            await self.close()